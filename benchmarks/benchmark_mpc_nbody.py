@@ -0,0 +1,272 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# mpc_nbody/benchmarks/benchmark_mpc_nbody.py
+
+'''
+----------------------------------------------------------------------------
+Throughput benchmarks of mpc_nbody's hot paths, at several scales (numbers
+of objects), on synthetic variants of the dev_data files (no network).
+
+Measured (best of --repeat runs, after one warm-up run):
+(a) parse_orbfit & parse_orbfit_batch: OrbFit files per second
+(b) ecliptic_to_equatorial & equatorial_helio2bary: vectors per second
+(c) _fix_input: particles per second, for (N, 6) and structured arrays
+(d) run_nbody: particle-days per second
+(e) save_output: MB per second, text & binary
+
+Results are written as JSON (--output), so that runs can be compared:
+
+    python benchmarks/benchmark_mpc_nbody.py --scales 1 1000 --output a.json
+
+equatorial_helio2bary & run_nbody need the JPL kernel and the reboundx
+ephem_forces integrator (see README.md).
+----------------------------------------------------------------------------
+'''
+
+# Import third-party packages
+# -----------------------------------------------------------------------------
+import sys
+import os
+import json
+import time
+import platform
+import argparse
+import tempfile
+import numpy as np
+
+# Import neighbouring packages
+# -----------------------------------------------------------------------------
+sys.path.append(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+from mpc_nbody import mpc_nbody
+from mpc_nbody import parse_input
+
+# Default for caching stuff using lru_cache
+# -----------------------------------------------------------------------------
+
+# Constants and stuff
+# -----------------------------------------------------------------------------
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'dev_data')
+TEMPLATE_FILE = os.path.join(DATA_DIR, '30101.eq0_postfit')
+DEFAULT_SCALES = [1, 1000, 100000]
+BENCHMARK_VERSION = 1  # Increase when results are no longer comparable
+RELATIVE_SCATTER = 1e-3  # Of the synthetic states around the template's
+EPOCH_SCATTER = 30  # Synthetic epochs are up to this many days apart
+
+
+# Synthetic data
+# -----------------------------------------------------------------------------
+
+def template_state():
+    '''The heliocentric ecliptic state & MJD (TT) of the template file.'''
+    with open(TEMPLATE_FILE) as infile:
+        lines = infile.read().splitlines()
+    car = [line for line in lines if line.startswith(' CAR ')][0]
+    mjd = [line for line in lines if line.startswith(' MJD ')][0]
+    return np.array(car.split()[1:], dtype=float), float(mjd.split()[1])
+
+
+def synthetic_states(n_objects, rng):
+    '''
+    n_objects heliocentric ecliptic states (n_objects, 6) scattered around
+    the template's, and their epochs (JD TDB, whole days apart).
+    '''
+    state, mjd_tt = template_state()
+    states = state * (1 + RELATIVE_SCATTER *
+                      rng.standard_normal((n_objects, 6)))
+    mjd_tt = mjd_tt + rng.integers(0, EPOCH_SCATTER, n_objects)
+    return states, parse_input.mjd_tt_to_jd_tdb(mjd_tt)
+
+
+def write_synthetic_orbfit_files(directory, n_objects, rng):
+    '''
+    Write n_objects copies of the template OrbFit file to directory, with
+    their cartesian states & epochs replaced by synthetic ones.
+    Returns the list of filenames.
+    '''
+    state, mjd_tt = template_state()
+    with open(TEMPLATE_FILE) as infile:
+        template = infile.read()
+    car = [line for line in template.splitlines()
+           if line.startswith(' CAR ')][0]
+    template = template.replace(car, ' CAR {car}').replace(
+        f'{mjd_tt:.9f}', '{mjd:.9f}')
+    states = state * (1 + RELATIVE_SCATTER *
+                      rng.standard_normal((n_objects, 6)))
+    epochs = mjd_tt + rng.integers(0, EPOCH_SCATTER, n_objects)
+    filenames = []
+    for i, (row, epoch) in enumerate(zip(states, epochs)):
+        filename = os.path.join(directory, f'{i:07d}.eq0')
+        with open(filename, 'w') as outfile:
+            outfile.write(template.format(
+                car=' '.join(f'{value: .14E}' for value in row), mjd=epoch))
+        filenames.append(filename)
+    return filenames
+
+
+# Benchmarks
+# -----------------------------------------------------------------------------
+
+def best_time(function, repeat, setup=None):
+    '''Best wall-clock time [s] of repeat calls, after one warm-up call.'''
+    times = []
+    for _ in range(repeat + 1):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times[1:])
+
+
+def result(benchmark, n_objects, seconds, amount, unit, **details):
+    '''One benchmark result: amount units were processed in seconds.'''
+    return dict({'benchmark': benchmark, 'n_objects': n_objects,
+                 'seconds': seconds, 'rate': amount / seconds,
+                 'unit': unit}, **details)
+
+
+def bench_parse(n_objects, args, rng):
+    '''OrbFit files per second, one by one and in a batch.'''
+    with tempfile.TemporaryDirectory() as directory:
+        filenames = write_synthetic_orbfit_files(directory, n_objects, rng)
+        single = filenames[:args.max_loop]
+        P = parse_input.ParseElements()
+
+        def parse_one_by_one():
+            for filename in single:
+                P.parse_orbfit(filename)
+        return [
+            result('parse_orbfit', n_objects,
+                   best_time(parse_one_by_one, args.repeat), len(single),
+                   'files/s', n_measured=len(single)),
+            result('parse_orbfit_batch', n_objects,
+                   best_time(lambda: parse_input.parse_orbfit_batch(filenames),
+                             args.repeat), n_objects, 'files/s')]
+
+
+def bench_transforms(n_objects, args, rng):
+    '''Vectors per second of the frame & origin transformations.'''
+    states, jd_tdb = synthetic_states(n_objects, rng)
+    equatorial = parse_input.ecliptic_to_equatorial(states)
+    return [
+        result('ecliptic_to_equatorial', n_objects,
+               best_time(lambda: parse_input.ecliptic_to_equatorial(states),
+                         args.repeat), n_objects, 'vectors/s'),
+        result('equatorial_helio2bary', n_objects,
+               best_time(lambda: parse_input.equatorial_helio2bary(equatorial,
+                                                                   jd_tdb),
+                         args.repeat, parse_input.sun_offset_cache.clear),
+               n_objects, 'vectors/s')]
+
+
+def bench_fix_input(n_objects, args, rng):
+    '''Particles per second through _fix_input, for the usual layouts.'''
+    states, _ = synthetic_states(n_objects, rng)
+    structured = np.empty(n_objects, dtype=parse_input.BARY_EQU_DTYPE)
+    for i, name in enumerate(parse_input.BARY_EQU_DTYPE.names):
+        structured[name] = states[:, i]
+    return [result(f'_fix_input[{layout}]', n_objects,
+                   best_time(lambda: mpc_nbody._fix_input(vectors),
+                             args.repeat), n_objects, 'particles/s')
+            for layout, vectors in [('array', states),
+                                    ('structured', structured)]]
+
+
+def bench_run_nbody(n_objects, args, rng):
+    '''Particle-days per second of one multi-particle integration.'''
+    states, jd_tdb = synthetic_states(n_objects, rng)
+    vectors = parse_input.equatorial_helio2bary(
+        parse_input.ecliptic_to_equatorial(states), jd_tdb[0])
+    seconds = best_time(lambda: mpc_nbody.run_nbody(
+        vectors, jd_tdb[0], args.tstep, args.trange, use_cache=False),
+        args.repeat)
+    return [result('run_nbody', n_objects, seconds,
+                   n_objects * abs(args.trange), 'particle-days/s',
+                   tstep=args.tstep, trange=args.trange)]
+
+
+def bench_save_output(n_objects, args, rng):
+    '''MB per second written by save_output, as text & binary.'''
+    states, jd_tdb = synthetic_states(n_objects, rng)
+    Sim = mpc_nbody.NbodySim()
+    Sim(vectors=states, tstart=jd_tdb[0], tstep=args.tstep,
+        trange=args.trange, use_cache=False)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        output_file = os.path.join(directory, 'simulation_states.dat')
+        for binary in (False, True):
+            seconds = best_time(lambda: Sim.save_output(output_file, binary),
+                                args.repeat)
+            results.append(result(
+                f"save_output[{'binary' if binary else 'text'}]", n_objects,
+                seconds, os.path.getsize(output_file) / 1e6, 'MB/s',
+                n_times=Sim.output_n_times))
+    return results
+
+
+BENCHMARKS = {'parse': bench_parse, 'transforms': bench_transforms,
+              'fix_input': bench_fix_input, 'run_nbody': bench_run_nbody,
+              'save_output': bench_save_output}
+
+
+# Running
+# -----------------------------------------------------------------------------
+
+def run_benchmarks(args):
+    '''All the requested benchmarks at all scales, as a JSON-able dict.'''
+    results = []
+    for name in args.benchmarks:
+        for n_objects in args.scales:
+            rng = np.random.default_rng(args.seed)
+            for entry in BENCHMARKS[name](n_objects, args, rng):
+                print(f"{entry['benchmark']:<28} {n_objects:>8} objects: "
+                      f"{entry['rate']:12.4g} {entry['unit']:}")
+                results.append(entry)
+    return {'version': BENCHMARK_VERSION,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'arguments': vars(args),
+            'results': results}
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--scales', type=int, nargs='+',
+                        default=DEFAULT_SCALES,
+                        help='numbers of objects to benchmark')
+    parser.add_argument('--benchmarks', nargs='+', default=list(BENCHMARKS),
+                        choices=list(BENCHMARKS),
+                        help='which benchmarks to run')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timed runs of each benchmark (best is kept)')
+    parser.add_argument('--max-loop', type=int, default=1000,
+                        help='at most this many files are parsed one by one')
+    parser.add_argument('--tstep', type=float, default=20.,
+                        help='integrator time step [days]')
+    parser.add_argument('--trange', type=float, default=60.,
+                        help='integration time range [days]')
+    parser.add_argument('--seed', type=int, default=2020,
+                        help='seed of the synthetic data')
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='JSON file to write the results to')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    results = run_benchmarks(args)
+    with open(args.output, 'w') as outfile:
+        json.dump(results, outfile, indent=1)
+    print(f'Results written to {args.output:}')
+
+
+if __name__ == '__main__':
+    main()
+
+
+# End
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+# mpc_nbody/mpc_nbody/cache.py
+
+'''
+----------------------------------------------------------------------------
+mpc_nbody's module for caching results in memory and on disk.
+
+This module provides functionalities to
+(a) make cache keys from file contents and other inputs (hashes)
+(b) keep numpy arrays in a size-capped on-disk cache, evicting the least
+    recently used entries, that several processes can share safely
+(c) keep numpy arrays in a size-capped in-memory cache, optionally backed
+    by such an on-disk cache
+
+On-disk caches are off unless a directory is given, either explicitly or
+with the MPC_NBODY_CACHE_DIR environment variable (see default_cache).
+----------------------------------------------------------------------------
+'''
+
+# Import third-party packages
+# -----------------------------------------------------------------------------
+import os
+import hashlib
+import zipfile
+from collections import OrderedDict
+import tempfile
+import numpy as np
+try:
+    import fcntl
+except ImportError:  # Not on Windows; writes are still atomic there
+    fcntl = None
+
+# Import neighbouring packages
+# -----------------------------------------------------------------------------
+
+# Default for caching stuff using lru_cache
+# -----------------------------------------------------------------------------
+
+# Constants and stuff
+# -----------------------------------------------------------------------------
+CACHE_DIR_VARIABLE = 'MPC_NBODY_CACHE_DIR'
+CACHE_SUFFIX = '.npz'
+LOCK_FILE = '.lock'
+SIZE_FILE = '.size'  # Running total of the entries' sizes [bytes]
+EVICT_TO = 0.9  # Eviction frees space down to this fraction of max_bytes
+DEFAULT_MAX_BYTES = 2 ** 30
+DEFAULT_MEMORY_BYTES = 2 ** 28
+
+
+# Data classes/methods
+# -----------------------------------------------------------------------------
+
+class DiskCache():
+    '''
+    Size-capped on-disk cache of dictionaries of numpy arrays.
+
+    Each entry is one .npz file named after its key. Entries are written to
+    a temporary file and renamed into place, so readers never see partial
+    entries. Reading an entry touches its modification time. The total size
+    of the entries is kept in a small index file, so a write does not have
+    to look at the other entries; only when the total goes over max_bytes
+    are the least recently used entries deleted, down to EVICT_TO of it.
+    The index is only changed under an exclusive lock (flock) on a lock
+    file, so several processes can share one cache directory.
+    Entries that cannot be read (e.g. truncated) are deleted.
+
+    Inputs:
+    -------
+    cache_dir : string, directory of the cache (created if needed).
+    max_bytes : integer, size cap of all entries together [bytes].
+
+    The counters hits, misses, writes and evictions show how well it works.
+    '''
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.reset_counters()
+
+    def get(self, key):
+        '''The dictionary of arrays stored under key, or None.'''
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+            os.utime(path)
+        except FileNotFoundError:  # Missing, or evicted meanwhile
+            self.misses += 1
+            return None
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+            self._discard(path)  # Truncated or corrupt
+            self.misses += 1
+            return None
+        self.hits += 1
+        return arrays
+
+    def put(self, key, arrays):
+        '''Store a dictionary of arrays under key, then enforce the cap.'''
+        handle, tmp_path = tempfile.mkstemp(dir=self.cache_dir,
+                                            suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as outfile:
+                np.savez(outfile, **arrays)
+            size = os.path.getsize(tmp_path)
+            path = self._path(key)
+            with self._lock():
+                total = self._read_total() + size - _size(path)
+                os.replace(tmp_path, path)
+                if total > self.max_bytes:
+                    total = self._evict()
+                self._write_total(total)
+        except BaseException:
+            _remove(tmp_path)
+            raise
+        self.writes += 1
+
+    def clear(self):
+        '''Delete all the entries (counters are kept).'''
+        with self._lock():
+            for entry in self._entries():
+                _remove(entry.path)
+            self._write_total(0)
+
+    def reset_counters(self):
+        '''Set all the counters back to zero.'''
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+    @property
+    def stats(self):
+        '''Dictionary of the counters and current size of the cache.'''
+        entries = self._entries()
+        return {'hits': self.hits, 'misses': self.misses,
+                'writes': self.writes, 'evictions': self.evictions,
+                'entries': len(entries),
+                'bytes': sum(entry.stat().st_size for entry in entries),
+                'max_bytes': self.max_bytes}
+
+    def _evict(self):
+        '''
+        Delete the least recently used entries until the total is at most
+        EVICT_TO of the cap, and return the new total. Call under the lock.
+        '''
+        entries = []
+        for entry in self._entries():
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= EVICT_TO * self.max_bytes:
+                break
+            _remove(path)
+            total -= size
+            self.evictions += 1
+        return total
+
+    def _discard(self, path):
+        '''Delete one entry and take it off the total.'''
+        with self._lock():
+            size = _size(path)
+            _remove(path)
+            self._write_total(self._read_total() - size)
+
+    def _read_total(self):
+        '''The total size of the entries. Call under the lock.'''
+        try:
+            with open(os.path.join(self.cache_dir, SIZE_FILE)) as infile:
+                return max(int(infile.read()), 0)
+        except (OSError, ValueError):  # No index yet: add it up once
+            return sum(_size(entry.path) for entry in self._entries())
+
+    def _write_total(self, total):
+        '''Record the total size of the entries. Call under the lock.'''
+        with open(os.path.join(self.cache_dir, SIZE_FILE), 'w') as outfile:
+            outfile.write(str(total))
+
+    def _entries(self):
+        return [entry for entry in os.scandir(self.cache_dir)
+                if entry.name.endswith(CACHE_SUFFIX)]
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + CACHE_SUFFIX)
+
+    def _lock(self):
+        return _FileLock(os.path.join(self.cache_dir, LOCK_FILE))
+
+
+class ResultCache():
+    '''
+    Size-capped in-memory cache of dictionaries of numpy arrays, evicting
+    the least recently used entries, optionally backed by a DiskCache.
+
+    Cached arrays are shared by everyone who gets them, so they are made
+    read-only.
+
+    Inputs:
+    -------
+    max_bytes : integer, size cap of the arrays kept in memory [bytes].
+    disk : DiskCache, or the name of a default_cache (looked up on first
+           use, so only used if MPC_NBODY_CACHE_DIR is set), or None.
+
+    The counters hits (in memory), disk_hits, misses, writes and evictions
+    (from memory) show how well it works.
+    '''
+
+    def __init__(self, max_bytes=DEFAULT_MEMORY_BYTES, disk=None):
+        self.max_bytes = max_bytes
+        self._disk = disk
+        self._cache = OrderedDict()
+        self._bytes = 0
+        self.reset_counters()
+
+    @property
+    def disk(self):
+        if isinstance(self._disk, str):
+            self._disk = default_cache(self._disk)
+        return self._disk
+
+    def get(self, key):
+        '''The dictionary of (read-only) arrays stored under key, or None.'''
+        arrays = self._cache.get(key)
+        if arrays is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return arrays
+        arrays = None if self.disk is None else self.disk.get(key)
+        if arrays is None:
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        return self._store(key, arrays)
+
+    def put(self, key, arrays):
+        '''
+        Store a dictionary of arrays under key (and on disk). Copies of the
+        arrays are stored, and made read-only, so that the caller's arrays
+        stay writable; the stored copies are returned.
+        '''
+        self.writes += 1
+        if self.disk is not None:
+            self.disk.put(key, arrays)
+        return self._store(key, {name: np.array(array, copy=True)
+                                 for name, array in arrays.items()})
+
+    def clear(self):
+        '''Empty the in-memory cache (counters and disk are kept).'''
+        self._cache.clear()
+        self._bytes = 0
+
+    def reset_counters(self):
+        '''Set all the counters back to zero.'''
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+    @property
+    def stats(self):
+        '''Dictionary of the counters and current size of the cache.'''
+        return {'hits': self.hits, 'disk_hits': self.disk_hits,
+                'misses': self.misses, 'writes': self.writes,
+                'evictions': self.evictions, 'entries': len(self._cache),
+                'bytes': self._bytes, 'max_bytes': self.max_bytes}
+
+    def _store(self, key, arrays):
+        arrays = {name: np.asarray(array) for name, array in arrays.items()}
+        for array in arrays.values():
+            array.flags.writeable = False
+        if key in self._cache:
+            self._bytes -= _nbytes(self._cache.pop(key))
+        self._cache[key] = arrays
+        self._bytes += _nbytes(arrays)
+        while (self._bytes > self.max_bytes) & (len(self._cache) > 1):
+            self._bytes -= _nbytes(self._cache.popitem(last=False)[1])
+            self.evictions += 1
+        if self._bytes > self.max_bytes:  # Too big to keep at all
+            self.clear()
+            self.evictions += 1
+        return arrays
+
+
+class _FileLock():
+    '''Exclusive flock on a file, as a context manager.'''
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self._file = open(self.path, 'a')
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+
+# Functions
+# -----------------------------------------------------------------------------
+
+def default_cache(name, max_bytes=DEFAULT_MAX_BYTES):
+    '''
+    The DiskCache in the subdirectory name of $MPC_NBODY_CACHE_DIR, or None
+    if that environment variable is not set (caching off).
+    '''
+    cache_dir = os.environ.get(CACHE_DIR_VARIABLE)
+    if not cache_dir:
+        return None
+    return DiskCache(os.path.join(cache_dir, name), max_bytes)
+
+
+def make_key(*parts):
+    '''
+    Hash of any number of strings, bytes, numbers and numpy arrays (their
+    exact bytes, dtype & shape), as a hexadecimal string.
+    '''
+    digest = hashlib.blake2b(digest_size=20)
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        elif not isinstance(part, bytes):
+            part = np.ascontiguousarray(part)
+            digest.update(f'{part.dtype.str}{part.shape}'.encode())
+            part = part.tobytes()
+        digest.update(len(part).to_bytes(8, 'little'))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def file_digest(filename, chunk_size=2 ** 20):
+    '''Hash of the contents of a file, as a hexadecimal string.'''
+    digest = hashlib.blake2b(digest_size=20)
+    with open(filename, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _nbytes(arrays):
+    return sum(array.nbytes for array in arrays.values())
+
+
+def _size(path):
+    '''Size of a file [bytes], 0 if it does not exist.'''
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _remove(path):
+    '''Remove a file that another process may have removed already.'''
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# End
@@ -0,0 +1,508 @@
+# -*- coding: utf-8 -*-
+# mpc_nbody/mpc_nbody/conversions.py
+
+'''
+----------------------------------------------------------------------------
+mpc_nbody's module for converting between orbital element sets.
+
+This module provides functionalities to
+(a) solve Kepler's equation for many elliptic, parabolic & hyperbolic
+    orbits at once
+(b) convert between cartesian state vectors, Keplerian elements
+    (a, e, i, node, argument of perihelion, mean anomaly) and cometary
+    elements (q, e, i, node, argument of perihelion, time of perihelion)
+(c) give the analytic Jacobians of those conversions, so that covariance
+    matrices can be converted in the same pass (propagate_covariance)
+
+All functions work on (..., 6) arrays (one row per orbit), in au, days and
+radians, so whole catalogues are converted without Python loops.
+Keplerian elements do not exist for parabolic orbits (a is infinite); use
+cometary elements for those. Hyperbolic orbits have a < 0.
+----------------------------------------------------------------------------
+'''
+
+# Import third-party packages
+# -----------------------------------------------------------------------------
+import numpy as np
+
+# Import neighbouring packages
+# -----------------------------------------------------------------------------
+
+# Default for caching stuff using lru_cache
+# -----------------------------------------------------------------------------
+
+# Constants and stuff
+# -----------------------------------------------------------------------------
+GM_SUN = 0.01720209895 ** 2  # Gaussian gravitational constant^2, au^3/day^2
+KEPLER_TOLERANCE = 1e-15  # relative
+KEPLER_MAX_ITERATIONS = 50
+PARABOLIC_TOLERANCE = 1e-12  # |e - 1| below which an orbit is a parabola
+SMALL_ANGLE = 1e-12  # Below this, e (or sin i) is treated as exactly 0
+
+
+# Functions
+# -----------------------------------------------------------------------------
+
+def solve_kepler(mean_anomaly, eccentricity):
+    '''
+    Solve Kepler's equation for many orbits at once.
+
+    Elliptic orbits (e < 1) give the eccentric anomaly E, with
+    M = E - e sin(E) (M first reduced to [-pi, pi)).
+    Hyperbolic orbits (e > 1) give the hyperbolic anomaly H, with
+    M = e sinh(H) - H.
+    Parabolic orbits (|e - 1| < PARABOLIC_TOLERANCE) give D = tan(nu / 2),
+    with Barker's equation M = D + D^3 / 3, solved in closed form.
+
+    Newton's method is started from an upper bound of the root, where the
+    equations are convex, so it converges monotonically for all e, also
+    close to e = 1 (where the equations are rearranged to avoid
+    cancellation).
+
+    Inputs:
+    -------
+    mean_anomaly : float or array, mean anomaly M [radians].
+    eccentricity : float or array, broadcast against mean_anomaly.
+
+    Returns:
+    --------
+    numpy array, E, H or D (see above) for each orbit.
+    '''
+    mean_anomaly, e = np.broadcast_arrays(
+        np.asarray(mean_anomaly, dtype=float),
+        np.asarray(eccentricity, dtype=float))
+    if np.any(e < 0):
+        raise ValueError("solve_kepler needs eccentricity >= 0.")
+    elliptic, parabolic, hyperbolic = _conic_masks(e)
+    M = np.where(elliptic, _wrap_angle(mean_anomaly), mean_anomaly)
+    # Solve for |M| and restore the sign: the equations are odd in M.
+    sign, M = np.where(M < 0, -1., 1.), np.abs(M)
+    one_minus_e = np.abs(1 - e)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        anomaly = np.where(
+            elliptic,
+            np.minimum.reduce([np.full(M.shape, np.pi), M / one_minus_e,
+                               1.3 * np.cbrt(6 * M)]),
+            np.minimum(np.cbrt(6 * M), np.arcsinh(M / one_minus_e)))
+    for is_hyperbolic, rows in ((False, elliptic), (True, hyperbolic)):
+        rows = np.flatnonzero(rows)
+        x, m, k = anomaly.flat[rows], M.flat[rows], one_minus_e.flat[rows]
+        for _ in range(KEPLER_MAX_ITERATIONS):
+            step = _kepler_newton_step(x, m, k, is_hyperbolic)
+            x = x - step
+            # Newton decreases x monotonically to the root: a step that
+            # is not positive is rounding noise, and that orbit is done.
+            done = step <= KEPLER_TOLERANCE * x
+            if np.any(done):
+                anomaly.flat[rows[done]] = x[done]
+                rows, x, m, k = rows[~done], x[~done], m[~done], k[~done]
+            if not len(rows):
+                break
+        anomaly.flat[rows] = x
+    # Barker's equation: D = Y - 1 / Y with Y = cbrt(W + sqrt(W^2 + 1))
+    W = 1.5 * M[parabolic]
+    Y = np.cbrt(W + np.sqrt(W ** 2 + 1))
+    anomaly[parabolic] = Y - 1 / Y
+    return sign * anomaly
+
+
+def mean_to_true_anomaly(mean_anomaly, eccentricity):
+    '''
+    True anomaly nu [radians] from the mean anomaly (as defined for each
+    type of orbit in solve_kepler) and the eccentricity.
+    '''
+    e = np.asarray(eccentricity, dtype=float)
+    anomaly = solve_kepler(mean_anomaly, e)
+    e = np.broadcast_to(e, anomaly.shape)
+    elliptic, parabolic, hyperbolic = _conic_masks(e)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        nu = np.where(
+            elliptic,
+            2 * np.arctan2(np.sqrt(1 + e) * np.sin(anomaly / 2),
+                           np.sqrt(np.abs(1 - e)) * np.cos(anomaly / 2)),
+            2 * np.arctan(np.sqrt((e + 1) / np.abs(e - 1)) *
+                          np.tanh(anomaly / 2)))
+    return np.where(parabolic, 2 * np.arctan(anomaly), nu)
+
+
+def true_to_mean_anomaly(true_anomaly, eccentricity):
+    '''
+    Mean anomaly (as defined for each type of orbit in solve_kepler) from
+    the true anomaly [radians] and the eccentricity. Elliptic mean
+    anomalies are in [-pi, pi).
+    '''
+    nu, e = np.broadcast_arrays(np.asarray(true_anomaly, dtype=float),
+                                np.asarray(eccentricity, dtype=float))
+    elliptic, parabolic, hyperbolic = _conic_masks(e)
+    half_nu = _wrap_angle(nu) / 2
+    one_minus_e = np.abs(1 - e)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        E = 2 * np.arctan2(np.sqrt(one_minus_e) * np.sin(half_nu),
+                           np.sqrt(1 + e) * np.cos(half_nu))
+        H = 2 * np.arctanh(np.sqrt(one_minus_e / (e + 1)) *
+                           np.tan(half_nu))
+    D = np.tan(half_nu)
+    return np.where(elliptic, one_minus_e * np.sin(E) + _x_minus_sin(E),
+                    np.where(hyperbolic,
+                             one_minus_e * np.sinh(H) + _sinh_minus_x(H),
+                             D + D ** 3 / 3))
+
+
+def keplerian_to_cartesian(elements, mu=GM_SUN, jacobian=False):
+    '''
+    Convert Keplerian elements to cartesian state vectors, in the
+    reference frame of the elements (e.g. heliocentric ecliptic J2000).
+
+    Inputs:
+    -------
+    elements : array (..., 6), a [au] (negative if hyperbolic), e, i,
+               longitude of ascending node, argument of perihelion,
+               mean anomaly [radians].
+    mu : float, gravitational parameter [au^3/day^2].
+    jacobian : boolean, also return d(cartesian)/d(elements).
+
+    Returns:
+    --------
+    xyzv : numpy array (..., 6), x, y, z [au], dx, dy, dz [au/day].
+    jacobian : numpy array (..., 6, 6), only if jacobian=True.
+    '''
+    a, e, incl, node, peri, M = np.moveaxis(
+        np.asarray(elements, dtype=float), -1, 0)
+    if np.any(_conic_masks(e)[1]):
+        raise ValueError("Parabolic orbits have no Keplerian elements, "
+                         "use cometary_to_cartesian.")
+    nu = mean_to_true_anomaly(M, e)
+    p = a * (1 - e ** 2)
+    xyzv, d_state = _conic_state(p, e, nu, incl, node, peri, mu, jacobian)
+    if not jacobian:
+        return xyzv
+    # d(p, e, nu, i, node, peri) / d(a, e, i, node, peri, M)
+    chain = _identity_like(a)
+    chain[..., 0, 0], chain[..., 0, 1] = 1 - e ** 2, -2 * a * e
+    chain[..., 2, 1], chain[..., 2, 5] = _dnu_de(nu, e), _dnu_dmean(nu, e)
+    chain[..., 2, 2] = 0.
+    chain[..., 3:, 2:5] = np.eye(3)
+    chain[..., 5, 5] = 0.
+    return xyzv, d_state @ chain
+
+
+def cartesian_to_keplerian(xyzv, mu=GM_SUN, jacobian=False):
+    '''
+    Convert cartesian state vectors to Keplerian elements, the inverse of
+    keplerian_to_cartesian (elliptic mean anomalies are in [0, 2 pi)).
+    For (near-)parabolic orbits a is +-inf; use cartesian_to_cometary.
+
+    Returns:
+    --------
+    elements : numpy array (..., 6), a, e, i, node, argument of perihelion,
+               mean anomaly.
+    jacobian : numpy array (..., 6, 6) d(elements)/d(cartesian), only if
+               jacobian=True.
+    '''
+    p, e, incl, node, peri, nu = _plane_elements(xyzv, mu)
+    elliptic = _conic_masks(e)[0]
+    with np.errstate(divide='ignore'):
+        a = p / (1 - e ** 2)
+    M = true_to_mean_anomaly(nu, e)
+    M = np.where(elliptic, np.mod(M, 2 * np.pi), M)
+    elements = np.stack([a, e, incl, node, peri, M], axis=-1)
+    if not jacobian:
+        return elements
+    _, forward = keplerian_to_cartesian(elements, mu, jacobian=True)
+    return elements, np.linalg.inv(forward)
+
+
+def cometary_to_cartesian(elements, epoch, mu=GM_SUN, jacobian=False):
+    '''
+    Convert cometary elements to cartesian state vectors at epoch, for
+    elliptic, parabolic & hyperbolic orbits.
+
+    Inputs:
+    -------
+    elements : array (..., 6), q [au], e, i, longitude of ascending node,
+               argument of perihelion [radians], time of perihelion [days].
+    epoch : float or array (...), time [days, same scale as tp] at which
+            the state vectors are wanted.
+    mu : float, gravitational parameter [au^3/day^2].
+    jacobian : boolean, also return d(cartesian)/d(elements). For exactly
+               parabolic orbits the e column is a numerical derivative.
+
+    Returns:
+    --------
+    xyzv : numpy array (..., 6), x, y, z [au], dx, dy, dz [au/day].
+    jacobian : numpy array (..., 6, 6), only if jacobian=True.
+    '''
+    elements = np.asarray(elements, dtype=float)
+    q, e, incl, node, peri, tp = np.moveaxis(elements, -1, 0)
+    n = _mean_motion(q, e, mu)
+    M = n * (epoch - tp)
+    nu = mean_to_true_anomaly(M, e)
+    p = q * (1 + e)
+    xyzv, d_state = _conic_state(p, e, nu, incl, node, peri, mu, jacobian)
+    if not jacobian:
+        return xyzv
+    # d(p, e, nu, i, node, peri) / d(q, e, i, node, peri, tp)
+    parabolic = _conic_masks(e)[1]
+    dnu_dM = np.where(parabolic, 2 * np.cos(nu / 2) ** 4, _dnu_dmean(nu, e))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dnu_de = _dnu_de(nu, e) - dnu_dM * 1.5 * M / (1 - e)
+    chain = _identity_like(q)
+    chain[..., 0, 0], chain[..., 0, 1] = 1 + e, q
+    chain[..., 2, 0] = -dnu_dM * 1.5 * M / q
+    chain[..., 2, 1], chain[..., 2, 5] = dnu_de, -dnu_dM * n
+    chain[..., 2, 2] = 0.
+    chain[..., 3:, 2:5] = np.eye(3)
+    chain[..., 5, 5] = 0.
+    full = d_state @ chain
+    if np.any(parabolic):  # d/de has a removable singularity at e = 1
+        step = 1e-7
+        plus, minus = elements[parabolic].copy(), elements[parabolic].copy()
+        plus[:, 1] += step
+        minus[:, 1] -= step
+        epochs = np.broadcast_to(epoch, e.shape)[parabolic]
+        full[parabolic, :, 1] = (
+            cometary_to_cartesian(plus, epochs, mu) -
+            cometary_to_cartesian(minus, epochs, mu)) / (2 * step)
+    return xyzv, full
+
+
+def cartesian_to_cometary(xyzv, epoch, mu=GM_SUN, jacobian=False):
+    '''
+    Convert cartesian state vectors at epoch to cometary elements, the
+    inverse of cometary_to_cartesian. For elliptic orbits tp is the
+    perihelion closest to epoch.
+
+    Returns:
+    --------
+    elements : numpy array (..., 6), q, e, i, node, argument of perihelion,
+               time of perihelion.
+    jacobian : numpy array (..., 6, 6) d(elements)/d(cartesian), only if
+               jacobian=True.
+    '''
+    p, e, incl, node, peri, nu = _plane_elements(xyzv, mu)
+    q = p / (1 + e)
+    tp = epoch - true_to_mean_anomaly(nu, e) / _mean_motion(q, e, mu)
+    elements = np.stack([q, e, incl, node, peri, tp], axis=-1)
+    if not jacobian:
+        return elements
+    _, forward = cometary_to_cartesian(elements, epoch, mu, jacobian=True)
+    return elements, np.linalg.inv(forward)
+
+
+def keplerian_to_cometary(elements, epoch, mu=GM_SUN, jacobian=False):
+    '''
+    Convert Keplerian elements at epoch to cometary elements (tp is the
+    perihelion closest to epoch for elliptic orbits), optionally with the
+    Jacobian d(cometary)/d(Keplerian).
+    '''
+    a, e, incl, node, peri, M = np.moveaxis(
+        np.asarray(elements, dtype=float), -1, 0)
+    M = np.where(e < 1, _wrap_angle(M), M)
+    n = np.sqrt(mu / np.abs(a) ** 3)
+    q, tp = a * (1 - e), epoch - M / n
+    cometary = np.stack([q, e, incl, node, peri, tp], axis=-1)
+    if not jacobian:
+        return cometary
+    chain = _identity_like(a)
+    chain[..., 0, 0], chain[..., 0, 1] = 1 - e, -a
+    chain[..., 5, 0], chain[..., 5, 5] = -1.5 * M / (n * a), -1 / n
+    return cometary, chain
+
+
+def cometary_to_keplerian(elements, epoch, mu=GM_SUN, jacobian=False):
+    '''
+    Convert cometary elements to Keplerian elements at epoch (elliptic
+    mean anomalies in [0, 2 pi)), optionally with the Jacobian
+    d(Keplerian)/d(cometary). Not possible for parabolic orbits.
+    '''
+    q, e, incl, node, peri, tp = np.moveaxis(
+        np.asarray(elements, dtype=float), -1, 0)
+    if np.any(_conic_masks(e)[1]):
+        raise ValueError("Parabolic orbits have no Keplerian elements.")
+    a = q / (1 - e)
+    n = np.sqrt(mu / np.abs(a) ** 3)
+    M = n * (epoch - tp)
+    keplerian = np.stack([a, e, incl, node, peri,
+                          np.where(e < 1, np.mod(M, 2 * np.pi), M)], axis=-1)
+    if not jacobian:
+        return keplerian
+    chain = _identity_like(q)
+    chain[..., 0, 0], chain[..., 0, 1] = 1 / (1 - e), q / (1 - e) ** 2
+    chain[..., 5, 0], chain[..., 5, 1] = -1.5 * M / q, -1.5 * M / (1 - e)
+    chain[..., 5, 5] = -n
+    return keplerian, chain
+
+
+def propagate_covariance(covariance, jacobian):
+    '''
+    Convert (..., 6, 6) covariance matrices with the (..., 6, 6) Jacobians
+    of a conversion: J C J^T.
+    '''
+    return np.einsum('...ij,...jk,...lk->...il', jacobian, covariance,
+                     jacobian)
+
+
+def _conic_state(p, e, nu, incl, node, peri, mu, jacobian=False):
+    '''
+    Cartesian state from the semi-latus rectum p, eccentricity, true
+    anomaly and orientation angles, valid for all conics. If jacobian,
+    also d(state)/d(p, e, nu, i, node, peri) as (..., 6, 6), else None.
+    Not intended for user usage.
+    '''
+    P, Q = _perifocal_axes(incl, node, peri)
+    cos_nu, sin_nu = np.cos(nu)[..., None], np.sin(nu)[..., None]
+    e_, p_ = e[..., None], p[..., None]
+    r = p_ / (1 + e_ * cos_nu)
+    v_scale = np.sqrt(mu / p_)
+    radial = cos_nu * P + sin_nu * Q
+    along = -sin_nu * P + cos_nu * Q
+    position = r * radial
+    velocity = v_scale * (along + e_ * Q)
+    xyzv = np.concatenate([position, velocity], axis=-1)
+    if not jacobian:
+        return xyzv, None
+    node_axis = np.stack([np.cos(node), np.sin(node), np.zeros(np.shape(node))],
+                         axis=-1)
+    z_axis = np.broadcast_to([0., 0., 1.], P.shape)
+    normal = np.cross(P, Q)
+    columns = [
+        (position / p_, -velocity / (2 * p_)),
+        (-r ** 2 * cos_nu / p_ * radial, v_scale * Q),
+        (r ** 2 * e_ * sin_nu / p_ * radial + r * along, -v_scale * radial),
+        ]
+    columns += [(np.cross(axis, position), np.cross(axis, velocity))
+                for axis in (node_axis, z_axis, normal)]
+    d_state = np.stack([np.concatenate(column, axis=-1)
+                        for column in columns], axis=-1)
+    return xyzv, d_state
+
+
+def _plane_elements(xyzv, mu):
+    '''
+    Semi-latus rectum, eccentricity, inclination, node, argument of
+    perihelion & true anomaly (in [-pi, pi]) from cartesian states (..., 6).
+    The node is 0 for orbits in the reference plane, the argument of
+    perihelion is 0 for circular orbits.
+    Not intended for user usage.
+    '''
+    xyzv = np.asarray(xyzv, dtype=float)
+    position, velocity = xyzv[..., :3], xyzv[..., 3:]
+    r = np.linalg.norm(position, axis=-1)
+    h_vec = np.cross(position, velocity)
+    h = np.linalg.norm(h_vec, axis=-1)
+    p = h ** 2 / mu
+    e_vec = ((np.sum(velocity ** 2, axis=-1) - mu / r)[..., None] * position
+             - np.sum(position * velocity, axis=-1)[..., None] * velocity
+             ) / mu
+    e = np.linalg.norm(e_vec, axis=-1)
+    normal = h_vec / h[..., None]
+    incl = np.arccos(np.clip(normal[..., 2], -1., 1.))
+    node = np.where(np.hypot(normal[..., 0], normal[..., 1]) < SMALL_ANGLE,
+                    0., np.arctan2(normal[..., 0], -normal[..., 1]))
+    node_axis = np.stack([np.cos(node), np.sin(node), np.zeros(node.shape)],
+                         axis=-1)
+    ahead = np.cross(normal, node_axis)
+    latitude = np.arctan2(np.sum(position * ahead, axis=-1),
+                          np.sum(position * node_axis, axis=-1))
+    peri = np.where(e < SMALL_ANGLE, 0.,
+                    np.arctan2(np.sum(e_vec * ahead, axis=-1),
+                               np.sum(e_vec * node_axis, axis=-1)))
+    return (p, e, incl, np.mod(node, 2 * np.pi), np.mod(peri, 2 * np.pi),
+            _wrap_angle(latitude - peri))
+
+
+def _perifocal_axes(incl, node, peri):
+    '''
+    Unit vectors (..., 3) towards perihelion (P) and 90 degrees ahead of it
+    in the orbital plane (Q), in the reference frame.
+    Not intended for user usage.
+    '''
+    cos_i, sin_i = np.cos(incl), np.sin(incl)
+    cos_O, sin_O = np.cos(node), np.sin(node)
+    cos_w, sin_w = np.cos(peri), np.sin(peri)
+    P = np.stack([cos_w * cos_O - sin_w * sin_O * cos_i,
+                  cos_w * sin_O + sin_w * cos_O * cos_i,
+                  sin_w * sin_i], axis=-1)
+    Q = np.stack([-sin_w * cos_O - cos_w * sin_O * cos_i,
+                  -sin_w * sin_O + cos_w * cos_O * cos_i,
+                  cos_w * sin_i], axis=-1)
+    return P, Q
+
+
+def _conic_masks(e):
+    '''Boolean masks of elliptic, parabolic & hyperbolic eccentricities.'''
+    parabolic = np.abs(e - 1) < PARABOLIC_TOLERANCE
+    return (e < 1) & ~parabolic, parabolic, (e > 1) & ~parabolic
+
+
+def _mean_motion(q, e, mu):
+    '''
+    Mean motion [radians/day] for perihelion distance q and eccentricity e,
+    with the parabolic definition sqrt(mu / (2 q^3)) of Barker's equation.
+    Not intended for user usage.
+    '''
+    return np.where(_conic_masks(e)[1], np.sqrt(mu / (2 * q ** 3)),
+                    np.sqrt(mu * (np.abs(1 - e) / q) ** 3))
+
+
+def _dnu_dmean(nu, e):
+    '''d(true anomaly)/d(mean anomaly) for elliptic & hyperbolic orbits.'''
+    with np.errstate(divide='ignore'):
+        return (1 + e * np.cos(nu)) ** 2 / np.abs(1 - e ** 2) ** 1.5
+
+
+def _dnu_de(nu, e):
+    '''
+    d(true anomaly)/d(eccentricity) at fixed mean anomaly, for elliptic &
+    hyperbolic orbits.
+    '''
+    with np.errstate(divide='ignore'):
+        return np.sin(nu) * (2 + e * np.cos(nu)) / (1 - e ** 2)
+
+
+def _identity_like(x):
+    '''(..., 6, 6) identity matrices for an array x of shape (...).'''
+    return np.broadcast_to(np.eye(6), np.shape(x) + (6, 6)).copy()
+
+
+def _kepler_newton_step(x, M, one_minus_e, hyperbolic):
+    '''
+    Newton step for e sin(E) - E = M (or e sinh(H) - H = M), rearranged as
+    |1 - e| sin(E) + (E - sin(E)) = M (or |1 - e| sinh(H) + (sinh(H) - H)
+    = M) to avoid cancellation close to e = 1.
+    Not intended for user usage.
+    '''
+    if hyperbolic:
+        f = one_minus_e * np.sinh(x) + _sinh_minus_x(x) - M
+        df = one_minus_e * np.cosh(x) + 2 * np.sinh(x / 2) ** 2
+    else:
+        f = one_minus_e * np.sin(x) + _x_minus_sin(x) - M
+        df = one_minus_e * np.cos(x) + 2 * np.sin(x / 2) ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(df > 0, f / df, 0.)
+
+
+def _wrap_angle(x):
+    '''
+    Angles reduced to [-pi, pi], leaving small angles exact (unlike
+    np.mod(x + pi, 2 pi) - pi, which matters close to e = 1).
+    '''
+    return x - 2 * np.pi * np.round(x / (2 * np.pi))
+
+
+def _x_minus_sin(x):
+    '''x - sin(x), without cancellation for small x.'''
+    series = x ** 3 / 6 * (1 - x ** 2 / 20 * (1 - x ** 2 / 42 *
+                                              (1 - x ** 2 / 72)))
+    return np.where(np.abs(x) < 0.1, series, x - np.sin(x))
+
+
+def _sinh_minus_x(x):
+    '''sinh(x) - x, without cancellation for small x.'''
+    series = x ** 3 / 6 * (1 + x ** 2 / 20 * (1 + x ** 2 / 42 *
+                                              (1 + x ** 2 / 72)))
+    with np.errstate(over='ignore'):
+        return np.where(np.abs(x) < 0.1, series, np.sinh(x) - x)
+
+
+# End
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# mpc_nbody/mpc_nbody/metrics.py
+
+'''
+----------------------------------------------------------------------------
+mpc_nbody's module for timing the stages of a run and counting its work.
+
+This module provides functionalities to
+(a) collect the wall-clock time spent in each stage (parse, time
+    conversion, kernel lookup, input reshaping, integration, output write)
+    and counters (particles, substeps, bytes written) in a Metrics object
+(b) pass every measurement on to a user hook, e.g. to feed a monitoring
+    system
+(c) instrument code with stage() & count(), which report to the Metrics
+    object that is active (see activated), and cost next to nothing when
+    none is
+
+NbodySim(metrics=Metrics()) activates its Metrics around all of its work.
+Stage timings are inclusive: 'parse' includes the 'time_conversion' and
+'kernel_lookup' it causes. Work done in worker processes (the parallel
+runners) is not seen.
+----------------------------------------------------------------------------
+'''
+
+# Import third-party packages
+# -----------------------------------------------------------------------------
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Import neighbouring packages
+# -----------------------------------------------------------------------------
+
+# Default for caching stuff using lru_cache
+# -----------------------------------------------------------------------------
+
+# Constants and stuff
+# -----------------------------------------------------------------------------
+STAGES = ('parse', 'time_conversion', 'kernel_lookup', 'input_reshaping',
+          'integration', 'output_write')
+COUNTERS = ('particles', 'substeps', 'bytes_written')
+
+
+# Data classes/methods
+# -----------------------------------------------------------------------------
+
+class Metrics():
+    '''
+    Wall-clock time & number of calls per stage, and counters.
+
+    Inputs:
+    -------
+    hook : None, or a callable hook(kind, name, value), called with
+           ('stage', stage name, seconds) after every timed stage and with
+           ('count', counter name, amount) for every count.
+
+    timings, calls and counters are dictionaries (zero when missing); see
+    summary for all of them at once.
+    '''
+
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.reset()
+
+    def stage(self, name):
+        '''Context manager timing one pass through stage name.'''
+        return _Timer(self, name)
+
+    def count(self, name, amount=1):
+        '''Add amount to counter name.'''
+        self.counters[name] += amount
+        if self.hook is not None:
+            self.hook('count', name, amount)
+
+    def add_time(self, name, seconds):
+        '''Add one pass of seconds through stage name.'''
+        self.timings[name] += seconds
+        self.calls[name] += 1
+        if self.hook is not None:
+            self.hook('stage', name, seconds)
+
+    def reset(self):
+        '''Set all the timings & counters back to zero.'''
+        self.timings = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+
+    def summary(self):
+        '''Dictionary of the timings [s], calls & counters.'''
+        return {'timings': dict(self.timings), 'calls': dict(self.calls),
+                'counters': dict(self.counters)}
+
+    def __repr__(self):
+        return f'Metrics({self.summary()!r})'
+
+
+class NullMetrics():
+    '''Metrics that are switched off: everything is a no-op.'''
+    hook = None
+
+    def stage(self, name):
+        return _NULL_TIMER
+
+    def count(self, name, amount=1):
+        pass
+
+    def add_time(self, name, seconds):
+        pass
+
+    def reset(self):
+        pass
+
+    def summary(self):
+        return {'timings': {}, 'calls': {}, 'counters': {}}
+
+
+class _Timer():
+    '''Times the with block and adds it to a stage. Not for user usage.'''
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.add_time(self.name, time.perf_counter() - self.start)
+
+
+class _NullTimer():
+    '''A with block that does nothing. Not for user usage.'''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+_NULL_TIMER = _NullTimer()
+_active = NULL_METRICS
+
+
+# Functions
+# -----------------------------------------------------------------------------
+
+@contextmanager
+def activated(metrics):
+    '''
+    Make metrics (a Metrics, or None for none) the ones that stage() &
+    count() report to within the with block.
+    '''
+    global _active
+    previous, _active = _active, NULL_METRICS if metrics is None else metrics
+    try:
+        yield _active
+    finally:
+        _active = previous
+
+
+def active():
+    '''The Metrics that stage() & count() currently report to.'''
+    return _active
+
+
+def stage(name):
+    '''Context manager timing stage name in the active Metrics.'''
+    return _active.stage(name)
+
+
+def count(name, amount=1):
+    '''Add amount to counter name of the active Metrics.'''
+    _active.count(name, amount)
+
+
+# End
@@ -23,48 +23,129 @@ The output is then either saved to a file or passed to the orbit_cheby routine.
 # -----------------------------------------------------------------------------
 import sys
 import os
+import glob
+import json
+from functools import lru_cache, wraps
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
+from numpy.lib.recfunctions import structured_to_unstructured
 
 
 # Import neighbouring packages
 # -----------------------------------------------------------------------------
-sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
-try:  # Import ephem_forces from whereever REBX_DIR is set to live
-    sys.path.append(os.environ['REBX_DIR'])
-    from examples.ephem_forces.ephem_forces import integration_function
-except (KeyError, ModuleNotFoundError):
-    from reboundx.examples.ephem_forces.ephem_forces import integration_function
+# The reboundx ephem_forces integrator (and the ephemeris it loads) is only
+# imported when first needed, see _load_integration_function.
 from mpc_nbody import parse_input
+from mpc_nbody.output_store import OutputStore
+from mpc_nbody.orbit_cheby import ChebyshevEphemeris
+from mpc_nbody.cache import ResultCache, make_key
+from mpc_nbody.uncertainty import sample_clones
+from mpc_nbody.conversions import propagate_covariance
+from mpc_nbody.metrics import activated, stage, count
 
 # Default for caching stuff using lru_cache
 # -----------------------------------------------------------------------------
 
+@lru_cache(maxsize=1)
+def _load_integration_function():
+    '''
+    Import ephem_forces.integration_function on first use, from wherever
+    REBX_DIR is set to live, or else from the installed reboundx.
+    '''
+    try:
+        rebx_dir = os.environ['REBX_DIR']
+        if rebx_dir not in sys.path:
+            sys.path.append(rebx_dir)
+        from examples.ephem_forces.ephem_forces import integration_function
+    except (KeyError, ModuleNotFoundError):
+        from reboundx.examples.ephem_forces.ephem_forces import \
+            integration_function
+    return integration_function
+
 
 # Constants and stuff
 # -----------------------------------------------------------------------------
 DATA_PATH = os.path.realpath(os.path.dirname(__file__))
 DATA_DIR = os.path.join(os.path.dirname(DATA_PATH), 'dev_data')
 au_km = 149597870.700  # This is now a definition
+BINARY_MAGIC = b'MPCNBODY'  # First bytes of binary output files
+BINARY_VERSION = 1
+BINARY_ALIGN = 64  # Data blocks start at multiples of this many bytes
+RESAMPLE_WINDOW = 365.25  # Days integrated at once when resampling output
+RUN_CACHE_VERSION = 1  # Increase when the integrator's results change
+# Files of each filetype that are parsed from a directory (OrbFit writes
+# e.g. 30101.eq0 & 30101.fel; MPC files are e.g. MPCORB.DAT)
+DIRECTORY_PATTERNS = {'eq': '*.eq[0-9]*', 'fel': '*.fel*', 'mpcorb': '*.DAT'}
+# Finite-difference steps of the state transition matrix [au, au/day]
+STM_STEPS = np.array([1e-6, 1e-6, 1e-6, 1e-8, 1e-8, 1e-8])
+# Results of run_nbody, in memory (and on disk if MPC_NBODY_CACHE_DIR is set)
+run_cache = ResultCache(disk='run')
 
 
 # Data classes/methods
 # -----------------------------------------------------------------------------
+def _with_metrics(method):
+    '''
+    Decorate an NbodySim method to report to the object's metrics.
+    Not intended for user usage.
+    '''
+    @wraps(method)
+    def with_metrics(self, *args, **kwargs):
+        with activated(self.metrics):
+            return method(self, *args, **kwargs)
+    return with_metrics
+
+
 class NbodySim():
     '''
     Class for containing all of the N-body related stuff.
+
+    input_file can be a single file, or a list of files, a directory or a
+    glob pattern (of a directory, only the files named as DIRECTORY_PATTERNS
+    gives for the filetype). In the latter cases all the files are parsed,
+    grouped by epoch and each epoch group is integrated in a single
+    multi-particle run_nbody call; see epoch_groups, object_output &
+    iter_object_outputs.
+
+    metrics can be a metrics.Metrics object, which then collects the time
+    spent in each stage of the parsing, integrating and saving done by this
+    object, and counts of the particles, substeps and bytes written.
+
+    tstep, trange & geocentric are the defaults of the integrations; files
+    of filetype 'ic' (see parse_input.ICWriter) set them from their header.
     '''
 
-    def __init__(self, input_file=None, filetype=None, save_parsed=False):
+    def __init__(self, input_file=None, filetype=None, save_parsed=False,
+                 metrics=None):
+        self.metrics = metrics
+        self.pparticle = None
+        self.designations = None
+        self.input_epochs = None
+        self.input_states = None
+        self.input_covariances = None
+        self.parse_failures = []
+        self.epoch_groups = None
+        self.clone_groups = None
+        self.output_stm = None
+        self.output_covariances = None
+        self.tstep = 20
+        self.trange = 600
+        self.geocentric = False  # Can be changed to something like
+        #self.pparticle.geocentric if ParseElements gains knowledge.
         #If input filename provided, process it:
-        if isinstance(input_file, str) & isinstance(filetype, str):
-            self.pparticle = parse_input.ParseElements(input_file, filetype,
-                                                       save_parsed=save_parsed)
+        input_files = _expand_input_files(input_file, filetype)
+        if isinstance(input_files, str) & (filetype in ('mpcorb', 'ic')):
+            input_files = [input_files]  # These files hold many orbits
+        if isinstance(input_files, str) & isinstance(filetype, str):
+            with activated(metrics), stage('parse'):
+                self.pparticle = parse_input.ParseElements(
+                    input_file, filetype, save_parsed=save_parsed)
+        elif isinstance(input_files, list) & isinstance(filetype, str):
+            with activated(metrics), stage('parse'):
+                self.parse_files(input_files, filetype)
         else:
             print("Keywords 'input_file' and/or 'filetype' missing; "
                   "initiating empty object.")
-            self.pparticle = None
-        self.geocentric = False  # Can be changed to something like
-        #self.pparticle.geocentric if ParseElements gains knowledge.
         self.input_vectors = None
         self.input_n_particles = None
         self.output_times = None
@@ -72,72 +153,462 @@ class NbodySim():
         self.output_n_times = None
         self.output_n_particles = None
         self.time_parameters = None
+        self.output_store = None
+        self.chebyshev = None
+
+    def parse_files(self, input_files, filetype):
+        '''
+        Parse many input files into arrays of designations, TDB epochs,
+        barycentric equatorial states and covariances.
+        Files that cannot be parsed are listed in self.parse_failures.
+        '''
+        if filetype in ('fel', 'eq'):
+            elements, self.parse_failures = parse_input.parse_orbfit_batch(
+                input_files)
+        elif filetype == 'mpcorb':  # Each file holds many orbits
+            batches = [parse_input.parse_mpcorb_batch(input_file)
+                       for input_file in input_files]
+            elements = np.concatenate([batch[0] for batch in batches])
+            self.parse_failures = [failure for batch in batches
+                                   for failure in batch[1]]
+        elif filetype == 'ic':  # Already barycentric equatorial
+            batches = [parse_input.read_initial_conditions(input_file)
+                       for input_file in input_files]
+            parameters = {(batch[1]['tstep'], batch[1]['trange'],
+                           batch[1]['geocentric']) for batch in batches}
+            if len(parameters) > 1:
+                raise TypeError("The initial conditions files have "
+                                "different integration parameters.")
+            self.tstep, self.trange, self.geocentric = parameters.pop()
+            elements = np.concatenate([batch[0] for batch in batches])
+            self.parse_failures = []
+            self.input_epochs = elements['jd_tdb']
+            self.input_states = elements['state']
+            self.input_covariances = elements['covariance']
+            self.designations = elements['designation']
+            return
+        else:
+            raise TypeError(f"Batch parsing of filetype '{filetype:}' "
+                            "is not supported.")
+        (self.input_epochs, self.input_states, self.input_covariances
+         ) = parse_input.bary_equatorial_batch(elements)
+        self.designations = elements['designation']
 
-    def __call__(self, tstart=None, vectors=None, tstep=20, trange=600,
-                 save_output=None, verbose=False):
-        if vectors is None:
-            vectors = self.pparticle
+    @_with_metrics
+    def __call__(self, tstart=None, vectors=None, tstep=None, trange=None,
+                 save_output=None, binary_output=False, output_store=None,
+                 output_epochs=None, tbounds=None, stm=False, use_cache=False,
+                 verbose=False):
+        '''
+        Run the integration. See run_nbody for the parameters; tstep &
+        trange default to self.tstep & self.trange.
+        If output_store (an OutputStore, or a directory name for a default
+        one) is given, the output is written to disk window by window and
+        output_vectors becomes a lazy view onto the store.
+        If output_epochs (array of Julian Dates, or a cadence in days) is
+        given, the output is only at those epochs, not at the sub-steps.
+        If tbounds (t_min, t_max) is given, the integration runs backward to
+        t_min and forward to t_max from tstart (trange is ignored), see
+        run_nbody_bidirectional.
+        If stm, the state transition matrices are also computed (see
+        run_nbody_stm) and stored in output_stm, and the covariance of the
+        parsed particle(s) is propagated with them into output_covariances
+        (n_times, n_particles, 6, 6), or None if there is no covariance.
+        '''
+        if (output_store is not None) & (output_epochs is not None):
+            raise TypeError("output_epochs is not supported together with "
+                            "output_store.")
+        if (tbounds is not None) & ((output_store is not None) |
+                                    (output_epochs is not None)):
+            raise TypeError("tbounds is not supported together with "
+                            "output_store or output_epochs.")
+        if stm & ((output_store is not None) | (output_epochs is not None) |
+                  (tbounds is not None)):
+            raise TypeError("stm is not supported together with "
+                            "output_store, output_epochs or tbounds.")
+        self.output_stm = None
+        self.output_covariances = None
+        tstep = self.tstep if tstep is None else tstep
+        trange = self.trange if trange is None else trange
+        if (vectors is None) & (self.input_states is not None):
+            if tstart is not None:
+                raise TypeError("tstart is not supported for multiple input "
+                                "files: each object starts at its epoch.")
+            if output_store is not None:
+                raise TypeError("output_store is not supported for "
+                                "multiple input files.")
+            if (save_output is not None) & (
+                    len(np.unique(self.input_epochs)) > 1):
+                raise TypeError("save_output is only possible when all "
+                                "objects share the same epoch.")
+            self.run_epoch_groups(tstep, trange, verbose, output_epochs,
+                                  use_cache, tbounds, stm)
+        else:
             if vectors is None:
-                raise TypeError("If you didn't parse a particle from an input "
-                                "file, you must supply 'vectors'.")
-        if tstart is None:
-            try:
-                tstart = self.pparticle.time.tdb.jd
-            except AttributeError:
-                print("If you didn't parse a particle from an input file, "
-                      "you must supply a 'tstart' value.")
-                raise TypeError("If you didn't parse a particle from input "
-                                "file, you must supply a 'tstart' value.")
-        (self.input_vectors, self.input_n_particles, self.output_times,
-         self.output_vectors, self.output_n_times, self.output_n_particles
-         ) = run_nbody(vectors, tstart, tstep, trange, self.geocentric, verbose)
-        print(f'###!!!{type(self.output_times):}!!!###' if verbose else '')
-        self.time_parameters = [tstart, tstep, trange]
+                vectors = self.pparticle
+                if vectors is None:
+                    raise TypeError("If you didn't parse a particle from an "
+                                    "input file, you must supply 'vectors'.")
+            if tstart is None:
+                try:
+                    tstart = self.pparticle.epoch_jd_tdb
+                except AttributeError:
+                    print("If you didn't parse a particle from an input file, "
+                          "you must supply a 'tstart' value.")
+                    raise TypeError("If you didn't parse a particle from "
+                                    "input file, you must supply a 'tstart' "
+                                    "value.")
+            if output_store is not None:
+                if isinstance(output_store, str):
+                    output_store = OutputStore(output_store)
+                run_nbody_chunked(vectors, tstart, tstep, trange,
+                                  output_store, self.geocentric, verbose)
+                self.open_store(output_store)
+            elif tbounds is not None:
+                (self.input_vectors, self.input_n_particles,
+                 self.output_times, self.output_vectors, self.output_n_times,
+                 self.output_n_particles
+                 ) = run_nbody_bidirectional(vectors, tstart, tstep, *tbounds,
+                                             self.geocentric, verbose,
+                                             use_cache=use_cache)
+                self.time_parameters = [tstart, tstep, tbounds[1] - tstart]
+            elif stm:
+                (self.input_vectors, self.input_n_particles,
+                 self.output_times, self.output_vectors, self.output_n_times,
+                 self.output_n_particles, self.output_stm
+                 ) = run_nbody_stm(vectors, tstart, tstep, trange,
+                                   self.geocentric, verbose, use_cache)
+                covariance = getattr(vectors,
+                                     'barycentric_equatorial_covariance', None)
+                if covariance is not None:
+                    self.output_covariances = propagate_covariance(
+                        covariance, self.output_stm)
+                self.time_parameters = [tstart, tstep, trange]
+            else:
+                (self.input_vectors, self.input_n_particles,
+                 self.output_times, self.output_vectors, self.output_n_times,
+                 self.output_n_particles
+                 ) = run_nbody(vectors, tstart, tstep, trange,
+                               self.geocentric, verbose, output_epochs,
+                               use_cache)
+                self.time_parameters = [tstart, tstep, trange]
         if save_output is not None:
             if isinstance(save_output, str):
-                self.save_output(output_file=save_output)
+                self.save_output(output_file=save_output,
+                                 binary=binary_output)
             else:
-                self.save_output()
+                self.save_output(binary=binary_output)
+
+    @_with_metrics
+    def run_epoch_groups(self, tstep=None, trange=None, verbose=False,
+                         output_epochs=None, use_cache=False, tbounds=None,
+                         stm=False):
+        '''
+        Integrate all the parsed objects, one run_nbody call per epoch.
+        The ephemeris force evaluation dominates the cost of a step and is
+        shared by all particles, so each epoch group is integrated together.
 
-    def save_output(self, output_file='simulation_states.dat'):
+        Results are stored in self.epoch_groups, a list of dictionaries with
+        keys 'tstart', 'indices' (into self.designations etc.), 'tstep',
+        'output_times' and 'output_vectors' (n_times, n_group, 6).
+        If there is only one group, the usual output attributes are also set.
+        With tbounds (t_min, t_max), every group is integrated from its own
+        epoch backward to t_min and forward to t_max.
+        With stm, the groups also get 'output_stm' & 'output_covariances'
+        (n_times, n_group, 6, 6), see run_nbody_stm.
+        tstep & trange default to self.tstep & self.trange.
+        '''
+        tstep = self.tstep if tstep is None else tstep
+        trange = self.trange if trange is None else trange
+        self.epoch_groups = []
+        for tstart, indices in group_by_epoch(self.input_epochs):
+            if tbounds is not None:
+                (input_vectors, input_n_particles, output_times,
+                 output_vectors, output_n_times, output_n_particles
+                 ) = run_nbody_bidirectional(
+                     self.input_states[indices].reshape(-1), tstart, tstep,
+                     *tbounds, self.geocentric, verbose, use_cache=use_cache)
+                trange = tbounds[1] - tstart
+            elif stm:
+                (input_vectors, input_n_particles, output_times,
+                 output_vectors, output_n_times, output_n_particles,
+                 output_stm
+                 ) = run_nbody_stm(self.input_states[indices].reshape(-1),
+                                   tstart, tstep, trange, self.geocentric,
+                                   verbose, use_cache)
+            else:
+                (input_vectors, input_n_particles, output_times,
+                 output_vectors, output_n_times, output_n_particles
+                 ) = run_nbody(self.input_states[indices].reshape(-1),
+                               tstart, tstep, trange, self.geocentric,
+                               verbose, output_epochs, use_cache)
+            self.epoch_groups.append({'tstart': tstart, 'indices': indices,
+                                      'tstep': tstep,
+                                      'output_times': output_times,
+                                      'output_vectors': output_vectors})
+            if stm:
+                self.epoch_groups[-1]['output_stm'] = output_stm
+                self.epoch_groups[-1]['output_covariances'] = \
+                    propagate_covariance(self.input_covariances[indices],
+                                         output_stm)
+        if len(self.epoch_groups) == 1:
+            (self.input_vectors, self.input_n_particles, self.output_times,
+             self.output_vectors, self.output_n_times, self.output_n_particles
+             ) = (input_vectors, input_n_particles, output_times,
+                  output_vectors, output_n_times, output_n_particles)
+            self.time_parameters = [tstart, tstep, trange]
+            if stm:
+                self.output_stm = output_stm
+                self.output_covariances = \
+                    self.epoch_groups[0]['output_covariances']
+
+    @_with_metrics
+    def run_clones(self, n_clones, tstep=None, trange=None, rng=None,
+                   include_nominal=False, use_cache=False, verbose=False):
+        '''
+        Draw n_clones clones of every parsed object from its covariance and
+        integrate them, one run_nbody_clones call per epoch.
+
+        Results are stored in self.clone_groups, a list of dictionaries with
+        keys 'tstart', 'indices' (into self.designations etc.), 'clones'
+        (n_group, n_clones, 6), 'output_times' and 'clone_vectors'
+        (n_times, n_group, n_clones, 6).
+        tstep & trange default to self.tstep & self.trange.
+        '''
+        tstep = self.tstep if tstep is None else tstep
+        trange = self.trange if trange is None else trange
+        if self.input_states is None:
+            raise TypeError("run_clones needs objects parsed from several "
+                            "input files (or an 'mpcorb' or 'ic' file).")
+        rng = np.random.default_rng(rng)
+        self.clone_groups = []
+        for tstart, indices in group_by_epoch(self.input_epochs):
+            clones, output_times, clone_vectors = run_nbody_clones(
+                self.input_states[indices], self.input_covariances[indices],
+                tstart, tstep, trange, n_clones, self.geocentric, rng,
+                include_nominal, verbose, use_cache)
+            self.clone_groups.append({'tstart': tstart, 'indices': indices,
+                                      'clones': clones,
+                                      'output_times': output_times,
+                                      'clone_vectors': clone_vectors})
+
+    @_with_metrics
+    def extend(self, trange, tstep=None, use_cache=False, verbose=False):
+        '''
+        Continue the integration for trange more days from the last output
+        time, appending to the output (or to the OutputStore), so that e.g.
+        a rolling ephemeris only costs the new interval.
+        tstep defaults to the one of the original run.
+
+        The integrator restarts from the last output states (ephem_forces
+        does not expose its internal step state), which is the same as
+        starting a new window in run_nbody_chunked. The new output is at
+        the integrator's own output times, also if the run used
+        output_epochs. State transition matrices are not extended, so they
+        are dropped.
+        '''
+        self.output_stm = None
+        self.output_covariances = None
+        for group in self.epoch_groups or []:
+            group.pop('output_stm', None)
+            group.pop('output_covariances', None)
+        if self.output_store is not None:
+            extend_output_store(self.output_store, trange, tstep,
+                                self.geocentric, verbose)
+            self.open_store(self.output_store)
+        elif self.epoch_groups:
+            for group in self.epoch_groups:
+                group['output_times'], group['output_vectors'] = \
+                    _extend_output(group['output_times'],
+                                   group['output_vectors'], trange,
+                                   group['tstep'] if tstep is None else tstep,
+                                   self.geocentric, use_cache, verbose)
+            if len(self.epoch_groups) == 1:
+                self.output_times = self.epoch_groups[0]['output_times']
+                self.output_vectors = self.epoch_groups[0]['output_vectors']
+        elif self.output_times is not None:
+            self.output_times, self.output_vectors = _extend_output(
+                self.output_times, self.output_vectors, trange,
+                self.time_parameters[1] if tstep is None else tstep,
+                self.geocentric, use_cache, verbose)
+        else:
+            raise TypeError("There is no integration to extend yet.")
+        if self.output_store is None:
+            self.output_n_times = len(self.output_times) \
+                if self.output_times is not None else None
+            if self.time_parameters is not None:
+                self.time_parameters = [self.time_parameters[0],
+                                        self.time_parameters[1],
+                                        self.output_times[-1] -
+                                        self.time_parameters[0]]
+        self.chebyshev = None
+
+    def object_output(self, obj):
+        '''
+        Output of a single object after run_epoch_groups.
+
+        Input:
+        ------
+        obj = integer index into self.designations, or a designation string.
+
+        Output:
+        -------
+        times = numpy array, output times of the object's epoch group
+        vectors = numpy array (n_times, 6), a view into the group's output
+        '''
+        if isinstance(obj, str):
+            matches = np.flatnonzero(self.designations == obj)
+            if len(matches) == 0:
+                raise KeyError(f"No object with designation {obj:}")
+            obj = matches[0]
+        for group in self.epoch_groups:
+            position = np.searchsorted(group['indices'], obj)
+            if ((position < len(group['indices'])) and
+                    (group['indices'][position] == obj)):
+                return (group['output_times'],
+                        group['output_vectors'][:, position, :])
+        raise IndexError(f"Object {obj:} has not been integrated.")
+
+    def iter_object_outputs(self):
+        '''
+        Generator over all integrated objects, yielding
+        (designation, output_times, output_vectors (n_times, 6)) tuples
+        in epoch group order.
+        '''
+        for group in self.epoch_groups:
+            for position, index in enumerate(group['indices']):
+                yield (self.designations[index], group['output_times'],
+                       group['output_vectors'][:, position, :])
+
+    @_with_metrics
+    def save_output(self, output_file='simulation_states.dat', binary=False):
         """
         Save all the outputs to file.
 
         Inputs:
         -------
         output_file : string, filename to write elements to.
+        binary : boolean, write the self-describing binary format
+                 (see save_binary_output & load_output) instead of text.
 
         The file is overwritten if it already exists.
         """
-        outfile = open(output_file, 'w')
-        outfile.write(f'#Input vectors: [')
-        for coo in self.input_vectors:
-            outfile.write(f'{coo} ')
-        outfile.write(f'\b]')
-        outfile.write(f'\n#Input N_particles: {self.input_n_particles:}')
-        outfile.write('\n#Start time, timestep, time range: '
-                      f'{self.time_parameters:}')
-        outfile.write(f'\n#Output N_times: {self.output_n_times:}')
-        outfile.write(f'\n#Output N_particles: {self.output_n_particles:}')
-        outfile.write('\n#')
-        outfile.write('\n#Time               ')
-        for j in np.arange(self.output_n_particles):
-            outfile.write('x                  y                  '
+        if self.output_times is None:
+            raise TypeError("save_output is only possible when all objects "
+                            "share the same epoch." if self.epoch_groups else
+                            "There is no output to save yet.")
+        with stage('output_write'):
+            if binary:
+                save_binary_output(output_file, self.input_vectors,
+                                   self.input_n_particles,
+                                   self.time_parameters, self.output_times,
+                                   self.output_vectors)
+            else:
+                self._save_text_output(output_file)
+        count('bytes_written', os.path.getsize(output_file))
+
+    def _save_text_output(self, output_file):
+        '''The text format of save_output. Not intended for user usage.'''
+        n_cols = 6 * self.output_n_particles
+        with open(output_file, 'w') as outfile:
+            outfile.write('#Input vectors: [' +
+                          ' '.join(f'{coo}' for coo in self.input_vectors) +
+                          ']')
+            outfile.write(f'\n#Input N_particles: {self.input_n_particles:}')
+            outfile.write('\n#Start time, timestep, time range: '
+                          f'{self.time_parameters:}')
+            outfile.write(f'\n#Output N_times: {self.output_n_times:}')
+            outfile.write('\n#Output N_particles: '
+                          f'{self.output_n_particles:}')
+            outfile.write('\n#')
+            outfile.write('\n#Time               ' +
+                          'x                  y                  '
                           'z                   dx                  '
-                          '  dy                    dz                  ')
-        for i, timei in enumerate(self.output_times):
-            outfile.write(f'\n{timei:} ')
-            for j in np.arange(self.output_n_particles):
-                for k in np.arange(6):
-                    outfile.write(f'{self.output_vectors[i, j, k]:} ')
-        outfile.write('\n#End')
+                          '  dy                    dz                  ' *
+                          self.output_n_particles)
+            # Format every row at once, then write the table in one go.
+            table = np.column_stack([
+                self.output_times,
+                np.reshape(self.output_vectors, (-1, n_cols))])
+            row_format = '\n' + '%r ' * (n_cols + 1)
+            outfile.write(''.join(row_format % tuple(row)
+                                  for row in table.tolist()))
+            outfile.write('\n#End')
+
+    def fit_chebyshev(self, tolerance=1e-10, degree=11, window=None):
+        """
+        Compress the output into per-object, per-window Chebyshev
+        polynomials (see orbit_cheby.ChebyshevEphemeris.fit), stored in
+        self.chebyshev and returned. Positions & velocities can then be
+        looked up with self.chebyshev.evaluate(object_ids, times).
+        Not supported after integrating objects with different epochs
+        (several epoch_groups).
+        """
+        if self.output_times is None:
+            raise TypeError("fit_chebyshev needs the output of a single "
+                            "integration, not of several epoch groups."
+                            if self.epoch_groups else
+                            "There is no output to fit yet.")
+        self.chebyshev = ChebyshevEphemeris.fit(
+            self.output_times, self.output_vectors, tolerance=tolerance,
+            degree=degree, window=window)
+        return self.chebyshev
+
+    def open_store(self, output_store):
+        """
+        Point this object's outputs at an OutputStore (or the directory of
+        one); output_vectors becomes a lazy view onto the disk store.
+        """
+        if isinstance(output_store, str):
+            output_store = OutputStore(output_store)
+        self.output_store = output_store
+        self.input_vectors = np.array(output_store.meta['input_vectors'])
+        self.input_n_particles = output_store.n_particles
+        self.time_parameters = output_store.meta['time_parameters']
+        self.output_times = output_store.times()
+        self.output_vectors = output_store.vectors()
+        self.output_n_times = output_store.n_times
+        self.output_n_particles = output_store.n_particles
+
+    def load_output(self, output_file, mmap_mode='r'):
+        """
+        Load outputs saved with save_output(..., binary=True) into this
+        object. The arrays are memory-mapped unless mmap_mode is None.
+        A directory is opened as an OutputStore instead.
+        """
+        if os.path.isdir(output_file):
+            self.open_store(output_file)
+            return
+        output = load_output(output_file, mmap_mode=mmap_mode)
+        self.input_vectors = output['input_vectors']
+        self.input_n_particles = output['input_n_particles']
+        self.time_parameters = output['time_parameters']
+        self.output_times = output['output_times']
+        self.output_vectors = output['output_vectors']
+        self.output_n_times, self.output_n_particles, _ = np.shape(
+            self.output_vectors)
 
 # Functions
 # -----------------------------------------------------------------------------
 
 
+def integration_function(tstart, tstep, trange, geocentric, n_particles,
+                         instates):
+    '''
+    ephem_forces.integration_function, imported on first use.
+    Returns times, states (n_times, n_particles, 6), n_times, n_particles.
+    '''
+    with stage('integration'):
+        output = _load_integration_function()(tstart, tstep, trange,
+                                              geocentric, n_particles,
+                                              instates)
+    count('particles', n_particles)
+    count('substeps', len(output[0]))
+    return output
+
+
 def run_nbody(input_vectors, tstart, tstep, trange, geocentric=False,
-              verbose=False):
+              verbose=False, output_epochs=None, use_cache=False):
     '''
     Run the nbody integrator with the parsed input.
 
@@ -150,12 +621,22 @@ def run_nbody(input_vectors, tstart, tstep, trange, geocentric=False,
     tstep = float or integer, major time step of integrator.
     trange = float or integer, rough total time of integration.
     geocentric = boolean, use geo- (True) or heliocentric (False)
+    output_epochs = None, array of Julian Dates within the integration, or
+                    float cadence [days] starting at tstart: if given, the
+                    output is interpolated to these epochs instead (see
+                    run_nbody_resampled).
+    use_cache = boolean, look the result up in (and add it to) run_cache,
+                keyed on the exact input vectors & parameters. Results
+                found in the cache are shared, so they are read-only; a
+                copy of new results is kept in memory (up to
+                run_cache.max_bytes), hence off by default.
 
     Output:
     -------
     reparsed_input = numpy array, input elements, reparsed into array
     n_particles = integer, the input number of particles
-    times = numpy array, all the output times (including sub-steps)
+    times = numpy array, all the output times (including sub-steps),
+                         or output_epochs if given
     output_vectors = numpy array, output elements of dimensions
                                   (n_times, n_particles_out, 6)
     n_times = integer, number of time outputs
@@ -163,56 +644,653 @@ def run_nbody(input_vectors, tstart, tstep, trange, geocentric=False,
     '''
     # First get input (3 types allowed) into a useful format:
     reparsed_input, n_particles = _fix_input(input_vectors, verbose)
-    # Now run the nbody integrator:
-    (times, output_vectors, n_times, n_particles_out
-     ) = integration_function(tstart, tstep, trange, geocentric,
-                              n_particles, reparsed_input)
+    if use_cache:
+        key = _run_cache_key(reparsed_input, [tstart, tstep, trange],
+                             geocentric, 'all' if output_epochs is None else
+                             np.asarray(output_epochs, dtype=float))
+        cached = run_cache.get(key)
+        if cached is not None:
+            return(reparsed_input, n_particles, cached['times'],
+                   cached['output_vectors'], len(cached['times']),
+                   cached['output_vectors'].shape[1])
+    if output_epochs is not None:
+        times, output_vectors = run_nbody_resampled(
+            reparsed_input, tstart, tstep, trange, output_epochs, geocentric,
+            verbose)
+    else:
+        # Now run the nbody integrator:
+        (times, output_vectors, n_times, n_particles_out
+         ) = integration_function(tstart, tstep, trange, geocentric,
+                                  n_particles, reparsed_input)
+    if use_cache:
+        run_cache.put(key, {'times': times, 'output_vectors': output_vectors})
     return(reparsed_input, n_particles, times, output_vectors,
-           n_times, n_particles_out)
+           len(times), output_vectors.shape[1])
+
+
+def run_nbody_bidirectional(input_vectors, tstart, tstep, t_min, t_max,
+                            geocentric=False, verbose=False, parallel=False,
+                            use_cache=False):
+    '''
+    Run the nbody integrator backward from tstart to t_min and forward from
+    tstart to t_max, e.g. for an orbit fit with its epoch in the middle of
+    the observations, and return one time-ordered output.
+
+    With parallel, the two legs run concurrently in two new worker
+    processes (unless one leg is empty). Each worker loads the ephemeris,
+    which only pays off for long integrations of many particles, so this
+    is off by default (also in NbodySim & run_epoch_groups).
+    The output is assembled with a single copy of each leg.
+
+    Input:
+    ------
+    input_vectors, tstep, geocentric, verbose, use_cache = as for run_nbody.
+    tstart = float, Julian Date of the input elements.
+    t_min, t_max = floats, Julian Dates with t_min <= tstart <= t_max.
+    parallel = boolean, integrate the two legs concurrently.
+
+    Output:
+    -------
+    As for run_nbody, with times increasing from t_min to t_max.
+    '''
+    reparsed_input, n_particles = _fix_input(input_vectors, verbose)
+    if not t_min <= tstart <= t_max:
+        raise ValueError("Need t_min <= tstart <= t_max.")
+    if use_cache:
+        key = _run_cache_key(reparsed_input, [tstart, tstep, t_min, t_max],
+                             geocentric, 'bidirectional')
+        cached = run_cache.get(key)
+        if cached is not None:
+            return(reparsed_input, n_particles, cached['times'],
+                   cached['output_vectors'], len(cached['times']),
+                   n_particles)
+    # REBOUND integrates backward when trange < 0, with tstep > 0
+    legs = [(tstart, abs(tstep), trange, geocentric)
+            for trange in (t_min - tstart, t_max - tstart) if trange != 0]
+    if parallel & (len(legs) == 2):
+        with ProcessPoolExecutor(max_workers=2,
+                                 initializer=_init_worker) as executor:
+            futures = [executor.submit(_integrate_leg, reparsed_input, *leg)
+                       for leg in legs]
+            outputs = [future.result() for future in futures]
+    else:
+        outputs = [integration_function(*leg[:3], geocentric, n_particles,
+                                        reparsed_input)[:2] for leg in legs]
+    start = ([tstart], reparsed_input.reshape(1, n_particles, 6))
+    backward = outputs.pop(0) if t_min < tstart else start
+    forward = outputs.pop(0) if t_max > tstart else start
+    times = np.concatenate([backward[0][:0:-1], forward[0]])
+    output_vectors = np.concatenate([backward[1][:0:-1], forward[1]])
+    if use_cache:
+        run_cache.put(key, {'times': times, 'output_vectors': output_vectors})
+    return(reparsed_input, n_particles, times, output_vectors,
+           len(times), n_particles)
+
+
+def run_nbody_clones(states, covariances, tstart, tstep, trange, n_clones,
+                     geocentric=False, rng=None, include_nominal=False,
+                     verbose=False, use_cache=False):
+    '''
+    Draw n_clones Monte-Carlo clones of every object from its covariance
+    (see uncertainty.sample_clones) and integrate all the n_objects x
+    n_clones clones together, in one multi-particle run_nbody call.
+
+    Input:
+    ------
+    states = array (n_objects, 6), barycentric equatorial states at tstart.
+    covariances = array (n_objects, 6, 6), covariances of the states.
+    tstart, tstep, trange, geocentric, verbose, use_cache = as for run_nbody.
+    n_clones, rng, include_nominal = as for uncertainty.sample_clones.
+
+    Output:
+    -------
+    clones = numpy array (n_objects, n_clones, 6), the initial clones
+    times = numpy array, all the output times
+    clone_vectors = numpy array (n_times, n_objects, n_clones, 6), a view
+                    of run_nbody's output (see uncertainty.clone_statistics
+                    for the spread at each time)
+    '''
+    clones = sample_clones(states, covariances, n_clones, rng,
+                           include_nominal)
+    (_, _, times, output_vectors, n_times, _
+     ) = run_nbody(clones.reshape(-1), tstart, tstep, trange, geocentric,
+                   verbose, use_cache=use_cache)
+    return clones, times, output_vectors.reshape((n_times,) + clones.shape)
+
+
+def run_nbody_stm(input_vectors, tstart, tstep, trange, geocentric=False,
+                  verbose=False, use_cache=False, steps=None):
+    '''
+    Run the nbody integrator and also compute the 6x6 state transition
+    matrix d(state at t)/d(state at tstart) of every particle at every
+    output time, e.g. to propagate covariances linearly (J C J^T, see
+    conversions.propagate_covariance).
+
+    ephem_forces does not integrate variational equations, so the matrices
+    are central finite differences: every particle gets 12 clones, offset
+    by +-steps along each coordinate, and all of them are integrated in the
+    same run_nbody call as the nominal particles.
+
+    Input:
+    ------
+    As for run_nbody (without output_epochs), and
+    steps = None (STM_STEPS) or array-like (6,), finite-difference steps.
+
+    Output:
+    -------
+    As for run_nbody, and
+    stm = numpy array (n_times, n_particles, 6, 6)
+    '''
+    reparsed_input, n_particles = _fix_input(input_vectors, verbose)
+    steps = STM_STEPS if steps is None else np.broadcast_to(steps, (6,))
+    states = reparsed_input.reshape(n_particles, 1, 6)
+    offsets = np.diag(steps)
+    clones = np.concatenate([states, states + offsets, states - offsets],
+                            axis=1)
+    (_, _, times, output_vectors, n_times, _
+     ) = run_nbody(clones.reshape(-1), tstart, tstep, trange, geocentric,
+                   verbose, use_cache=use_cache)
+    output_vectors = output_vectors.reshape(n_times, n_particles, 13, 6)
+    # The offsets actually applied, after rounding of states +- steps
+    widths = np.diagonal(clones[:, 1:7] - clones[:, 7:], axis1=1, axis2=2)
+    stm = (output_vectors[:, :, 1:7] - output_vectors[:, :, 7:]
+           ) / widths[..., None]
+    return(reparsed_input, n_particles, times,
+           np.ascontiguousarray(output_vectors[:, :, 0]), n_times,
+           n_particles, stm.swapaxes(-1, -2))
+
+
+def _run_cache_key(reparsed_input, time_parameters, geocentric, *extra):
+    '''
+    run_cache key of an integration: hash of the exact input vectors,
+    time parameters, geocentric flag & anything else that sets the output.
+    Not intended for user usage.
+    '''
+    return make_key(reparsed_input, np.array(time_parameters, dtype=float),
+                    str(bool(geocentric)), str(RUN_CACHE_VERSION), *extra)
+
+
+def run_nbody_resampled(input_vectors, tstart, tstep, trange, output_epochs,
+                        geocentric=False, verbose=False,
+                        window=RESAMPLE_WINDOW):
+    '''
+    Run the nbody integrator and return the states at requested epochs,
+    rather than at the integrator's (adaptive) sub-steps.
+    The integration is done in windows of `window` days; each window's
+    sub-step output is Hermite interpolated (using positions & velocities)
+    to the epochs it covers and then dropped, so only the requested output
+    is kept in memory.
+
+    Input:
+    ------
+    input_vectors, tstart, tstep, trange, geocentric = as for run_nbody.
+    output_epochs = array of Julian Dates, or float cadence [days], as for
+                    run_nbody. Epochs must lie within tstart + [0, trange].
+    window = float, length [days] of the integration windows.
+
+    Output:
+    -------
+    times = numpy array, the output epochs
+    output_vectors = numpy array, interpolated output elements of
+                                  dimensions (n_epochs, n_particles, 6)
+    '''
+    state, n_particles = _fix_input(input_vectors, verbose)
+    tend = tstart + trange
+    direction = 1 if trange >= 0 else -1
+    if np.ndim(output_epochs) == 0:
+        output_epochs = tstart + direction * np.arange(
+            0, abs(trange) + 1e-9, abs(output_epochs))
+    output_epochs = np.asarray(output_epochs, dtype=float)
+    if np.any((output_epochs - tstart) * direction < 0) | np.any(
+            (output_epochs - tend) * direction > 0):
+        raise ValueError("output_epochs must lie within the integration.")
+    output_vectors = np.full((len(output_epochs), n_particles, 6), np.nan)
+    done = output_epochs == tstart
+    output_vectors[done] = state.reshape(n_particles, 6)
+    while (tend - tstart) * direction > 0 and not np.all(done):
+        length = direction * min(window, (tend - tstart) * direction)
+        (times, vectors, n_times, _
+         ) = integration_function(tstart, tstep, length, geocentric,
+                                  n_particles, state)
+        if times[-1] == tstart:  # The integrator did not get any further
+            break
+        inside = ~done & ((output_epochs - times[0]) * direction >= 0) & (
+            (output_epochs - times[-1]) * direction <= 0)
+        output_vectors[inside] = hermite_interpolate(times, vectors,
+                                                     output_epochs[inside])
+        done |= inside
+        tstart, state = times[-1], np.array(vectors[-1]).reshape(-1)
+    if not np.all(done):
+        raise ValueError(f"The integration stopped at {tstart:}, before "
+                         f"{np.sum(~done):} of the output_epochs.")
+    return output_epochs, output_vectors
+
+
+def hermite_interpolate(times, vectors, epochs):
+    '''
+    Cubic Hermite interpolation of states between output times, using the
+    positions & velocities at the two times bracketing each epoch.
+
+    Input:
+    ------
+    times = numpy array (n_times), monotonic (increasing or decreasing).
+    vectors = numpy array (n_times, n_particles, 6), positions & velocities.
+    epochs = numpy array (n_epochs), within the range of times.
+
+    Output:
+    -------
+    numpy array (n_epochs, n_particles, 6), interpolated positions and
+    velocities (the derivative of the interpolating cubic).
+    '''
+    times = np.asarray(times, dtype=float)
+    if times[-1] < times[0]:
+        times, vectors = times[::-1], vectors[::-1]
+    i = np.clip(np.searchsorted(times, epochs, 'right') - 1, 0,
+                len(times) - 2)
+    h = (times[i + 1] - times[i])[:, None, None]
+    s = ((epochs - times[i]) / (times[i + 1] - times[i]))[:, None, None]
+    x0, v0 = vectors[i, :, :3], vectors[i, :, 3:] * h
+    x1, v1 = vectors[i + 1, :, :3], vectors[i + 1, :, 3:] * h
+    position = ((2 * s ** 3 - 3 * s ** 2 + 1) * x0 +
+                (s ** 3 - 2 * s ** 2 + s) * v0 +
+                (-2 * s ** 3 + 3 * s ** 2) * x1 + (s ** 3 - s ** 2) * v1)
+    velocity = ((6 * s ** 2 - 6 * s) * x0 + (3 * s ** 2 - 4 * s + 1) * v0 +
+                (-6 * s ** 2 + 6 * s) * x1 + (3 * s ** 2 - 2 * s) * v1) / h
+    return np.concatenate([position, velocity], axis=-1)
+
+
+def run_nbody_chunked(input_vectors, tstart, tstep, trange, output_store,
+                      geocentric=False, verbose=False):
+    '''
+    Run the nbody integrator one time window at a time, writing each
+    window's output to a disk-backed OutputStore (chunked by particle
+    block) before integrating the next one, so that the full output never
+    has to fit in memory. Each window starts from the last state of the
+    previous one; the repeated start time is not stored twice.
+
+    Input:
+    ------
+    input_vectors, tstart, tstep, trange, geocentric = as for run_nbody.
+    output_store = OutputStore, where the output is written.
+
+    Output:
+    -------
+    reparsed_input = numpy array, input elements, reparsed into array
+    n_particles = integer, the input number of particles
+    '''
+    reparsed_input, n_particles = _fix_input(input_vectors, verbose)
+    output_store.start(reparsed_input, n_particles, [tstart, tstep, trange])
+    _integrate_windows(reparsed_input, n_particles, tstart, tstep,
+                       tstart + trange, output_store, geocentric, verbose)
+    return reparsed_input, n_particles
+
+
+def _integrate_windows(state, n_particles, tstart, tstep, tend, output_store,
+                       geocentric=False, verbose=False, skip_first=False):
+    '''
+    Integrate from tstart to tend in windows of output_store.time_window,
+    appending each window to output_store. Returns the final time & state.
+    skip_first drops the first output time of the first window (used when
+    it is already the last time in the store).
+    '''
+    direction = 1 if tend >= tstart else -1
+    while (tend - tstart) * direction > 0:
+        window = direction * min(output_store.time_window,
+                                 (tend - tstart) * direction)
+        (_, _, times, output_vectors, n_times, _
+         ) = run_nbody(state, tstart, tstep, window, geocentric, verbose,
+                       use_cache=False)
+        first = 1 if skip_first else 0
+        output_store.append_window(times[first:], output_vectors[first:])
+        tstart, state = times[-1], np.array(output_vectors[-1]).reshape(-1)
+        skip_first = True
+    return tstart, state
+
+
+def extend_output_store(output_store, trange=None, tstep=None,
+                        geocentric=False, verbose=False):
+    '''
+    Continue the integration in an OutputStore from its last output,
+    appending windows to the store.
+
+    Input:
+    ------
+    output_store = OutputStore (or the directory of one), as written by
+                   run_nbody_chunked.
+    trange = float, days to integrate beyond the last output, or None to
+             finish the integration recorded in the store's
+             time_parameters (e.g. one that was interrupted).
+    tstep = float, major time step of integrator (default: the store's).
+    geocentric, verbose = as for run_nbody.
+
+    Output:
+    -------
+    output_store = OutputStore, extended.
+    '''
+    if isinstance(output_store, str):
+        output_store = OutputStore(output_store)
+    if output_store.meta['time_parameters'] is None:
+        raise TypeError("The output store holds no integration to extend.")
+    tstart, run_tstep, run_trange = output_store.meta['time_parameters']
+    last = output_store.last_state()
+    if last is None:  # Interrupted before the first window was written
+        tlast, state = tstart, np.array(output_store.meta['input_vectors'])
+    else:
+        tlast, state = last[0], last[1].reshape(-1)
+    tend = tstart + run_trange if trange is None else tlast + trange
+    direction = 1 if run_trange >= 0 else -1
+    if (tend - tlast) * direction < 0:
+        raise ValueError("An integration can only be extended in the "
+                         "direction it was run.")
+    _integrate_windows(state, output_store.n_particles, tlast,
+                       run_tstep if tstep is None else tstep, tend,
+                       output_store, geocentric, verbose,
+                       skip_first=last is not None)
+    if trange is not None:
+        output_store.set_time_parameters([tstart, run_tstep, tend - tstart])
+    return output_store
+
+
+def _extend_output(times, vectors, trange, tstep, geocentric=False,
+                   use_cache=False, verbose=False):
+    '''
+    Integrate trange more days from the last of the in-memory output
+    times & vectors, returning them with the new output appended (the
+    restart time is not repeated).
+    Not intended for user usage.
+    '''
+    direction = 1 if times[-1] >= times[0] else -1
+    if trange * direction < 0:
+        raise ValueError("An integration can only be extended in the "
+                         "direction it was run.")
+    (_, _, new_times, new_vectors, _, _
+     ) = run_nbody(np.array(vectors[-1]).reshape(-1), times[-1], tstep,
+                   trange, geocentric, verbose, use_cache=use_cache)
+    return (np.concatenate([times, new_times[1:]]),
+            np.concatenate([vectors, new_vectors[1:]]))
+
+
+def run_nbody_parallel(input_states, tstarts, tstep, trange, geocentric=False,
+                       chunk_size=1000, max_workers=None, full_output=True):
+    '''
+    Run the nbody integrator for many orbits with different start times,
+    in parallel over a pool of worker processes.
+
+    The orbits are grouped by start time and each group is split into
+    chunks of at most chunk_size particles; every chunk is one
+    integration_function call in a worker. Each worker loads the ephemeris
+    once, when it starts. A chunk that fails does not affect the others.
+
+    Input:
+    ------
+    input_states = numpy array (N, 6), barycentric equatorial elements.
+    tstarts = float or numpy array length N, Julian Dates (TDB) at which
+              the elements are valid and integrations start.
+    tstep = float or integer, major time step of integrator.
+    trange = float or integer, rough total time of integration.
+    geocentric = boolean, use geo- (True) or heliocentric (False)
+    chunk_size = integer, maximum number of particles per integration.
+    max_workers = integer, number of worker processes
+                  (default: number of processors).
+    full_output = boolean, gather the output at all times; if False, only
+                  the final times & states are sent back by the workers.
+
+    Output:
+    -------
+    final_times = numpy array length N, time of the last output of each
+                  orbit's integration (NaN for failed chunks).
+    final_states = numpy array (N, 6), elements at final_times,
+                   in the same order as input_states (NaN if failed).
+    chunks = list of dictionaries, one per successful chunk, in input order
+             (of their first orbit), with keys 'tstart', 'indices' (into
+             input_states), 'output_times' and 'output_vectors'
+             (n_times, len(indices), 6); only the final time if not
+             full_output.
+    failures = list of (indices, error message) tuples, one per failed chunk.
+    '''
+    input_states = np.asarray(input_states, dtype=float).reshape(-1, 6)
+    tstarts = np.broadcast_to(np.asarray(tstarts, dtype=float),
+                              (len(input_states),))
+    final_times = np.full(len(input_states), np.nan)
+    final_states = np.full((len(input_states), 6), np.nan)
+    failures = []
+    chunks = [(tstart, indices[i:i + chunk_size])
+              for tstart, indices in group_by_epoch(tstarts)
+              for i in range(0, len(indices), chunk_size)]
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             initializer=_init_worker) as executor:
+        futures = {executor.submit(_integrate_chunk,
+                                   input_states[indices].reshape(-1), tstart,
+                                   tstep, trange, geocentric, full_output):
+                   (tstart, indices) for tstart, indices in chunks}
+        outputs = []
+        for future in as_completed(futures):
+            tstart, indices = futures[future]
+            try:
+                output_times, output_vectors = future.result()
+            except Exception as err:  # Isolate the failure to this chunk
+                failures.append((indices, f'{type(err).__name__}: {err}'))
+                continue
+            final_times[indices] = output_times[-1]
+            final_states[indices] = output_vectors[-1]
+            outputs.append({'tstart': tstart, 'indices': indices,
+                            'output_times': output_times,
+                            'output_vectors': output_vectors})
+    outputs.sort(key=lambda chunk: chunk['indices'][0])
+    failures.sort(key=lambda failure: failure[0][0])
+    return final_times, final_states, outputs, failures
+
+
+def _init_worker():
+    '''
+    Initializer for run_nbody_parallel & run_nbody_bidirectional worker
+    processes:
+    make sure the integrator & ephemeris are loaded once per process.
+    '''
+    global _worker_integration_function
+    _worker_integration_function = _load_integration_function()
+
+
+def _integrate_leg(reparsed_input, tstart, tstep, trange, geocentric):
+    '''
+    Integrate one leg of run_nbody_bidirectional in a worker process,
+    returning its times & (n_times, n_particles, 6) output.
+    '''
+    (times, output_vectors, n_times, n_particles_out
+     ) = _worker_integration_function(tstart, tstep, trange, geocentric,
+                                      len(reparsed_input) // 6,
+                                      reparsed_input)
+    return times, output_vectors
+
+
+def _integrate_chunk(reparsed_input, tstart, tstep, trange, geocentric,
+                     full_output=True):
+    '''
+    Integrate one chunk of particles in a worker process and return its
+    times & (n_times, n_particles, 6) output, or only the final time &
+    states if not full_output, to keep transfers small.
+    '''
+    if not np.all(np.isfinite(reparsed_input)):
+        raise ValueError("Input states must be finite.")
+    (times, output_vectors, n_times, n_particles_out
+     ) = _worker_integration_function(tstart, tstep, trange, geocentric,
+                                      len(reparsed_input) // 6,
+                                      reparsed_input)
+    if not full_output:
+        return times[-1:], output_vectors[-1:]
+    return times, output_vectors
+
+
+def save_binary_output(output_file, input_vectors, input_n_particles,
+                       time_parameters, output_times, output_vectors):
+    '''
+    Save integration output in a self-describing binary format:
+    BINARY_MAGIC, an 8-byte little-endian header length, a JSON header
+    describing the data blocks, then the input vectors, output times and
+    output vectors as contiguous little-endian float64 blocks, each starting
+    at a multiple of BINARY_ALIGN bytes so that they can be memory-mapped.
+    '''
+    blocks = {'input_vectors': np.asarray(input_vectors, dtype='<f8'),
+              'output_times': np.asarray(output_times, dtype='<f8'),
+              'output_vectors': np.asarray(output_vectors, dtype='<f8')}
+    header = {'version': BINARY_VERSION,
+              'input_n_particles': int(input_n_particles),
+              'time_parameters': [float(t) for t in time_parameters],
+              'dtype': '<f8', 'blocks': {}}
+    # The header size depends on the offsets, so leave room for them.
+    offset = BINARY_ALIGN * 64
+    for name, block in blocks.items():
+        header['blocks'][name] = {'offset': offset, 'shape': block.shape}
+        offset += -(-block.nbytes // BINARY_ALIGN) * BINARY_ALIGN
+    header_bytes = json.dumps(header).encode()
+    if len(BINARY_MAGIC) + 8 + len(header_bytes) > BINARY_ALIGN * 64:
+        raise ValueError("Binary output header too long.")
+    with open(output_file, 'wb') as outfile:
+        outfile.write(BINARY_MAGIC)
+        outfile.write(len(header_bytes).to_bytes(8, 'little'))
+        outfile.write(header_bytes)
+        for name, block in blocks.items():
+            outfile.seek(header['blocks'][name]['offset'])
+            np.ascontiguousarray(block).tofile(outfile)
+
+
+def load_output(output_file, mmap_mode='r'):
+    '''
+    Load a file written by save_binary_output.
+
+    Input:
+    ------
+    output_file = string, filename.
+    mmap_mode = 'r', 'r+', 'c' to memory-map the data blocks (nothing is
+                read until it is used), or None to read them into memory.
+
+    Output:
+    -------
+    Dictionary with keys 'input_vectors', 'input_n_particles',
+    'time_parameters', 'output_times' and 'output_vectors'.
+    '''
+    with open(output_file, 'rb') as infile:
+        if infile.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise TypeError(f"{output_file:} is not an mpc_nbody "
+                            "binary output file.")
+        header_length = int.from_bytes(infile.read(8), 'little')
+        header = json.loads(infile.read(header_length).decode())
+        output = {'input_n_particles': header['input_n_particles'],
+                  'time_parameters': header['time_parameters']}
+        for name, block in header['blocks'].items():
+            shape = tuple(block['shape'])
+            if mmap_mode is None:
+                infile.seek(block['offset'])
+                output[name] = np.fromfile(infile, dtype=header['dtype'],
+                                           count=int(np.prod(shape))
+                                           ).reshape(shape)
+            else:
+                output[name] = np.memmap(output_file, dtype=header['dtype'],
+                                         mode=mmap_mode, shape=shape,
+                                         offset=block['offset'])
+    return output
+
+
+def group_by_epoch(epochs):
+    '''
+    Group objects that share an epoch.
+
+    Input:
+    ------
+    epochs = numpy array length N, the epoch of each object.
+
+    Output:
+    -------
+    List of (epoch, indices) tuples, in increasing epoch order,
+    where indices is a sorted integer array into the N objects.
+    '''
+    unique_epochs, inverse = np.unique(epochs, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    boundaries = np.cumsum(np.bincount(inverse.reshape(-1),
+                                       minlength=len(unique_epochs)))[:-1]
+    return list(zip(unique_epochs, np.split(order, boundaries)))
+
+
+def _expand_input_files(input_file, filetype=None):
+    '''
+    Expand a list of files, a directory or a glob pattern into a sorted
+    list of filenames. Of a directory, only the files matching
+    DIRECTORY_PATTERNS[filetype] are used; filetypes without a pattern need
+    a glob pattern instead. A single existing filename is returned
+    unchanged. Not intended for user usage.
+    '''
+    if isinstance(input_file, (list, tuple)):
+        return list(input_file)
+    if isinstance(input_file, str):
+        if os.path.isdir(input_file):
+            if filetype not in DIRECTORY_PATTERNS:
+                raise TypeError(f"Cannot tell the '{filetype}' files in a "
+                                "directory; give a glob pattern instead.")
+            return sorted(filename for filename in glob.glob(os.path.join(
+                input_file, DIRECTORY_PATTERNS[filetype]))
+                          if os.path.isfile(filename))
+        if (not os.path.exists(input_file)) & glob.has_magic(input_file):
+            return sorted(glob.glob(input_file))
+    return input_file
 
 
 def _fix_input(pinput, verbose=False):
     '''
-    Convert the input to a useful format.
+    Convert the input to a useful format: one flat, C-contiguous float64
+    array of barycentric equatorial elements, 6 per particle.
+    Arrays already in that layout are passed on without copying; the
+    state of a ParseElements object is copied, so that the integration's
+    input_vectors do not alias the parser's.
 
     Input:
     ------
     pinput = Either ParseElements object,
              list of ParseElements objects,
-             or numpy array of elements.
+             numpy array (or list) of elements, shape (6N,) or (N, 6),
+             or structured numpy array with the fields of
+             parse_input.BARY_EQU_DTYPE ('x_BaryEqu', ..., 'dz_BaryEqu').
 
     Output:
     -------
     reparsed = numpy array of elements.
     len(reparsed)//6 = integer, number of particles.
     '''
-    if isinstance(pinput, parse_input.ParseElements):
-        print('###!!!ONE!!!###' if verbose else '')
-        els = pinput.barycentric_equatorial_cartesian_elements
-        reparsed = np.array([els[i] for i in ['x_BaryEqu', 'y_BaryEqu',
-                                              'z_BaryEqu', 'dx_BaryEqu',
-                                              'dy_BaryEqu', 'dz_BaryEqu']])
-    elif isinstance(pinput, list):
-        print('###!!!TWO!!!###' if verbose else '')
-        if isinstance(pinput[0], parse_input.ParseElements):
-            print('###!!!TWO.5!!!###' if verbose else '')
-            reparsed = []
-            for particle in pinput:
-                els = particle.barycentric_equatorial_cartesian_elements
-                _ = [reparsed.append(els[i])
-                     for i in ['x_BaryEqu', 'y_BaryEqu', 'z_BaryEqu',
-                               'dx_BaryEqu', 'dy_BaryEqu', 'dz_BaryEqu']]
-            reparsed = np.array(reparsed)
-        else:
-            reparsed = np.array(pinput)
-    elif isinstance(pinput, np.ndarray):
-        if (len(np.shape(pinput)) == 1) & (len(pinput) % 6 == 0):
-            print('###!!!THREE!!!###' if verbose else '')
-            reparsed = pinput
-    else:
-        raise(TypeError('"pinput" not understood.\n'
-                        'Must be ParseElements object, '
-                        'list of ParseElements or numpy array.'))
+    with stage('input_reshaping'):
+        if isinstance(pinput, parse_input.ParseElements):
+            pinput = pinput.barycentric_equatorial_state.copy()
+        elif isinstance(pinput, (list, tuple)) and len(pinput) and isinstance(
+                pinput[0], parse_input.ParseElements):
+            pinput = np.concatenate([particle.barycentric_equatorial_state
+                                     for particle in pinput])
+        elif isinstance(pinput, (list, tuple)):
+            try:
+                pinput = np.asarray(pinput, dtype=float)
+            except ValueError as error:  # Ragged, or not numbers
+                raise TypeError('Input elements must be a (6N,) or (N, 6) '
+                                f'list of numbers: {error}') from error
+        elif not isinstance(pinput, np.ndarray):
+            raise TypeError('"pinput" not understood.\n'
+                            'Must be ParseElements object, '
+                            'list of ParseElements or numpy array.')
+        if pinput.dtype.names is not None:
+            names = list(parse_input.BARY_EQU_DTYPE.names)
+            if not set(names) <= set(pinput.dtype.names):
+                raise TypeError('Structured input must have the fields '
+                                f'{names:} (barycentric equatorial).')
+            # A view, if the fields are laid out like BARY_EQU_DTYPE
+            pinput = structured_to_unstructured(pinput[names], dtype=float,
+                                                copy=False)
+        if pinput.dtype.kind not in 'fiu':
+            raise TypeError('Input elements must be numbers, not '
+                            f'{pinput.dtype}.')
+        if not (((pinput.ndim == 1) & (pinput.size % 6 == 0)) |
+                ((pinput.ndim == 2) & (pinput.shape[-1] == 6))):
+            raise TypeError('Input elements must have shape (6N,) or (N, 6), '
+                            f'not {pinput.shape}.')
+        reparsed = np.ascontiguousarray(pinput,
+                                        dtype=np.float64).reshape(-1)
+    if verbose:
+        print(f'Input: {len(reparsed) // 6:} particles.')
     return reparsed, len(reparsed) // 6
 
 # End
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+# mpc_nbody/mpc_nbody/orbit_cheby.py
+
+'''
+----------------------------------------------------------------------------
+mpc_nbody's module for compressing n-body output into Chebyshev polynomials.
+
+This module provides functionalities to
+(a) fit per-object, per-time-window Chebyshev coefficients to the
+    output_times/output_vectors of an integration, within a tolerance
+(b) store them compactly in arrays (and save/load them with numpy)
+(c) evaluate positions & velocities for many (object, time) pairs at once
+
+This replaces keeping the dense sub-step output of the integrator around.
+----------------------------------------------------------------------------
+'''
+
+# Import third-party packages
+# -----------------------------------------------------------------------------
+import numpy as np
+
+# Import neighbouring packages
+# -----------------------------------------------------------------------------
+
+# Default for caching stuff using lru_cache
+# -----------------------------------------------------------------------------
+
+# Constants and stuff
+# -----------------------------------------------------------------------------
+
+
+# Data classes/methods
+# -----------------------------------------------------------------------------
+
+class ChebyshevEphemeris():
+    '''
+    Piecewise Chebyshev representation of the positions of many objects.
+
+    All objects share the same equal-length time windows, starting at
+    tstart; coeffs has shape (n_objects, n_windows, 3, degree + 1).
+    Velocities are the derivatives of the position polynomials.
+    Windows without any output times (gaps in irregular output) are not
+    fitted; their coefficients are NaN, so evaluating there gives NaN.
+    position_error is measured at output times held out of the fit, so it
+    also bounds the error between the fitted times.
+
+    Use ChebyshevEphemeris.fit to make one from integration output,
+    evaluate to use it, and save/load to store it.
+    '''
+
+    def __init__(self, tstart, window, coeffs, position_error=np.nan):
+        self.tstart = float(tstart)
+        self.window = float(window)
+        self.coeffs = np.ascontiguousarray(coeffs, dtype=float)
+        self.position_error = position_error
+
+    @property
+    def n_objects(self):
+        return self.coeffs.shape[0]
+
+    @property
+    def n_windows(self):
+        return self.coeffs.shape[1]
+
+    @property
+    def degree(self):
+        return self.coeffs.shape[3] - 1
+
+    @property
+    def tend(self):
+        return self.tstart + self.window * self.n_windows
+
+    @classmethod
+    def fit(cls, times, vectors, tolerance=1e-10, degree=11, window=None,
+            max_halvings=10):
+        '''
+        Fit Chebyshev polynomials to integration output.
+
+        Inputs:
+        -------
+        times : numpy array (n_times), output times, increasing (or
+                decreasing, as from a backward integration).
+        vectors : array (n_times, n_objects, 6), output elements. A lazy
+                  view onto an OutputStore works too; it is read one
+                  window at a time (all at once if times decrease).
+        tolerance : float, maximum allowed position error [au] at the
+                    output times. Every other output time in a window is
+                    held out of its fit, to check the error in between.
+        degree : integer, maximum degree of the polynomials. In windows
+                 with few output times a lower degree is used, so that
+                 there are always more fitted times than coefficients.
+        window : float, initial window length [days] (default: all times).
+        max_halvings : integer, how many times the window length may be
+                       halved to reach the tolerance.
+
+        Returns:
+        --------
+        ChebyshevEphemeris, with the achieved maximum error in
+        position_error.
+        '''
+        times = np.asarray(times, dtype=float)
+        if np.any(np.diff(times) < 0):
+            order = np.argsort(times, kind='stable')
+            times, vectors = times[order], np.asarray(vectors)[order]
+        if window is None:
+            window = times[-1] - times[0]
+        for _ in range(max_halvings + 1):
+            coeffs, error = _fit_windows(times, vectors, window, degree)
+            if error <= tolerance:
+                return cls(times[0], window, coeffs, error)
+            window /= 2.
+        raise ValueError(f"Could not reach a tolerance of {tolerance:} au, "
+                         f"got {error:} au.")
+
+    def evaluate(self, object_ids, times, velocity=False):
+        '''
+        Positions (and velocities) for many (object, time) pairs at once.
+
+        Inputs:
+        -------
+        object_ids : integer or integer array, indices of the objects.
+        times : float or array, times; broadcast against object_ids.
+        velocity : boolean, also return velocities.
+
+        Returns:
+        --------
+        positions : numpy array (..., 3), NaN for times outside the fit
+                    (or in a window without output times).
+        velocities : numpy array (..., 3), only if velocity=True.
+        '''
+        object_ids, times = np.broadcast_arrays(np.asarray(object_ids),
+                                                np.asarray(times, dtype=float))
+        shape = times.shape
+        object_ids, times = object_ids.reshape(-1), times.reshape(-1)
+        scaled = (times - self.tstart) / self.window
+        windows = np.clip(np.floor(scaled).astype(int), 0,
+                          self.n_windows - 1)
+        x = 2. * (scaled - windows) - 1.
+        T, dT = _chebyshev_basis(x, self.degree, derivative=velocity)
+        coeffs = self.coeffs[object_ids, windows]
+        outside = (times < self.tstart) | (times > self.tend)
+        positions = np.einsum('njk,kn->nj', coeffs, T)
+        positions[outside] = np.nan
+        if not velocity:
+            return positions.reshape(shape + (3,))
+        velocities = np.einsum('njk,kn->nj', coeffs, dT) * 2. / self.window
+        velocities[outside] = np.nan
+        return positions.reshape(shape + (3,)), velocities.reshape(shape +
+                                                                   (3,))
+
+    def save(self, filename):
+        '''Save to a numpy .npz file.'''
+        np.savez(filename, tstart=self.tstart, window=self.window,
+                 coeffs=self.coeffs, position_error=self.position_error)
+
+    @classmethod
+    def load(cls, filename):
+        '''Load from a numpy .npz file written by save.'''
+        with np.load(filename) as data:
+            return cls(float(data['tstart']), float(data['window']),
+                       data['coeffs'], float(data['position_error']))
+
+
+# Functions
+# -----------------------------------------------------------------------------
+
+def _fit_windows(times, vectors, window, degree):
+    '''
+    Least-squares fit of positions & velocities in each window, all objects
+    and coordinates at once, to every other output time in the window.
+    Returns the (n_objects, n_windows, 3, degree + 1) coefficients and the
+    maximum position residual, including at the held-out times (infinite
+    if a window has too few output times to check). Windows without
+    output times get NaN coefficients.
+    Not intended for user usage.
+    '''
+    n_windows = max(int(np.ceil((times[-1] - times[0]) / window -
+                                1e-9)), 1)
+    n_objects = np.shape(vectors)[1]
+    coeffs = np.zeros((n_objects, n_windows, 3, degree + 1))
+    max_error = 0.
+    for i in range(n_windows):
+        start = times[0] + i * window
+        indices = np.flatnonzero((times >= start) &
+                                 (times <= start + window))
+        if len(indices) == 0:  # A gap in the output: nothing to fit
+            coeffs[:, i] = np.nan
+            continue
+        if len(indices) < 3:  # Cannot both fit and check the fit
+            coeffs[:, i] = np.nan
+            max_error = np.inf
+            continue
+        fitted = indices[::2]
+        # More fitted times than coefficients, so the fit cannot just pass
+        # through the samples.
+        n_coeffs = min(degree + 1, len(fitted) - 1)
+        x = 2. * (times[indices] - start) / window - 1.
+        T, dT = _chebyshev_basis(x, n_coeffs - 1)
+        xyzv = np.asarray(vectors[indices])
+        # Velocity equations are scaled to position units over the window.
+        A = np.concatenate([T[:, ::2].T, dT[:, ::2].T])
+        b = np.concatenate([xyzv[::2, :, :3],
+                            xyzv[::2, :, 3:] * window / 2.]
+                           ).reshape(2 * len(fitted), -1)
+        solution = np.linalg.lstsq(A, b, rcond=None)[0]
+        coeffs[:, i, :, :n_coeffs] = solution.reshape(
+            n_coeffs, n_objects, 3).transpose(1, 2, 0)
+        residual = T.T @ solution - xyzv[..., :3].reshape(len(indices), -1)
+        max_error = max(max_error, np.max(np.abs(residual)))
+    return coeffs, max_error
+
+
+def _chebyshev_basis(x, degree, derivative=True):
+    '''
+    Chebyshev polynomials T_k(x), k = 0..degree, as a (degree + 1, len(x))
+    array, and their derivatives (or None), by recurrence.
+    Not intended for user usage.
+    '''
+    T = np.empty((degree + 1, len(x)))
+    T[0] = 1.
+    if degree > 0:
+        T[1] = x
+    for k in range(2, degree + 1):
+        T[k] = 2. * x * T[k - 1] - T[k - 2]
+    if not derivative:
+        return T, None
+    dT = np.empty((degree + 1, len(x)))
+    dT[0] = 0.
+    if degree > 0:
+        dT[1] = 1.
+    for k in range(2, degree + 1):
+        dT[k] = 2. * T[k - 1] + 2. * x * dT[k - 1] - dT[k - 2]
+    return T, dT
+
+
+# End
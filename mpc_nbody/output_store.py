@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+# mpc_nbody/mpc_nbody/output_store.py
+
+'''
+----------------------------------------------------------------------------
+mpc_nbody's module for disk-backed storage of n-body integration outputs.
+
+This module provides functionalities to
+(a) write integration outputs to disk, chunked by time window and
+    particle block, as they are produced
+(b) re-open such a store later
+(c) view the whole output as a lazy (n_times, n_particles, 6) array,
+    so that slicing one object or one time range only reads those chunks
+(d) give the last output state, to continue (or resume) the integration
+
+The store is a directory with a store.json description, one times_*.npy
+file per time window and one vectors_*_*.npy file per window and block.
+----------------------------------------------------------------------------
+'''
+
+# Import third-party packages
+# -----------------------------------------------------------------------------
+import os
+import json
+import numpy as np
+
+# Import neighbouring packages
+# -----------------------------------------------------------------------------
+from mpc_nbody.metrics import stage, count
+
+# Default for caching stuff using lru_cache
+# -----------------------------------------------------------------------------
+
+# Constants and stuff
+# -----------------------------------------------------------------------------
+STORE_VERSION = 1
+STORE_META = 'store.json'
+
+
+# Data classes/methods
+# -----------------------------------------------------------------------------
+
+class OutputStore():
+    '''
+    Disk-backed store of integration outputs, chunked by time window and
+    particle block.
+
+    Inputs:
+    -------
+    store_dir : string, directory of the store (created if needed).
+    time_window : float, length of each integration window [days].
+    particle_block : integer, number of particles per stored block.
+
+    If store_dir already holds a store, it is re-opened and the other
+    arguments are ignored.
+    '''
+
+    def __init__(self, store_dir, time_window=3650., particle_block=1000):
+        self.store_dir = store_dir
+        meta_file = os.path.join(store_dir, STORE_META)
+        if os.path.exists(meta_file):
+            with open(meta_file) as infile:
+                self.meta = json.load(infile)
+        else:
+            os.makedirs(store_dir, exist_ok=True)
+            self.meta = {'version': STORE_VERSION,
+                         'time_window': float(time_window),
+                         'particle_block': int(particle_block),
+                         'n_particles': None, 'input_vectors': None,
+                         'time_parameters': None, 'window_n_times': []}
+        self._times = None
+
+    @property
+    def time_window(self):
+        return self.meta['time_window']
+
+    @property
+    def particle_block(self):
+        return self.meta['particle_block']
+
+    @property
+    def n_particles(self):
+        return self.meta['n_particles']
+
+    @property
+    def n_windows(self):
+        return len(self.meta['window_n_times'])
+
+    @property
+    def n_times(self):
+        return int(np.sum(self.meta['window_n_times'], dtype=int))
+
+    def start(self, input_vectors, n_particles, time_parameters):
+        '''Empty the store and record the parameters of a new run.'''
+        for window in range(self.n_windows):
+            os.remove(self._times_file(window))
+            for block in range(self._n_blocks()):
+                os.remove(self._vectors_file(window, block))
+        self.meta.update({'n_particles': int(n_particles),
+                          'input_vectors': [float(x) for x in
+                                            np.reshape(input_vectors, -1)],
+                          'time_parameters': [float(t) for t in
+                                              time_parameters],
+                          'window_n_times': []})
+        self._times = None
+        self._save_meta()
+
+    def append_window(self, times, vectors):
+        '''
+        Write one time window of output, vectors of shape
+        (n_times, n_particles, 6), splitting it into particle blocks.
+        '''
+        window = self.n_windows
+        files = [self._times_file(window)] + [
+            self._vectors_file(window, block)
+            for block in range(self._n_blocks())]
+        with stage('output_write'):
+            np.save(files[0], np.asarray(times, dtype=float))
+            for block, vectors_file in enumerate(files[1:]):
+                np.save(vectors_file,
+                        vectors[:, block * self.particle_block:
+                                (block + 1) * self.particle_block])
+        count('bytes_written', sum(os.path.getsize(name) for name in files))
+        self.meta['window_n_times'].append(len(times))
+        self._times = None
+        self._save_meta()
+
+    def set_time_parameters(self, time_parameters):
+        '''Record new [tstart, tstep, trange], e.g. after extending a run.'''
+        self.meta['time_parameters'] = [float(t) for t in time_parameters]
+        self._save_meta()
+
+    def last_state(self):
+        '''
+        Time & (n_particles, 6) vectors of the last output, the checkpoint
+        from which to continue the integration; None if there is no output.
+        '''
+        if self.n_times == 0:
+            return None
+        return self.times()[-1], self.read([self.n_times - 1],
+                                           np.arange(self.n_particles))[0]
+
+    def times(self):
+        '''All the output times, as one (small) in-memory array.'''
+        if self._times is None:
+            self._times = np.concatenate(
+                [np.load(self._times_file(window))
+                 for window in range(self.n_windows)]
+                ) if self.n_windows else np.empty(0)
+        return self._times
+
+    def vectors(self):
+        '''Lazy (n_times, n_particles, 6) view of all the output vectors.'''
+        return ChunkedOutputVectors(self)
+
+    def object_output(self, particle, tmin=None, tmax=None):
+        '''
+        Times & (n_times, 6) vectors of one particle, optionally restricted
+        to tmin <= time <= tmax, reading only the chunks needed.
+        '''
+        times = self.times()
+        keep = np.ones(len(times), dtype=bool)
+        if tmin is not None:
+            keep &= times >= tmin
+        if tmax is not None:
+            keep &= times <= tmax
+        time_indices = np.flatnonzero(keep)
+        return times[time_indices], self.vectors()[time_indices, particle]
+
+    def read(self, time_indices, particle_indices):
+        '''
+        Read the vectors for integer arrays of time & particle indices,
+        returning an array of shape (len(time_indices),
+        len(particle_indices), 6). Only the chunks involved are opened,
+        memory-mapped, so only the requested bytes are read.
+        '''
+        out = np.empty((len(time_indices), len(particle_indices), 6))
+        window_starts = np.cumsum([0] + self.meta['window_n_times'])
+        windows = np.searchsorted(window_starts, time_indices, 'right') - 1
+        blocks = np.asarray(particle_indices) // self.particle_block
+        for window in np.unique(windows):
+            t_select = np.flatnonzero(windows == window)
+            local_t = np.asarray(time_indices)[t_select] - \
+                window_starts[window]
+            for block in np.unique(blocks):
+                p_select = np.flatnonzero(blocks == block)
+                local_p = (np.asarray(particle_indices)[p_select] -
+                           block * self.particle_block)
+                chunk = np.load(self._vectors_file(window, block),
+                                mmap_mode='r')
+                out[np.ix_(t_select, p_select)] = chunk[np.ix_(local_t,
+                                                               local_p)]
+        return out
+
+    def _n_blocks(self):
+        if self.n_particles is None:
+            return 0
+        return -(-self.n_particles // self.particle_block)
+
+    def _times_file(self, window):
+        return os.path.join(self.store_dir, f'times_{window:05d}.npy')
+
+    def _vectors_file(self, window, block):
+        return os.path.join(self.store_dir,
+                            f'vectors_{window:05d}_{block:05d}.npy')
+
+    def _save_meta(self):
+        '''Write the description atomically, so a crash can't corrupt it.'''
+        meta_file = os.path.join(self.store_dir, STORE_META)
+        with open(meta_file + '.tmp', 'w') as outfile:
+            json.dump(self.meta, outfile)
+        os.replace(meta_file + '.tmp', meta_file)
+
+
+class ChunkedOutputVectors():
+    '''
+    Lazy, read-only (n_times, n_particles, 6) array view onto an
+    OutputStore. Indexing with integers, slices or integer arrays on the
+    first two axes only reads the chunks involved. Two integer arrays
+    select all their combinations (like np.ix_), not point-wise pairs.
+    np.asarray(view) reads everything.
+    '''
+
+    def __init__(self, store):
+        self.store = store
+
+    @property
+    def shape(self):
+        return (self.store.n_times, self.store.n_particles, 6)
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def dtype(self):
+        return np.dtype(float)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        time_indices = np.arange(self.shape[0])[key[0]]
+        particle_indices = np.arange(self.shape[1])[key[1]]
+        out = self.store.read(np.atleast_1d(time_indices),
+                              np.atleast_1d(particle_indices))
+        # Drop the axes that were indexed with a scalar, like numpy does
+        out = out[(0 if np.ndim(time_indices) == 0 else slice(None),
+                   0 if np.ndim(particle_indices) == 0 else slice(None))]
+        return out[..., key[2]]
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[:, :, :]
+        return out if dtype is None else out.astype(dtype)
+
+
+# End
@@ -3,7 +3,7 @@
 
 '''
 ----------------------------------------------------------------------------
-mpc_nbody's module for parsing OrbFit + ele220 elements
+mpc_nbody's module for parsing OrbFit + ele220 + MPCORB elements
 
 Mar 2020
 Mike Alexandersen & Matthew Payne & Matthew Holman
@@ -11,7 +11,10 @@ Mike Alexandersen & Matthew Payne & Matthew Holman
 This module provides functionalities to
 (a) read an OrbFit .fel/.eq file with heliocentric ecliptic cartesian els
 (b) read ele220 element strings
-(c) convert the above to barycentric equatorial cartesian elements
+(c) read MPCORB-format files (Keplerian elements) into columnar arrays
+(d) convert the above to barycentric equatorial cartesian elements
+(e) write & read initial conditions files for the n-body integrator, for
+    one object (holman_ic) or many (ICWriter & read_initial_conditions)
 
 This is meant to prepare the elements for input into the n-body integrator
 ----------------------------------------------------------------------------
@@ -20,20 +23,176 @@ This is meant to prepare the elements for input into the n-body integrator
 # Import third-party packages
 # -----------------------------------------------------------------------------
 import os
+from collections import OrderedDict
+from collections.abc import Mapping
+from functools import lru_cache
 import numpy as np
-from astropy.time import Time
-from mpcpp import MPC_library as mpc
+# astropy.time and mpcpp.MPC_library (which loads the JPL kernel) are slow
+# to import, so they are only imported when first needed (see _mpc_library
+# and the local astropy imports below).
 
 # Import neighbouring packages
 # -----------------------------------------------------------------------------
+from mpc_nbody.conversions import keplerian_to_cartesian
+from mpc_nbody.cache import default_cache, file_digest, make_key
+from mpc_nbody.metrics import stage
 
 # Default for caching stuff using lru_cache
 # -----------------------------------------------------------------------------
 
+@lru_cache(maxsize=1)
+def _mpc_library():
+    '''Import mpcpp.MPC_library (and so the JPL kernel) on first use.'''
+    from mpcpp import MPC_library
+    return MPC_library
+
+
+@lru_cache(maxsize=4)
+def _element_keys(frame):
+    '''
+    The dictionary keys used for elements in the given frame ('HelioEcl' or
+    'BaryEqu'), e.g. 'x_BaryEqu' or 'sigma_dx_HelioEcl', mapped to
+    (index into the state, None) or to (row, column) of the covariance.
+    '''
+    keys = OrderedDict((f'{coord}_{frame}', (i, None))
+                       for i, coord in enumerate(ELEMENT_COORDS))
+    for i, j in zip(*COV_INDICES):
+        name = (f'sigma_{ELEMENT_COORDS[i]}' if i == j else
+                f'{ELEMENT_COORDS[i]}_{ELEMENT_COORDS[j]}')
+        keys[f'{name}_{frame}'] = (i, j)
+    return keys
+
+
+@lru_cache(maxsize=2)
+def _ecliptic_rotation_matrix(direction=+1):
+    '''
+    Rotation matrix from mean ecliptic to mean equatorial (direction=+1)
+    or back again (direction=-1). Built once per direction and cached.
+    '''
+    mpc = _mpc_library()
+    rotation_matrix = np.array(mpc.rotate_matrix(mpc.Constants.ecl *
+                                                 direction), dtype=float)
+    rotation_matrix.flags.writeable = False
+    return rotation_matrix
+
+
 # Constants and stuff
 # -----------------------------------------------------------------------------
 DATA_PATH = os.path.realpath(os.path.dirname(__file__))
 au_km = 149597870.700  # This is now a definition
+CART_HEAD = '! Cartesian position and velocity vectors'
+# One row per object for batch-parsed OrbFit files: designation, epoch
+# (MJD, TT), heliocentric ecliptic x, y, z, dx, dy, dz and the 21 upper
+# triangle covariance terms in the order OrbFit writes them.
+COV_INDICES = np.triu_indices(6)  # Row-major upper triangle, as in OrbFit
+ELEMENT_COORDS = ['x', 'y', 'z', 'dx', 'dy', 'dz']
+ORBFIT_DTYPE = np.dtype([('designation', 'U16'),
+                         ('mjd_tt', 'f8'),
+                         ('state', 'f8', (6,)),
+                         ('covariance', 'f8', (21,))])
+# One row per object for MPCORB-format files: packed designation, H, G,
+# epoch (MJD, TT) and Keplerian elements a [au], e, i, node, argument of
+# perihelion, mean anomaly [radians], heliocentric ecliptic J2000.
+MPCORB_DTYPE = np.dtype([('designation', 'U7'),
+                         ('H', 'f8'),
+                         ('G', 'f8'),
+                         ('mjd_tt', 'f8'),
+                         ('keplerian', 'f8', (6,))])
+# Fixed-width MPCORB columns (0-based start, end) as documented by the MPC
+MPCORB_COLUMNS = {'designation': (0, 7), 'H': (8, 13), 'G': (14, 19),
+                  'epoch': (20, 25), 'mean_anomaly': (26, 35),
+                  'peri': (37, 46), 'node': (48, 57), 'incl': (59, 68),
+                  'e': (70, 79), 'a': (92, 103)}
+MPCORB_MIN_LENGTH = 103  # Shortest line holding all the elements
+# Packed MPC dates: digits, then A=10 ... V=31; centuries I=18, J=19, K=20.
+_PACKED_DIGITS = np.full(256, -1, dtype=int)
+_PACKED_DIGITS[np.frombuffer(b'0123456789ABCDEFGHIJKLMNOPQRSTUV',
+                             dtype=np.uint8)] = np.arange(32)
+# Structured batch of barycentric equatorial states, one row per object,
+# as accepted by mpc_nbody.run_nbody (fields named like the dict keys).
+BARY_EQU_DTYPE = np.dtype([(f'{coord}_BaryEqu', 'f8')
+                           for coord in ELEMENT_COORDS])
+# Leading terms of the Fairhead & Bretagnon (1990) series for TDB - TT at
+# the geocentre, as in ERFA's dtdb: (power of t, amplitude [s],
+# frequency [rad / Julian millennium], phase [rad]), with t in Julian
+# millennia from J2000. Truncated to stay within 1 microsecond for
+# 1900-2100.
+TDB_TT_SERIES = np.array([
+    (0, 1656.674564e-6, 6283.075849991, 6.240054195),
+    (0, 22.417471e-6, 5753.384884897, 4.296977442),
+    (0, 13.839792e-6, 12566.151699983, 6.196904410),
+    (0, 4.770086e-6, 529.690965095, 0.444401603),
+    (0, 4.676740e-6, 6069.776754553, 4.021195093),
+    (0, 2.256707e-6, 213.299095438, 5.543113262),
+    (0, 1.694205e-6, -3.523118349, 5.025132748),
+    (0, 1.554905e-6, 77713.771467920, 5.198467090),
+    (0, 1.276839e-6, 7860.419392439, 5.988822341),
+    (0, 1.193379e-6, 5223.693919802, 3.649823730),
+    (0, 1.115322e-6, 3930.209696220, 1.422745069),
+    (0, 0.794185e-6, 11506.769769794, 2.322313077),
+    (0, 0.447061e-6, 26.298319800, 3.615796498),
+    (0, 0.435206e-6, -398.149003408, 4.349338347),
+    (0, 0.600309e-6, 1577.343542448, 2.678271909),
+    (0, 0.496817e-6, 6208.294251424, 5.696701824),
+    (0, 0.486306e-6, 5884.926846583, 0.520007179),
+    (0, 0.432392e-6, 74.781598567, 2.435898309),
+    (0, 0.468597e-6, 6244.942814354, 5.866398759),
+    (0, 0.375510e-6, 5507.553238667, 4.103476804),
+    (0, 0.243085e-6, -775.522611324, 3.651837925),
+    (0, 0.173435e-6, 18849.227549974, 6.153743485),
+    (0, 0.230685e-6, 5856.477659115, 4.773852582),
+    (0, 0.203747e-6, 12036.460734888, 4.333987818),
+    (0, 0.143935e-6, -796.298006816, 5.957517795),
+    (0, 0.159080e-6, 10977.078804699, 1.890075226),
+    (0, 0.119979e-6, 38.133035638, 4.551585768),
+    (0, 0.118971e-6, 5486.777843175, 1.914547226),
+    (0, 0.116120e-6, 1059.381930189, 0.873504123),
+    (0, 0.137927e-6, 11790.629088659, 1.135934669),
+    (0, 0.098358e-6, 2544.314419883, 0.092793886),
+    (0, 0.101868e-6, -5573.142801634, 5.984503847),
+    (0, 0.080164e-6, 206.185548437, 2.095377709),
+    (0, 0.079645e-6, 4694.002954708, 2.949233637),
+    (0, 0.062617e-6, 20.775395492, 2.654394814),
+    (0, 0.075019e-6, 2942.463423292, 4.980931759),
+    (0, 0.064397e-6, 5746.271337896, 1.280308748),
+    (0, 0.063814e-6, 5760.498431898, 4.167901731),
+    (0, 0.048042e-6, 2146.165416475, 1.495846011),
+    (0, 0.048373e-6, 155.420399434, 2.251573730),
+    (1, 102.156724e-6, 6283.075849991, 4.249032005),
+    (1, 1.706807e-6, 12566.151699983, 4.205904248),
+    (1, 0.269668e-6, 213.299095438, 3.400290479),
+    (1, 0.265919e-6, 529.690965095, 5.836047367),
+    (1, 0.210568e-6, -3.523118349, 6.262738348),
+    (1, 0.077996e-6, 5223.693919802, 4.670344204),
+    (2, 4.322990e-6, 6283.075849991, 2.642893748),
+    (2, 0.406495e-6, 0.000000000, 4.712388980),
+    (2, 0.122605e-6, 12566.151699983, 2.438140634),
+    ])
+# (amplitude, frequency, phase) arrays for each power of t
+_TDB_TT_TERMS = [TDB_TT_SERIES[TDB_TT_SERIES[:, 0] == power, 1:].T
+                 for power in range(3)]
+PARSE_CACHE_VERSION = 1  # Increase when parsing/conversion results change
+CACHED_ATTRIBUTES = ('heliocentric_ecliptic_state',
+                     'heliocentric_ecliptic_covariance',
+                     'barycentric_equatorial_state',
+                     'barycentric_equatorial_covariance',
+                     'heliocentric_ecliptic_keplerian',
+                     'epoch_mjd_tt', 'epoch_jd_tdb')
+# Multi-object initial conditions files: a header with the integration
+# parameters, then one fixed-width row per object: designation, epoch
+# (JD, TDB), barycentric equatorial state and, optionally, the upper
+# triangle of its covariance.
+IC_HEADER = '#mpc_nbody initial conditions, version 1'
+IC_DESIGNATION_WIDTH = 16
+# Enough digits to round-trip float64, and room for 3-digit exponents
+IC_FLOAT_FORMAT = ' %24.16e'
+IC_FLOAT_WIDTH = 25
+IC_DTYPE = np.dtype([('designation', f'U{IC_DESIGNATION_WIDTH:}'),
+                     ('jd_tdb', 'f8'),
+                     ('state', 'f8', (6,)),
+                     ('covariance', 'f8', (6, 6))])
+MJD_JD_OFFSET = 2400000.5
+J2000_JD = 2451545.0
 
 # Data classes/methods
 # -----------------------------------------------------------------------------
@@ -42,44 +201,144 @@ au_km = 149597870.700  # This is now a definition
 class ParseElements():
     '''
     Class for parsing elements and returning them in the correct format.
+
+    Each object only holds float64 arrays: the state vectors (length 6)
+    and covariances (6x6) in heliocentric ecliptic and barycentric
+    equatorial coordinates, and its epoch. The heliocentric_ecliptic_ and
+    barycentric_equatorial_cartesian_elements dictionaries are read-only
+    ElementsView mappings onto those arrays.
+
+    Parsed & converted results can be kept in a DiskCache (cache argument),
+    keyed on the contents of the input file: None means the default cache,
+    which is only used if the MPC_NBODY_CACHE_DIR environment variable is
+    set, False means no cache.
     '''
+    __slots__ = ('heliocentric_ecliptic_state',
+                 'heliocentric_ecliptic_covariance',
+                 'barycentric_equatorial_state',
+                 'barycentric_equatorial_covariance',
+                 'heliocentric_ecliptic_keplerian',
+                 'epoch_mjd_tt', 'epoch_jd_tdb', 'tstart', '_time')
 
-    def __init__(self, input_file=None, filetype=None, save_parsed=True):
+    def __init__(self, input_file=None, filetype=None, save_parsed=True,
+                 cache=None):
         #If input filename provided, process it:
         if isinstance(input_file, str) & isinstance(filetype, str):
-            if filetype == 'ele220':
-                self.parse_ele220(input_file)
-            if (filetype == 'fel') | (filetype == 'eq'):
-                self.parse_orbfit(input_file)
-            self.make_bary_equatorial()
+            if cache is None:
+                cache = default_cache('parse')
+            if cache:
+                key = make_key(file_digest(input_file), filetype,
+                               str(PARSE_CACHE_VERSION),
+                               sun_offset_cache.source())
+            if not (cache and self._from_cache(cache.get(key))):
+                if filetype == 'ele220':
+                    self.parse_ele220(input_file)
+                if filetype == 'mpcorb':
+                    self.parse_mpcorb(input_file)
+                if (filetype == 'fel') | (filetype == 'eq'):
+                    self.parse_orbfit(input_file)
+                self.make_bary_equatorial()
+                if cache:
+                    cache.put(key, self._to_cache())
             if save_parsed:
                 self.save_elements()
         else:
             print("Keywords 'input_file' and/or 'filetype' missing; "
                   "initiating empty object.")
 
-    def save_elements(self, output_file='holman_ic'):
+    def _to_cache(self):
+        '''The parsed & converted arrays, for storing in a DiskCache.'''
+        arrays = {name: getattr(self, name) for name in CACHED_ATTRIBUTES
+                  if getattr(self, name, None) is not None}
+        if arrays.get('epoch_mjd_tt') is None:
+            arrays['epoch_mjd_tt'] = np.nan
+        return arrays
+
+    def _from_cache(self, arrays):
+        '''Set the attributes from DiskCache arrays; False if there are none.'''
+        if arrays is None:
+            return False
+        for name in CACHED_ATTRIBUTES:
+            if name in arrays:
+                setattr(self, name, arrays[name])
+        self.epoch_jd_tdb = float(self.epoch_jd_tdb)
+        self.epoch_mjd_tt = (None if np.isnan(self.epoch_mjd_tt) else
+                             float(self.epoch_mjd_tt))
+        self._time = None
+        return True
+
+    @property
+    def time(self):
+        '''
+        The epoch as an astropy Time (built on first use).
+        The parser itself only keeps floats: epoch_jd_tdb and, for OrbFit
+        input, epoch_mjd_tt.
+        '''
+        if getattr(self, '_time', None) is None:
+            from astropy.time import Time
+            if getattr(self, 'epoch_mjd_tt', None) is not None:
+                self._time = Time(self.epoch_mjd_tt, format='mjd', scale='tt')
+            else:
+                self._time = Time(self.epoch_jd_tdb, format='jd', scale='tdb')
+        return self._time
+
+    @time.setter
+    def time(self, value):
+        self._time = value
+        self.epoch_jd_tdb = value.tdb.jd
+        self.epoch_mjd_tt = None
+
+    @property
+    def heliocentric_ecliptic_cartesian_elements(self):
+        '''Read-only dictionary view, keys like 'x_HelioEcl'.'''
+        return ElementsView(self.heliocentric_ecliptic_state,
+                            getattr(self, 'heliocentric_ecliptic_covariance',
+                                    None), 'HelioEcl')
+
+    @heliocentric_ecliptic_cartesian_elements.setter
+    def heliocentric_ecliptic_cartesian_elements(self, elements):
+        (self.heliocentric_ecliptic_state,
+         self.heliocentric_ecliptic_covariance
+         ) = _arrays_from_elements(elements, 'HelioEcl')
+
+    @property
+    def barycentric_equatorial_cartesian_elements(self):
+        '''Read-only dictionary view, keys like 'x_BaryEqu'.'''
+        return ElementsView(self.barycentric_equatorial_state,
+                            getattr(self, 'barycentric_equatorial_covariance',
+                                    None), 'BaryEqu')
+
+    @barycentric_equatorial_cartesian_elements.setter
+    def barycentric_equatorial_cartesian_elements(self, elements):
+        (self.barycentric_equatorial_state,
+         self.barycentric_equatorial_covariance
+         ) = _arrays_from_elements(elements, 'BaryEqu')
+
+    def save_elements(self, output_file='holman_ic', tstep=20.0,
+                      trange=600.):
         """
         Save the barycentric equatorial cartesian elements to file.
 
         Inputs:
         -------
         output_file : string, filename to write elements to.
+        tstep, trange : floats, integration parameters written to the file.
 
-        The file is overwritten if it already exists.
+        The file is overwritten if it already exists; give each process its
+        own output_file. For many objects use ICWriter instead.
         """
-        self.tstart = self.time.tdb.jd
-        outfile = open(output_file, 'w')
-        outfile.write(f"tstart {self.tstart:}\n")
-        outfile.write("tstep +20.0\n")
-        outfile.write("trange 600.\n")
-        outfile.write("geocentric 0\n")
-        outfile.write("state\n")
+        self.tstart = self.epoch_jd_tdb
         els = self.barycentric_equatorial_cartesian_elements
-        for prefix in ['', 'd']:
-            for el in ['x_BaryEqu', 'y_BaryEqu', 'z_BaryEqu']:
-                outfile.write(f"{els[prefix + el]: 18.15e} ")
-            outfile.write("\n")
+        with open(output_file, 'w') as outfile:
+            outfile.write(f"tstart {self.tstart:}\n")
+            outfile.write(f"tstep {tstep:+}\n")
+            outfile.write(f"trange {np.format_float_positional(trange)}\n")
+            outfile.write("geocentric 0\n")
+            outfile.write("state\n")
+            for prefix in ['', 'd']:
+                for el in ['x_BaryEqu', 'y_BaryEqu', 'z_BaryEqu']:
+                    outfile.write(f"{els[prefix + el]: 18.15e} ")
+                outfile.write("\n")
 
     def parse_ele220(self, ele220file=None):
         '''
@@ -93,6 +352,25 @@ class ParseElements():
         (self.heliocentric_ecliptic_cartesian_elements, self.time
          ) = _get_junk_data('HelioEcl')
 
+    def parse_mpcorb(self, mpcorbfile=None):
+        '''
+        Parse the first orbit in an MPCORB-format file.
+        Sets heliocentric_ecliptic_keplerian (a, e, i, node, argument of
+        perihelion, mean anomaly; au & radians) and the epoch.
+        For many objects use parse_mpcorb_batch instead.
+        '''
+        if mpcorbfile is None:
+            raise TypeError("Required argument 'mpcorbfile'"
+                            " (pos 1) not found")
+        elements, _ = parse_mpcorb_batch(mpcorbfile)
+        if len(elements) == 0:
+            raise TypeError("There does not seem to be any valid elements "
+                            f"in the input file {mpcorbfile:}")
+        self.heliocentric_ecliptic_keplerian = elements['keplerian'][0]
+        self.epoch_mjd_tt = float(elements['mjd_tt'][0])
+        self.epoch_jd_tdb = float(mjd_tt_to_jd_tdb(self.epoch_mjd_tt))
+        self._time = None
+
     def parse_orbfit(self, felfile=None):
         '''
         Parse a file containing OrbFit elements for a single object & epoch.
@@ -109,49 +387,23 @@ class ParseElements():
         if felfile is None:
             raise TypeError("Required argument 'felfile' (pos 1) not found")
 
-        obj = {}
-        el = open(felfile).readlines()
-        cart_head = '! Cartesian position and velocity vectors\n'
-        cart = el.count(cart_head)
+        _, carEls = _read_orbfit_cartesian_block(felfile)
 
         # Only do this if the file actually has cartesian coordinates.
-        if cart > 0:
+        if carEls is not None:
             # get Cartesian Elements
-            carLoc = len(el) - 1 - list(reversed(el)).index(cart_head)
-            carEls = el[carLoc:carLoc + 25]
             (_, car_x, car_y, car_z, car_dx, car_dy, car_dz
              ) = carEls[1].split()
             _, mjd_tdt, _ = carEls[2].split()
-            # Using Astropy.time for time conversion,
-            # because life's too short for timezones and time scales.
-            self.time = Time(float(mjd_tdt), format='mjd', scale='tt')
-            obj.update({'x_HelioEcl': float(car_x),
-                        'dx_HelioEcl': float(car_dx),
-                        'y_HelioEcl': float(car_y),
-                        'dy_HelioEcl': float(car_dy),
-                        'z_HelioEcl': float(car_z),
-                        'dz_HelioEcl': float(car_dz)})
-            # Cartesian Covariance
-            (cart_err, sig_x, x_y, x_z, x_dx, x_dy, x_dz, sig_y, y_z, y_dx,
-             y_dy, y_dz, sig_z, z_dx, z_dy, z_dz, sig_dx, dx_dy, dx_dz,
-             sig_dy, dy_dz, sig_dz) = _parse_Covariance_List(carEls)
-            if cart_err == "":
-                obj.update({'sigma_x_HelioEcl': sig_x,
-                            'sigma_dx_HelioEcl': sig_dx,
-                            'sigma_y_HelioEcl': sig_y,
-                            'sigma_dy_HelioEcl': sig_dy,
-                            'sigma_z_HelioEcl': sig_z,
-                            'sigma_dz_HelioEcl': sig_dz}
-                           )
-                obj.update({'x_y_HelioEcl': x_y, 'x_z_HelioEcl': x_z,
-                            'x_dx_HelioEcl': x_dx, 'x_dy_HelioEcl': x_dy,
-                            'x_dz_HelioEcl': x_dz, 'y_z_HelioEcl': y_z,
-                            'y_dx_HelioEcl': y_dx, 'y_dy_HelioEcl': y_dy,
-                            'y_dz_HelioEcl': y_dz, 'z_dx_HelioEcl': z_dx,
-                            'z_dy_HelioEcl': z_dy, 'z_dz_HelioEcl': z_dz,
-                            'dx_dy_HelioEcl': dx_dy, 'dx_dz_HelioEcl': dx_dz,
-                            'dy_dz_HelioEcl': dy_dz})
-            self.heliocentric_ecliptic_cartesian_elements = obj
+            self.epoch_mjd_tt = float(mjd_tdt)
+            self.epoch_jd_tdb = float(mjd_tt_to_jd_tdb(self.epoch_mjd_tt))
+            self._time = None
+            self.heliocentric_ecliptic_state = np.array(
+                [car_x, car_y, car_z, car_dx, car_dy, car_dz], dtype=float)
+            # Cartesian Covariance (NaN if there is none)
+            cart_err, *upper_triangle = _parse_Covariance_List(carEls)
+            self.heliocentric_ecliptic_covariance = covariance_matrix(
+                upper_triangle if cart_err == "" else [np.nan] * 21)
         else:
             raise TypeError("There does not seem to be any valid elements "
                             f"in the input file {felfile:}")
@@ -161,53 +413,584 @@ class ParseElements():
         Convert whatever elements to barycentric equatorial cartesian.
         Currently only heliocentric-ecliptic-cartesian input implemented.
         '''
-        if hasattr(self, 'heliocentric_ecliptic_cartesian_elements'):
-            xyzv_hel_ecl = [self.heliocentric_ecliptic_cartesian_elements[key]
-                            for key in ['x_HelioEcl', 'y_HelioEcl',
-                                        'z_HelioEcl', 'dx_HelioEcl',
-                                        'dy_HelioEcl', 'dz_HelioEcl']]
-            xyzv_hel_equ = ecliptic_to_equatorial(xyzv_hel_ecl)
-            xyzv_bar_equ = equatorial_helio2bary(xyzv_hel_equ, self.time.tdb.jd)
-            obj = {}
-            obj.update({'x_BaryEqu': float(xyzv_bar_equ[0]),
-                        'y_BaryEqu': float(xyzv_bar_equ[1]),
-                        'z_BaryEqu': float(xyzv_bar_equ[2]),
-                        'dx_BaryEqu': float(xyzv_bar_equ[3]),
-                        'dy_BaryEqu': float(xyzv_bar_equ[4]),
-                        'dz_BaryEqu': float(xyzv_bar_equ[5])})
-            self.barycentric_equatorial_cartesian_elements = obj
-        elif 0:  # if different input format (keplerian?)
-            pass
+        if hasattr(self, 'heliocentric_ecliptic_state'):
+            xyzv_hel_equ = ecliptic_to_equatorial(
+                self.heliocentric_ecliptic_state)
+            self.barycentric_equatorial_state = equatorial_helio2bary(
+                xyzv_hel_equ, self.epoch_jd_tdb)
+            # The helio->bary shift does not change the covariance.
+            if getattr(self, 'heliocentric_ecliptic_covariance',
+                       None) is not None:
+                self.barycentric_equatorial_covariance = rotate_covariance(
+                    self.heliocentric_ecliptic_covariance)
+        elif hasattr(self, 'heliocentric_ecliptic_keplerian'):
+            self.heliocentric_ecliptic_state = keplerian_to_cartesian(
+                self.heliocentric_ecliptic_keplerian)
+            self.make_bary_equatorial()
         else:
             raise TypeError("There does not seem to be any valid elements")
 
 
+class ElementsView(Mapping):
+    '''
+    Read-only dictionary view of a state vector (and covariance matrix),
+    with the keys of the element dictionaries, e.g. 'x_BaryEqu' or
+    'sigma_dx_HelioEcl' (the diagonal covariance terms) and 'x_dy_HelioEcl'.
+    Values are floats. Covariance keys are only present if the covariance
+    is known (not NaN).
+    '''
+    __slots__ = ('state', 'covariance', 'frame')
+
+    def __init__(self, state, covariance=None, frame='BaryEqu'):
+        self.state = state
+        self.covariance = covariance
+        self.frame = frame
+
+    def _has_covariance(self):
+        return (self.covariance is not None) and not np.all(
+            np.isnan(self.covariance))
+
+    def __getitem__(self, key):
+        i, j = _element_keys(self.frame)[key]
+        if j is None:
+            return float(self.state[i])
+        if not self._has_covariance():
+            raise KeyError(key)
+        return float(self.covariance[i, j])
+
+    def __iter__(self):
+        keys = iter(_element_keys(self.frame))
+        if self._has_covariance():
+            return keys
+        return (key for key, _ in zip(keys, range(6)))
+
+    def __len__(self):
+        return 27 if self._has_covariance() else 6
+
+    def __repr__(self):
+        return f'{type(self).__name__}({dict(self)!r})'
+
+
+class SunOffsetCache():
+    '''
+    Cache of the barycentric position & velocity of the Sun, keyed on TDB
+    epoch, used by equatorial_helio2bary.
+
+    Epochs are looked up in a bounded LRU cache; all misses in a call are
+    evaluated with one JPL kernel call. Optionally (see build_table) epochs
+    inside a configurable span are instead served from a precomputed
+    Chebyshev table, which never touches the kernel.
+
+    The counters hits, misses, kernel_calls and table_evaluations show how
+    well it works. All but kernel_calls count requested epochs: misses are
+    the epochs evaluated with the kernel, the other requested epochs not
+    served by the table (also repeats within a call) are hits.
+    '''
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.table = None
+        self._cache = OrderedDict()
+        self.reset_counters()
+
+    def __call__(self, jd_tdb):
+        '''
+        Barycentric position [au] & velocity [au/day] of the Sun.
+        A scalar jd_tdb gives two length-3 arrays,
+        a length-N array of jd_tdb gives two (N, 3) arrays.
+        '''
+        jd_tdb = np.asarray(jd_tdb, dtype=float)
+        epochs = jd_tdb.reshape(-1)
+        delta = np.empty((len(epochs), 3))
+        delta_vel = np.empty((len(epochs), 3))
+        todo = np.ones(len(epochs), dtype=bool)
+        if self.table is not None:
+            todo = ~self.table.covers(epochs)
+            if not np.all(todo):
+                delta[~todo], delta_vel[~todo] = self.table(epochs[~todo])
+                self.table_evaluations += int(np.sum(~todo))
+        if np.any(todo):
+            unique_epochs, inverse = np.unique(epochs[todo],
+                                               return_inverse=True)
+            pos, vel, n_missing = self._lookup(unique_epochs)
+            delta[todo], delta_vel[todo] = pos[inverse], vel[inverse]
+            self.misses += n_missing
+            self.hits += int(np.sum(todo)) - n_missing
+        return (delta.reshape(jd_tdb.shape + (3,)),
+                delta_vel.reshape(jd_tdb.shape + (3,)))
+
+    def _lookup(self, epochs):
+        '''
+        Look up unique epochs in the LRU cache, evaluating all the misses
+        with a single kernel call. Returns the positions, velocities and
+        the number of misses.
+        '''
+        pos, vel = np.empty((len(epochs), 3)), np.empty((len(epochs), 3))
+        missing = []
+        for i, epoch in enumerate(epochs):
+            cached = self._cache.get(epoch)
+            if cached is None:
+                missing.append(i)
+            else:
+                self._cache.move_to_end(epoch)
+                pos[i], vel[i] = cached
+        if missing:
+            self.kernel_calls += 1
+            pos[missing], vel[missing] = _kernel_sun_offset(epochs[missing])
+            for i in missing:
+                self._cache[epochs[i]] = (pos[i].copy(), vel[i].copy())
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return pos, vel, len(missing)
+
+    def build_table(self, jd_start, jd_end, segment_days=32., degree=13,
+                    tolerance=1e-14, velocity_tolerance=None):
+        '''
+        Precompute a Chebyshev table of the Sun offset between jd_start and
+        jd_end (TDB). Segments are halved until the position & velocity
+        errors, checked against the kernel half-way between fitting nodes,
+        are below tolerance [au] & velocity_tolerance [au/day] (default:
+        the same number as tolerance). The achieved errors are stored as
+        self.table.position_error & self.table.velocity_error.
+        '''
+        self.table = SunOffsetTable(jd_start, jd_end, segment_days, degree,
+                                    tolerance, velocity_tolerance)
+        return self.table
+
+    def source(self):
+        '''
+        String describing where the offsets come from: 'kernel', or the
+        table's span & accuracy. Part of the keys of cached conversions,
+        so that approximate & exact results are never mixed up.
+        '''
+        if self.table is None:
+            return 'kernel'
+        return 'table ' + ' '.join(repr(float(value)) for value in (
+            self.table.jd_start, self.table.jd_end, self.table.segment_days,
+            self.table.degree, self.table.tolerance,
+            self.table.velocity_tolerance))
+
+    def clear(self):
+        '''Empty the cache & drop any table (counters are kept).'''
+        self._cache.clear()
+        self.table = None
+
+    def reset_counters(self):
+        '''Set all the counters back to zero.'''
+        self.hits = 0
+        self.misses = 0
+        self.kernel_calls = 0
+        self.table_evaluations = 0
+
+    @property
+    def stats(self):
+        '''Dictionary of the counters and current cache size.'''
+        return {'hits': self.hits, 'misses': self.misses,
+                'kernel_calls': self.kernel_calls,
+                'table_evaluations': self.table_evaluations,
+                'size': len(self._cache), 'maxsize': self.maxsize}
+
+
+class SunOffsetTable():
+    '''
+    Piecewise Chebyshev representation of the barycentric position and
+    velocity of the Sun, with equal length segments between jd_start and
+    jd_end. The velocity is the derivative of the position polynomial,
+    so the two are always consistent.
+    '''
+
+    def __init__(self, jd_start, jd_end, segment_days=32., degree=13,
+                 tolerance=1e-14, velocity_tolerance=None, max_halvings=8):
+        self.jd_start, self.jd_end = float(jd_start), float(jd_end)
+        self.degree = degree
+        self.tolerance = tolerance
+        self.velocity_tolerance = (tolerance if velocity_tolerance is None
+                                   else velocity_tolerance)
+        for _ in range(max_halvings + 1):
+            self._fit(segment_days)
+            if ((self.position_error <= self.tolerance) &
+                    (self.velocity_error <= self.velocity_tolerance)):
+                break
+            segment_days /= 2.
+        else:
+            raise ValueError("Could not reach a Sun offset table tolerance "
+                             f"of {self.tolerance:} au & "
+                             f"{self.velocity_tolerance:} au/day, got "
+                             f"{self.position_error:} au & "
+                             f"{self.velocity_error:} au/day.")
+
+    def _fit(self, segment_days):
+        '''Fit all segments and measure the error against the kernel.'''
+        n_segments = max(int(np.ceil((self.jd_end - self.jd_start) /
+                                     segment_days)), 1)
+        self.segment_days = (self.jd_end - self.jd_start) / n_segments
+        n_nodes = 2 * (self.degree + 1)
+        nodes = np.cos(np.pi * (np.arange(n_nodes) + 0.5) / n_nodes)
+        check = 0.5 * (nodes[1:] + nodes[:-1])
+        starts = self.jd_start + self.segment_days * np.arange(n_segments)
+
+        def _epochs(x):
+            return (starts[:, None] + 0.5 * self.segment_days * (x + 1)
+                    ).reshape(-1)
+
+        pos, _ = _kernel_sun_offset(_epochs(nodes))
+        pos = pos.reshape(n_segments, n_nodes, 3)
+        # Fit all segments and coordinates in one least-squares solve
+        coeffs = np.polynomial.chebyshev.chebfit(
+            nodes, pos.transpose(1, 0, 2).reshape(n_nodes, -1), self.degree)
+        # Stored as (n_segments, 3, degree + 1) so that one gather per call
+        # fetches all the coefficients needed for an epoch.
+        self.coeffs = np.ascontiguousarray(
+            coeffs.reshape(self.degree + 1, n_segments, 3).transpose(1, 2, 0))
+        check_epochs = _epochs(check)
+        true_pos, true_vel = _kernel_sun_offset(check_epochs)
+        pos, vel = self(check_epochs)
+        self.position_error = np.max(np.abs(pos - true_pos))
+        self.velocity_error = np.max(np.abs(vel - true_vel))
+
+    def covers(self, jd_tdb):
+        '''Boolean array, True for epochs inside the table span.'''
+        return (jd_tdb >= self.jd_start) & (jd_tdb <= self.jd_end)
+
+    def __call__(self, jd_tdb):
+        '''
+        Position [au] & velocity [au/day] for a length-N array of epochs,
+        which must all be inside the table span, as two (N, 3) arrays.
+        '''
+        scaled = (jd_tdb - self.jd_start) / self.segment_days
+        segment = np.clip(scaled.astype(int), 0, self.coeffs.shape[0] - 1)
+        x = 2. * (scaled - segment) - 1.
+        # Chebyshev polynomials T_k(x) and their derivatives by recurrence
+        T = np.empty((self.degree + 1, len(x)))
+        dT = np.empty((self.degree + 1, len(x)))
+        T[0], T[1], dT[0], dT[1] = 1., x, 0., 1.
+        for k in range(2, self.degree + 1):
+            T[k] = 2. * x * T[k - 1] - T[k - 2]
+            dT[k] = 2. * T[k - 1] + 2. * x * dT[k - 1] - dT[k - 2]
+        coeffs = self.coeffs[segment]
+        return (np.einsum('njk,kn->nj', coeffs, T),
+                np.einsum('njk,kn->nj', coeffs, dT) * 2. / self.segment_days)
+
+
+class ICWriter():
+    '''
+    Streaming writer of multi-object initial conditions files, to be read
+    back with read_initial_conditions. Use as a context manager; every
+    write call formats all its objects at once and writes them in one go:
+
+        with ICWriter('ics.txt', tstep=20., trange=600.) as writer:
+            writer.write(designations, jd_tdb, states)
+
+    Inputs:
+    -------
+    output_file : string, filename (overwritten if it exists).
+    tstep, trange : floats, integration parameters for the header.
+    geocentric : boolean, for the header.
+    covariance : boolean, also write covariances (one 6x6 per object).
+    '''
+
+    def __init__(self, output_file, tstep=20.0, trange=600.,
+                 geocentric=False, covariance=False):
+        self.covariance = covariance
+        self.n_objects = 0
+        n_floats = 7 + (21 if covariance else 0)
+        self._row_format = (f'%-{IC_DESIGNATION_WIDTH:}s' +
+                            IC_FLOAT_FORMAT * n_floats + '\n')
+        self._outfile = open(output_file, 'w', newline='\n')
+        self._outfile.write(
+            f"{IC_HEADER:}\ntstep {tstep:+}\n"
+            f"trange {np.format_float_positional(trange)}\n"
+            f"geocentric {int(geocentric):}\n"
+            f"covariance {int(covariance):}\n"
+            f"#{'designation':<{IC_DESIGNATION_WIDTH - 1}} jd_tdb" +
+            ''.join(f' {coord:}_BaryEqu' for coord in ELEMENT_COORDS) +
+            ('  (covariance: upper triangle, row by row)' if covariance
+             else '') + '\n')
+
+    def write(self, designations, jd_tdb, states, covariances=None):
+        '''
+        Write N objects: designations (ASCII strings of at most 16
+        characters, as the rows have a fixed width in bytes),
+        jd_tdb (N epochs), states (N, 6) and, if the file has them,
+        covariances (N, 6, 6).
+        '''
+        designations = np.atleast_1d(np.asarray(designations, dtype=str))
+        if np.any(np.char.str_len(designations) > IC_DESIGNATION_WIDTH):
+            raise ValueError("Designations can have at most "
+                             f"{IC_DESIGNATION_WIDTH:} characters.")
+        try:
+            np.char.encode(designations, 'ascii')
+        except UnicodeEncodeError as error:
+            raise ValueError("Designations must be ASCII.") from error
+        columns = [np.broadcast_to(np.asarray(jd_tdb, dtype=float),
+                                   designations.shape)[:, None],
+                   np.reshape(states, (-1, 6))]
+        if self.covariance:
+            if covariances is None:
+                raise TypeError("This file needs covariances.")
+            columns.append(np.reshape(covariances,
+                                      (-1, 6, 6))[:, COV_INDICES[0],
+                                                  COV_INDICES[1]])
+        table = np.hstack(columns).tolist()
+        self._outfile.write(''.join(
+            self._row_format % (designation, *row)
+            for designation, row in zip(designations.tolist(), table)))
+        self.n_objects += len(table)
+
+    def close(self):
+        self._outfile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# The cache used by equatorial_helio2bary
+sun_offset_cache = SunOffsetCache()
+
+
 # Functions
 # -----------------------------------------------------------------------------
 
+def parse_orbfit_batch(felfiles):
+    '''
+    Parse many OrbFit fel/eq files into a single structured array.
+
+    Each file is streamed line by line and only the last Cartesian block is
+    kept, exactly as in ParseElements.parse_orbfit, but no per-object
+    dictionaries or astropy Time objects are created.
+    A file that cannot be parsed is reported and skipped, it does not abort
+    the rest of the batch.
+
+    Inputs:
+    -------
+    felfiles : iterable of strings, filenames of fel/eq formatted OrbFit output
+
+    Returns:
+    --------
+    elements : numpy structured array of dtype ORBFIT_DTYPE, one row per
+               successfully parsed file, in input order.
+               Covariance terms are NaN if a file has no covariance.
+    failures : list of (filename, error message) tuples for bad files.
+    '''
+    felfiles = list(felfiles)
+    elements = np.empty(len(felfiles), dtype=ORBFIT_DTYPE)
+    good = np.zeros(len(felfiles), dtype=bool)
+    failures = []
+    for i, felfile in enumerate(felfiles):
+        try:
+            designation, carEls = _read_orbfit_cartesian_block(felfile)
+            if carEls is None:
+                raise ValueError("There does not seem to be any valid "
+                                 "elements in the input file")
+            row = elements[i]
+            row['designation'] = designation
+            row['state'] = [float(x) for x in carEls[1].split()[1:7]]
+            row['mjd_tt'] = float(carEls[2].split()[1])
+            cov = [c for El in carEls if El[:4] == ' COV'
+                   for c in El.split()[1:]]
+            row['covariance'] = ([float(c) for c in cov] if len(cov) == 21
+                                 else np.nan)
+            good[i] = True
+        except (OSError, ValueError, IndexError) as err:
+            failures.append((felfile, str(err)))
+    return elements[good], failures
+
+
+def parse_mpcorb_batch(mpcorbfile):
+    '''
+    Parse a whole MPCORB-format file (e.g. MPCORB.DAT, or extracts of it,
+    with or without the header) into a single structured array.
+
+    The file is memory-mapped and every column is cut out of all lines at
+    once by byte indexing, so there is no Python loop over the lines.
+    Lines that are too short, or whose epoch or elements cannot be read,
+    are reported and skipped. Blank H or G values become NaN.
+
+    Inputs:
+    -------
+    mpcorbfile : string, filename of the MPCORB-format file.
+
+    Returns:
+    --------
+    elements : numpy structured array of dtype MPCORB_DTYPE, one row per
+               orbit, in file order.
+    failures : list of (filename:line number, error message) tuples.
+    '''
+    if os.path.getsize(mpcorbfile) == 0:
+        return np.empty(0, dtype=MPCORB_DTYPE), []
+    buf = np.memmap(mpcorbfile, dtype=np.uint8, mode='r')
+    ends = np.flatnonzero(buf == ord('\n'))
+    if (len(ends) == 0) or (ends[-1] != len(buf) - 1):
+        ends = np.append(ends, len(buf))
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    line_numbers = np.arange(1, len(starts) + 1)
+    # Skip the header, which ends with a line of dashes
+    dashes = np.flatnonzero((buf[np.minimum(starts, len(buf) - 1)] ==
+                             ord('-')) & (ends - starts >= 5))
+    first = dashes[0] + 1 if len(dashes) else 0
+    starts, ends = starts[first:], ends[first:]
+    line_numbers = line_numbers[first:]
+    long_enough = ends - starts >= MPCORB_MIN_LENGTH
+    failures = [(f'{mpcorbfile:}:{n:}', 'Line too short for MPCORB format')
+                for n in line_numbers[~long_enough & (ends - starts > 0)]]
+    starts, line_numbers = starts[long_enough], line_numbers[long_enough]
+
+    elements = np.empty(len(starts), dtype=MPCORB_DTYPE)
+    columns = {name: _fixed_width_column(buf, starts, *MPCORB_COLUMNS[name])
+               for name in MPCORB_COLUMNS}
+    elements['designation'] = np.char.strip(
+        columns['designation'].view('S7')[:, 0].astype('U7'))
+    elements['H'] = _fixed_width_floats(columns['H'])
+    elements['G'] = _fixed_width_floats(columns['G'])
+    elements['mjd_tt'] = _unpack_epoch(columns['epoch'])
+    for i, name in enumerate(['a', 'e', 'incl', 'node', 'peri',
+                              'mean_anomaly']):
+        elements['keplerian'][:, i] = _fixed_width_floats(columns[name])
+    elements['keplerian'][:, 2:] = np.radians(elements['keplerian'][:, 2:])
+    good = np.isfinite(elements['mjd_tt']) & np.all(
+        np.isfinite(elements['keplerian']), axis=1)
+    failures += [(f'{mpcorbfile:}:{n:}', 'Could not read epoch/elements')
+                 for n in line_numbers[~good]]
+    failures.sort(key=lambda failure: int(failure[0].rsplit(':', 1)[1]))
+    return elements[good], failures
+
+
+def read_initial_conditions(ic_file):
+    '''
+    Read a multi-object initial conditions file written by ICWriter.
+
+    The file is memory-mapped and the columns of all rows are converted at
+    once, so there is no Python loop over the objects.
+
+    Inputs:
+    -------
+    ic_file : string, filename.
+
+    Returns:
+    --------
+    elements : numpy structured array of dtype IC_DTYPE, one row per object
+               (covariances are NaN if the file has none).
+    parameters : dictionary, 'tstep', 'trange', 'geocentric' & 'covariance'
+                 from the header.
+    '''
+    parameters, header_bytes = {}, 0
+    with open(ic_file, 'rb') as infile:
+        if infile.readline().decode().rstrip() != IC_HEADER:
+            raise TypeError(f"{ic_file:} is not an initial conditions file.")
+        for line in infile:
+            if line.startswith(b'#'):
+                break
+            key, value = line.decode().split()
+            parameters[key] = float(value)
+        header_bytes = infile.tell()
+    parameters['geocentric'] = bool(parameters['geocentric'])
+    parameters['covariance'] = bool(parameters['covariance'])
+    n_floats = 7 + (21 if parameters['covariance'] else 0)
+    row_length = IC_DESIGNATION_WIDTH + n_floats * IC_FLOAT_WIDTH + 1
+    n_bytes = os.path.getsize(ic_file) - header_bytes
+    if n_bytes % row_length:
+        raise TypeError(f"{ic_file:} has rows of the wrong length.")
+    elements = np.empty(n_bytes // row_length, dtype=IC_DTYPE)
+    if len(elements) == 0:
+        return elements, parameters
+    rows = np.memmap(ic_file, dtype=np.uint8, mode='r', offset=header_bytes,
+                     shape=(len(elements), row_length))
+    elements['designation'] = np.char.rstrip(
+        np.ascontiguousarray(rows[:, :IC_DESIGNATION_WIDTH]).view(
+            f'S{IC_DESIGNATION_WIDTH:}')[:, 0].astype(elements.dtype[0]))
+    floats = np.ascontiguousarray(rows[:, IC_DESIGNATION_WIDTH:-1]).view(
+        f'S{IC_FLOAT_WIDTH:}').astype(float)
+    elements['jd_tdb'], elements['state'] = floats[:, 0], floats[:, 1:7]
+    elements['covariance'] = covariance_matrix(
+        floats[:, 7:] if parameters['covariance'] else
+        np.full((len(elements), 21), np.nan))
+    return elements, parameters
+
+
+def bary_equatorial_batch(elements):
+    '''
+    Convert a batch of parsed elements to barycentric equatorial.
+
+    Inputs:
+    -------
+    elements : numpy structured array of dtype ORBFIT_DTYPE or MPCORB_DTYPE,
+               as returned by parse_orbfit_batch or parse_mpcorb_batch.
+               Keplerian elements are converted to cartesian first; they
+               have no covariance (NaN).
+
+    Returns:
+    --------
+    jd_tdb : numpy array length N, epochs as TDB Julian Dates.
+    xyzv_bar_equ : numpy array (N, 6), barycentric equatorial cartesian
+                   elements.
+    cov_bar_equ : numpy array (N, 6, 6), covariance matrices of the above.
+    '''
+    jd_tdb = mjd_tt_to_jd_tdb(elements['mjd_tt'])
+    if 'keplerian' in elements.dtype.names:
+        xyzv_hel_ecl = keplerian_to_cartesian(elements['keplerian'])
+        cov_bar_equ = np.full((len(elements), 6, 6), np.nan)
+    else:
+        xyzv_hel_ecl = elements['state']
+        cov_bar_equ = rotate_covariance(
+            covariance_matrix(elements['covariance']))
+    xyzv_hel_equ = ecliptic_to_equatorial(xyzv_hel_ecl)
+    xyzv_bar_equ = equatorial_helio2bary(xyzv_hel_equ, jd_tdb)
+    return jd_tdb, xyzv_bar_equ, cov_bar_equ
+
+
+def mjd_tt_to_jd_tdb(mjd_tt):
+    '''
+    Convert epochs from MJD (TT) to JD (TDB), for floats or arrays,
+    without astropy (see tdb_minus_tt).
+    '''
+    with stage('time_conversion'):
+        jd_tt = np.asarray(mjd_tt, dtype=float) + MJD_JD_OFFSET
+        return jd_tt + tdb_minus_tt(jd_tt) / 86400.
+
+
+def tdb_minus_tt(jd_tt):
+    '''
+    TDB - TT [s] at the geocentre for JD (TT) floats or arrays, from the
+    truncated Fairhead & Bretagnon series in TDB_TT_SERIES. Agrees with
+    astropy/ERFA to within 1 microsecond for 1900-2100.
+    '''
+    t = (np.asarray(jd_tt, dtype=float) - J2000_JD) / 365250.
+    flat_t = t.reshape(-1)
+    tdb_tt = np.zeros(len(flat_t))
+    # All terms of a power at once, in chunks to bound the (terms, epochs)
+    # temporary arrays.
+    for start in range(0, len(flat_t), 8192):
+        chunk = flat_t[start:start + 8192]
+        for power, (amplitude, frequency, phase) in enumerate(_TDB_TT_TERMS):
+            tdb_tt[start:start + 8192] += chunk ** power * (
+                amplitude @ np.sin(np.outer(frequency, chunk) +
+                                   phase[:, None]))
+    return tdb_tt.reshape(t.shape)
+
+
 def ecliptic_to_equatorial(input_xyz, backwards=False):
     '''
     Convert a cartesian vector from mean ecliptic to mean equatorial.
     backwards=True converts backwards, from equatorial to ecliptic.
     input:
-        input_xyz - np.array length 3 or 6
+        input_xyz - np.array length 3 or 6, or array of shape (N, 3)/(N, 6)
         backwards - boolean
     output:
-        output_xyz - np.array length 3 or 6
+        output_xyz - np.array of the same shape as input_xyz
+
+    Many vectors are rotated with a single matrix multiplication.
 
     ### Is this HELIOCENTRIC or BARYCENTRIC??? Either way seems to work...
     '''
     direction = -1 if backwards else +1
-    if isinstance(input_xyz, list):
-        input_xyz = np.array(input_xyz)
-    rotation_matrix = mpc.rotate_matrix(mpc.Constants.ecl * direction)
-    output_xyz = np.zeros_like(input_xyz)
-    output_xyz[:3] = np.dot(rotation_matrix,
-                            input_xyz[:3].reshape(-1, 1)).flatten()
-    if len(output_xyz) == 6:
-        output_xyz[3:6] = np.dot(rotation_matrix,
-                                 input_xyz[3:6].reshape(-1, 1)).flatten()
-    return output_xyz
+    input_xyz = np.asarray(input_xyz, dtype=float)
+    rotation_matrix = _ecliptic_rotation_matrix(direction)
+    # Each consecutive triplet (position, then velocity) is one 3-vector.
+    output_xyz = np.dot(input_xyz.reshape(-1, 3), rotation_matrix.T)
+    return output_xyz.reshape(input_xyz.shape)
 
 
 def equatorial_helio2bary(input_xyz, jd_tdb, backwards=False):
@@ -215,26 +998,156 @@ def equatorial_helio2bary(input_xyz, jd_tdb, backwards=False):
     Convert from heliocentric to barycentic cartesian coordinates.
     backwards=True converts backwards, from bary to helio.
     input:
-        input_xyz - np.array length 3 or 6
+        input_xyz - np.array length 3 or 6, or array of shape (N, 3)/(N, 6)
+        jd_tdb    - float, or np.array length N of epochs (one per vector)
         backwards - boolean
     output:
-        output_xyz - np.array length 3 or 6
+        output_xyz - np.array of the same shape as input_xyz
+
+    All the Sun-barycentre offsets are evaluated in one kernel call.
 
     input_xyz MUST BE EQUATORIAL!!!
     '''
     direction = -1 if backwards else +1
-    if isinstance(input_xyz, list):
-        input_xyz = np.array(input_xyz)
-    delta, delta_vel = mpc.jpl_kernel[0, 10].compute_and_differentiate(jd_tdb)
-    output_xyz = np.zeros_like(input_xyz)
-    output_xyz[:3] = input_xyz[:3] + delta * direction / au_km
-    if len(output_xyz) == 6:
-        output_xyz[3:6] = input_xyz[3:6] + delta_vel * direction / au_km
+    input_xyz = np.asarray(input_xyz, dtype=float)
+    delta, delta_vel = _sun_offset(jd_tdb)
+    output_xyz = np.array(input_xyz)
+    output_xyz[..., :3] += delta * direction
+    if input_xyz.shape[-1] == 6:
+        output_xyz[..., 3:6] += delta_vel * direction
     return output_xyz
 
 
+def covariance_matrix(upper_triangle):
+    '''
+    Build full symmetric covariance matrices from their 21 upper triangle
+    terms (row-major, the order OrbFit writes them).
+    input:
+        upper_triangle - array-like (..., 21), numbers or numeric strings
+    output:
+        covariance - np.array (..., 6, 6) of floats
+    '''
+    upper_triangle = np.asarray(upper_triangle, dtype=float)
+    covariance = np.empty(upper_triangle.shape[:-1] + (6, 6))
+    covariance[..., COV_INDICES[0], COV_INDICES[1]] = upper_triangle
+    covariance[..., COV_INDICES[1], COV_INDICES[0]] = upper_triangle
+    return covariance
+
+
+def rotate_covariance(covariance, backwards=False):
+    '''
+    Rotate 6x6 cartesian covariance matrices from mean ecliptic to mean
+    equatorial, as R.C.R^T with R the 6x6 block-diagonal rotation.
+    backwards=True converts backwards, from equatorial to ecliptic.
+    input:
+        covariance - np.array (6, 6) or (N, 6, 6)
+        backwards - boolean
+    output:
+        rotated covariance - np.array of the same shape as covariance
+
+    All N matrices are rotated with one einsum.
+    '''
+    rotation_matrix = np.zeros((6, 6))
+    rotation_matrix[:3, :3] = rotation_matrix[3:, 3:] = \
+        _ecliptic_rotation_matrix(-1 if backwards else +1)
+    return np.einsum('ij,...jk,lk->...il', rotation_matrix,
+                     np.asarray(covariance, dtype=float), rotation_matrix)
+
+
+def _sun_offset(jd_tdb):
+    '''
+    Barycentric position [au] & velocity [au/day] of the Sun,
+    served through the module's SunOffsetCache.
+    Not intended for user usage.
+    '''
+    return sun_offset_cache(jd_tdb)
+
+
+def _kernel_sun_offset(jd_tdb):
+    '''
+    Barycentric position [au] & velocity [au/day] of the Sun straight from
+    the JPL kernel, for a length-N array of jd_tdb, as two (N, 3) arrays.
+    Not intended for user usage.
+    '''
+    with stage('kernel_lookup'):
+        delta, delta_vel = _mpc_library().jpl_kernel[
+            0, 10].compute_and_differentiate(jd_tdb)
+    # The kernel returns (3, N) arrays in km and km/day.
+    return (np.asarray(delta).T / au_km, np.asarray(delta_vel).T / au_km)
+
+
+def _arrays_from_elements(elements, frame):
+    '''
+    State vector & covariance matrix (or None) from an element dictionary
+    with keys like 'x_BaryEqu' and 'sigma_x_BaryEqu'. Missing off-diagonal
+    covariance terms are taken to be zero.
+    Not intended for user usage.
+    '''
+    keys = _element_keys(frame)
+    state = np.array([elements[key] for key in list(keys)[:6]], dtype=float)
+    if f'sigma_x_{frame}' not in elements:
+        return state, None
+    covariance = covariance_matrix([float(elements.get(key, 0.))
+                                    for key in list(keys)[6:]])
+    return state, covariance
+
+
+def _fixed_width_column(buf, starts, start, end):
+    '''
+    The bytes at columns start:end of every line (lines begin at the
+    offsets starts in buf), as an (N, end - start) uint8 array.
+    Not intended for user usage.
+    '''
+    return np.ascontiguousarray(buf[starts[:, None] + np.arange(start, end)])
+
+
+def _fixed_width_floats(column):
+    '''
+    Convert an (N, width) uint8 array of fixed-width text to N floats.
+    Blank or unreadable fields become NaN.
+    Not intended for user usage.
+    '''
+    column = column.copy()
+    width = column.shape[1]
+    column[np.all(column == ord(' '), axis=1)] = np.frombuffer(
+        b'nan'.ljust(width), dtype=np.uint8)
+    text = column.view(f'S{width:}')[:, 0]
+    try:
+        return text.astype(float)
+    except ValueError:  # Fall back to one at a time, to find the bad ones
+        return np.array([_float_or_nan(t) for t in text])
+
+
+def _float_or_nan(text):
+    try:
+        return float(text)
+    except ValueError:
+        return np.nan
+
+
+def _unpack_epoch(column):
+    '''
+    Convert an (N, 5) uint8 array of packed MPC dates (e.g. K205V for
+    2020 May 31) to MJD; NaN for invalid dates.
+    Not intended for user usage.
+    '''
+    century, tens, units, month, day = _PACKED_DIGITS[column].T
+    year = 100 * century + 10 * tens + units
+    valid = ((century >= 18) & (century <= 21) & (tens >= 0) & (tens < 10) &
+             (units >= 0) & (units < 10) & (month >= 1) & (month <= 12) &
+             (day >= 1))
+    # Gregorian calendar date to Julian Day Number, all integer arithmetic
+    a = (14 - month) // 12
+    y = year + 4800 - a
+    m = month + 12 * a - 3
+    jdn = (day + (153 * m + 2) // 5 + 365 * y + y // 4 - y // 100 + y // 400
+           - 32045)
+    return np.where(valid, jdn - 2400001., np.nan)
+
+
 def _get_junk_data(coordsystem='BaryEqu'):
     """Just make some junk data for saving."""
+    from astropy.time import Time
     junk_time = Time(2458849.5, format='jd', scale='tdb')
     junk = {}
     junk.update({'x_' + coordsystem: float(3), 'dx_' + coordsystem: float(0.3),
@@ -258,6 +1171,28 @@ def _get_junk_data(coordsystem='BaryEqu'):
     return junk, junk_time
 
 
+def _read_orbfit_cartesian_block(felfile):
+    '''
+    Convenience function for streaming an OrbFit file and returning the
+    designation and lines of the last Cartesian block (header line first),
+    or (None, None) if there is no Cartesian block.
+    Not intended for user usage.
+    '''
+    designation, carEls = None, None
+    name, block = None, None
+    with open(felfile) as infile:
+        for line in infile:
+            if line.rstrip('\n') == CART_HEAD:
+                block = [line]
+                designation, carEls = name, block
+            elif line[:1] not in (' ', '!'):  # Header or new object
+                name = line.split()[0] if line.strip() else name
+                block = None
+            elif block is not None and len(block) < 25:
+                block.append(line)
+    return designation, carEls
+
+
 def _parse_Covariance_List(Els):
     '''
     Convenience function for reading and splitting the covariance
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# mpc_nbody/mpc_nbody/uncertainty.py
+
+'''
+----------------------------------------------------------------------------
+mpc_nbody's module for the orbit uncertainties given by covariance matrices.
+
+This module provides functionalities to
+(a) factor many 6x6 covariance matrices at once (batched Cholesky)
+(b) draw Monte-Carlo clones of many objects from their covariances
+(c) summarize integrated clones by their mean & covariance at each time
+
+Clones are kept as (..., n_objects, n_clones, 6) arrays, so that the
+objects x clones structure survives integrating them all as one
+multi-particle run (see mpc_nbody.run_nbody_clones).
+----------------------------------------------------------------------------
+'''
+
+# Import third-party packages
+# -----------------------------------------------------------------------------
+import numpy as np
+
+# Import neighbouring packages
+# -----------------------------------------------------------------------------
+
+# Default for caching stuff using lru_cache
+# -----------------------------------------------------------------------------
+
+# Constants and stuff
+# -----------------------------------------------------------------------------
+
+
+# Functions
+# -----------------------------------------------------------------------------
+
+def covariance_factor(covariances):
+    '''
+    Square roots L (with L L^T = C) of (..., 6, 6) covariance matrices.
+
+    All matrices are factored with one batched Cholesky decomposition.
+    If some are not positive definite (as happens from rounding for very
+    elongated uncertainty regions), those are factored from their
+    eigendecomposition instead, with negative eigenvalues set to zero.
+    Raises ValueError for matrices that are not finite (no covariance).
+    '''
+    covariances = np.asarray(covariances, dtype=float)
+    if not np.all(np.isfinite(covariances)):
+        raise ValueError("Covariances must be finite; some objects have "
+                         "no covariance.")
+    try:
+        return np.linalg.cholesky(covariances)
+    except np.linalg.LinAlgError:
+        pass
+    flat = covariances.reshape(-1, 6, 6)
+    factor = np.empty_like(flat)
+    eigenvalues, eigenvectors = np.linalg.eigh(flat)
+    definite = eigenvalues[:, 0] > 0
+    try:
+        factor[definite] = np.linalg.cholesky(flat[definite])
+    except np.linalg.LinAlgError:  # Positive, but too close to zero
+        definite[:] = False
+    rest = ~definite
+    factor[rest] = eigenvectors[rest] * np.sqrt(
+        np.clip(eigenvalues[rest], 0, None))[:, None, :]
+    return factor.reshape(covariances.shape)
+
+
+def sample_clones(states, covariances, n_clones, rng=None,
+                  include_nominal=False):
+    '''
+    Draw Monte-Carlo clones of many objects from their covariances.
+
+    Input:
+    ------
+    states = array (n_objects, 6), nominal states.
+    covariances = array (n_objects, 6, 6), covariances of the states.
+    n_clones = integer, number of clones per object.
+    rng = numpy Generator, integer seed or None (fresh randomness).
+    include_nominal = boolean, make clone 0 of every object its nominal
+                      state (and draw n_clones - 1 random ones).
+
+    Output:
+    -------
+    clones = numpy array (n_objects, n_clones, 6)
+    '''
+    states = np.asarray(states, dtype=float).reshape(-1, 6)
+    factor = covariance_factor(np.reshape(covariances, (-1, 6, 6)))
+    rng = np.random.default_rng(rng)
+    deviates = rng.standard_normal((len(states), n_clones, 6))
+    if include_nominal:
+        deviates[:, 0] = 0.
+    return states[:, None, :] + np.einsum('nij,nkj->nki', factor, deviates)
+
+
+def clone_statistics(clone_vectors):
+    '''
+    Mean & covariance of the clones of every object, e.g. at every output
+    time of an integration.
+
+    Input:
+    ------
+    clone_vectors = array (..., n_objects, n_clones, 6)
+
+    Output:
+    -------
+    mean = numpy array (..., n_objects, 6)
+    covariance = numpy array (..., n_objects, 6, 6)
+    '''
+    clone_vectors = np.asarray(clone_vectors)
+    mean = clone_vectors.mean(axis=-2)
+    deviations = clone_vectors - mean[..., None, :]
+    covariance = np.einsum('...ki,...kj->...ij', deviations, deviations) / (
+        clone_vectors.shape[-2] - 1)
+    return mean, covariance
+
+
+# End
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# mpc_nbody/tests/test_cache.py
+
+'''
+----------------------------------------------------------------------------
+tests for mpc_nbody's cache module.
+
+----------------------------------------------------------------------------
+'''
+
+# import third-party packages
+# -----------------------------------------------------------------------------
+import sys
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# Import neighbouring packages
+# -----------------------------------------------------------------------------
+sys.path.append(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+from mpc_nbody.cache import (DiskCache, ResultCache, default_cache,
+                             make_key, file_digest)
+
+# Default for caching stuff using lru_cache
+# -----------------------------------------------------------------------------
+
+# Convenience functions
+# -----------------------------------------------------------------------------
+
+def put_entries(cache_dir, start, n_entries):
+    '''Write entries from another process.'''
+    cache = DiskCache(cache_dir, max_bytes=20000)
+    for i in range(start, start + n_entries):
+        cache.put(make_key(i), {'x': np.full(100, i, dtype=float)})
+    return cache.writes
+
+
+# Constants & Test Data
+# -----------------------------------------------------------------------------
+
+
+# Tests
+# -----------------------------------------------------------------------------
+
+def test_make_key(tmp_path):
+    '''Test that keys depend on exactly the inputs.'''
+    assert make_key('a', 1.) == make_key('a', 1.)
+    assert make_key('a', 1.) != make_key('a', 1)  # dtype matters
+    assert make_key('ab', 'c') != make_key('a', 'bc')
+    assert make_key(np.zeros(6)) != make_key(np.zeros((2, 3)))
+    data_file = tmp_path / 'data.txt'
+    data_file.write_text('some elements')
+    digest = file_digest(str(data_file))
+    data_file.write_text('other elements')
+    assert file_digest(str(data_file)) != digest
+
+
+def test_disk_cache(tmp_path):
+    '''Test storing, counting and least-recently-used eviction.'''
+    cache = DiskCache(str(tmp_path / 'cache'), max_bytes=3000)
+    assert cache.get('missing') is None
+    arrays = {'state': np.arange(6.), 'epoch': np.array(2458937.0)}
+    cache.put('a', arrays)
+    cached = cache.get('a')
+    assert cached.keys() == arrays.keys()
+    assert all(np.all(cached[name] == arrays[name]) for name in arrays)
+    assert cache.stats['hits'] == 1 and cache.stats['misses'] == 1
+    # Each entry is ~1 kB: the third one pushes out the least recently used
+    big = {'x': np.zeros(100)}
+    cache.put('b', big)
+    os.utime(cache._path('a'), (0, 0))
+    os.utime(cache._path('b'), (1, 1))
+    cache.get('a')  # Now 'b' is the least recently used
+    cache.put('c', big)
+    cache.put('d', big)
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.stats['evictions'] >= 1
+    assert cache.stats['bytes'] <= 3000
+    cache.clear()
+    assert cache.stats['entries'] == 0
+
+
+def test_disk_cache_index(tmp_path, monkeypatch):
+    '''
+    Test that writes under the cap do not look at the other entries, and
+    that the running total stays right.
+    '''
+    cache = DiskCache(str(tmp_path / 'cache'), max_bytes=10 ** 6)
+    cache.put('first', {'x': np.zeros(100)})
+    scans = []
+    original_entries = DiskCache._entries
+    monkeypatch.setattr(DiskCache, '_entries',
+                        lambda self: scans.append(1) or original_entries(self))
+    for i in range(50):
+        cache.put(make_key(i), {'x': np.zeros(100)})
+    cache.put(make_key(0), {'x': np.zeros(200)})  # Replaces an entry
+    assert scans == []
+    with cache._lock():
+        total = cache._read_total()
+    assert total == cache.stats['bytes']
+
+
+def test_disk_cache_corrupt(tmp_path):
+    '''Test that truncated or corrupt entries are misses, and deleted.'''
+    cache = DiskCache(str(tmp_path / 'cache'))
+    cache.put('a', {'x': np.zeros(100)})
+    cache.put('b', {'x': np.zeros(100)})
+    with open(cache._path('a'), 'wb') as outfile:
+        outfile.write(b'not an npz file')
+    with open(cache._path('b'), 'r+b') as outfile:
+        outfile.truncate(100)
+    for key in ['a', 'b']:
+        assert cache.get(key) is None
+        assert not os.path.exists(cache._path(key))
+    assert cache.stats['misses'] == 2 and cache.stats['entries'] == 0
+    cache.put('a', {'x': np.zeros(100)})
+    assert np.all(cache.get('a')['x'] == 0)
+
+
+def test_disk_cache_processes(tmp_path):
+    '''Test that several processes can share one cache directory.'''
+    cache_dir = str(tmp_path / 'cache')
+    with ProcessPoolExecutor(max_workers=3) as executor:
+        writes = list(executor.map(put_entries, [cache_dir] * 3,
+                                   [0, 20, 40], [20] * 3))
+    assert writes == [20] * 3
+    cache = DiskCache(cache_dir, max_bytes=20000)
+    assert cache.stats['bytes'] <= 20000
+    assert not [name for name in os.listdir(cache_dir)
+                if name.endswith('.tmp')]
+    for i in range(60):
+        arrays = cache.get(make_key(i))
+        assert arrays is None or np.all(arrays['x'] == i)
+
+
+def test_result_cache(tmp_path):
+    '''
+    Test the in-memory cache: read-only results, least-recently-used
+    eviction by size, and falling back to disk.
+    '''
+    disk = DiskCache(str(tmp_path / 'cache'))
+    cache = ResultCache(max_bytes=2000, disk=disk)
+    assert cache.get('a') is None
+    original = np.zeros(100)
+    stored = cache.put('a', {'x': original})  # 800 bytes
+    assert not stored['x'].flags.writeable
+    assert original.flags.writeable  # The cache keeps a copy
+    assert cache.get('a')['x'] is stored['x']
+    cache.put('b', {'x': np.ones(100)})
+    cache.get('a')  # Now 'b' is the least recently used
+    cache.put('c', {'x': np.ones(100)})
+    assert cache.stats['evictions'] == 1
+    assert cache.stats['bytes'] == 1600
+    assert cache.get('b')['x'][0] == 1.  # From disk
+    assert cache.stats['disk_hits'] == 1 and cache.stats['hits'] == 2
+    cache.put('big', {'x': np.zeros(1000)})  # Too big to keep in memory
+    assert cache.stats['bytes'] == 0
+    assert ResultCache().get('a') is None  # No disk
+
+
+def test_default_cache(tmp_path, monkeypatch):
+    '''Test that caching is off unless MPC_NBODY_CACHE_DIR is set.'''
+    monkeypatch.delenv('MPC_NBODY_CACHE_DIR', raising=False)
+    assert default_cache('parse') is None
+    monkeypatch.setenv('MPC_NBODY_CACHE_DIR', str(tmp_path))
+    assert default_cache('parse').cache_dir == str(tmp_path / 'parse')
+
+
+# End
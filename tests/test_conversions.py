@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# mpc_nbody/tests/test_conversions.py
+
+'''
+----------------------------------------------------------------------------
+tests for mpc_nbody's conversions module.
+
+----------------------------------------------------------------------------
+'''
+
+# import third-party packages
+# -----------------------------------------------------------------------------
+import sys
+import os
+import numpy as np
+import pytest
+
+# Import neighbouring packages
+# -----------------------------------------------------------------------------
+sys.path.append(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+from mpc_nbody import conversions
+
+# Default for caching stuff using lru_cache
+# -----------------------------------------------------------------------------
+
+# Constants & Test Data
+# -----------------------------------------------------------------------------
+RNG = np.random.default_rng(2020)
+N_ORBITS = 1000
+ELLIPTIC_ELEMENTS = np.column_stack([
+    RNG.uniform(0.5, 50., N_ORBITS),            # a
+    RNG.uniform(0., 0.99, N_ORBITS),            # e
+    RNG.uniform(0., np.pi, N_ORBITS),           # i
+    RNG.uniform(0., 2 * np.pi, N_ORBITS),       # node
+    RNG.uniform(0., 2 * np.pi, N_ORBITS),       # argument of perihelion
+    RNG.uniform(-10., 10., N_ORBITS)])          # mean anomaly
+HYPERBOLIC_ELEMENTS = ELLIPTIC_ELEMENTS.copy()
+HYPERBOLIC_ELEMENTS[:, 0] *= -1
+HYPERBOLIC_ELEMENTS[:, 1] = RNG.uniform(1.01, 5., N_ORBITS)
+EPOCH = 59000.5
+
+
+# Tests
+# -----------------------------------------------------------------------------
+
+def test_solve_kepler():
+    '''Test that the eccentric anomalies solve Kepler's equation.'''
+    e, M = ELLIPTIC_ELEMENTS[:, 1], ELLIPTIC_ELEMENTS[:, 5]
+    E = conversions.solve_kepler(M, e)
+    residual = E - e * np.sin(E) - M
+    assert np.all(np.abs(np.mod(residual + np.pi, 2 * np.pi) - np.pi)
+                  < 1e-14)
+    # Hyperbolic, also close to parabolic where cancellation is an issue
+    e = np.concatenate([HYPERBOLIC_ELEMENTS[:, 1], [1 + 1e-9, 1.5]])
+    M = np.concatenate([HYPERBOLIC_ELEMENTS[:, 5], [1e-6, 1e6]])
+    H = conversions.solve_kepler(M, e)
+    assert np.allclose(e * np.sinh(H) - H, M, rtol=1e-13, atol=1e-14)
+    # Parabolic: Barker's equation
+    D = conversions.solve_kepler(M, 1.)
+    assert np.allclose(D + D ** 3 / 3, M, rtol=1e-13, atol=1e-14)
+    with pytest.raises(ValueError):
+        conversions.solve_kepler(1., -0.5)
+
+
+def test_keplerian_to_cartesian():
+    '''
+    Test the conversion against the conserved quantities of the orbits:
+    energy (semi-major axis), angular momentum (e, i, node) and the
+    distance at perihelion.
+    '''
+    xyzv = conversions.keplerian_to_cartesian(ELLIPTIC_ELEMENTS)
+    assert xyzv.shape == (N_ORBITS, 6)
+    a, e, incl, node, peri, _ = ELLIPTIC_ELEMENTS.T
+    mu = conversions.GM_SUN
+    r = np.linalg.norm(xyzv[:, :3], axis=1)
+    v2 = np.sum(xyzv[:, 3:] ** 2, axis=1)
+    assert np.allclose(1 / (2 / r - v2 / mu), a, rtol=1e-12)
+    h = np.cross(xyzv[:, :3], xyzv[:, 3:])
+    assert np.allclose(np.sum(h ** 2, axis=1), mu * a * (1 - e ** 2),
+                       rtol=1e-12)
+    assert np.allclose(h / np.linalg.norm(h, axis=1)[:, None],
+                       np.column_stack([np.sin(incl) * np.sin(node),
+                                        -np.sin(incl) * np.cos(node),
+                                        np.cos(incl)]), atol=1e-12)
+    # At mean anomaly 0 the object is at perihelion
+    at_perihelion = ELLIPTIC_ELEMENTS.copy()
+    at_perihelion[:, 5] = 0.
+    xyzv = conversions.keplerian_to_cartesian(at_perihelion)
+    assert np.allclose(np.linalg.norm(xyzv[:, :3], axis=1), a * (1 - e),
+                       rtol=1e-12)
+    # A single orbit works too
+    assert np.all(conversions.keplerian_to_cartesian(at_perihelion[0]) ==
+                  xyzv[0])
+
+
+@pytest.mark.parametrize('elements', [ELLIPTIC_ELEMENTS, HYPERBOLIC_ELEMENTS])
+def test_round_trips(elements):
+    '''Test Keplerian -> cartesian -> cometary -> Keplerian.'''
+    xyzv = conversions.keplerian_to_cartesian(elements)
+    keplerian = conversions.cartesian_to_keplerian(xyzv)
+    assert states_close(conversions.keplerian_to_cartesian(keplerian), xyzv)
+    assert np.allclose(keplerian[:, :2], elements[:, :2], rtol=1e-10)
+    cometary = conversions.cartesian_to_cometary(xyzv, EPOCH)
+    assert states_close(conversions.cometary_to_cartesian(cometary, EPOCH),
+                        xyzv)
+    assert np.allclose(conversions.keplerian_to_cometary(elements, EPOCH),
+                       cometary, rtol=1e-10, atol=1e-10)
+    assert states_close(conversions.keplerian_to_cartesian(
+        conversions.cometary_to_keplerian(cometary, EPOCH)), xyzv)
+
+
+def test_parabolic():
+    '''Test parabolic orbits, and that they join near-parabolic ones.'''
+    cometary = np.array([[0.5, 1., 0.3, 1., 2., EPOCH - 30.],
+                         [2., 1., 2.5, 4., 5., EPOCH + 300.]])
+    xyzv = conversions.cometary_to_cartesian(cometary, EPOCH)
+    mu = conversions.GM_SUN
+    r = np.linalg.norm(xyzv[:, :3], axis=1)
+    assert np.allclose(np.sum(xyzv[:, 3:] ** 2, axis=1), 2 * mu / r,
+                       rtol=1e-13)
+    assert np.allclose(conversions.cartesian_to_cometary(xyzv, EPOCH),
+                       cometary, rtol=1e-12, atol=1e-12)
+    for de in (-1e-9, 1e-9):
+        near = cometary + [0., de, 0., 0., 0., 0.]
+        assert np.allclose(conversions.cometary_to_cartesian(near, EPOCH),
+                           xyzv, rtol=1e-7, atol=0)
+    with pytest.raises(ValueError):
+        conversions.cometary_to_keplerian(cometary, EPOCH)
+
+
+@pytest.mark.parametrize('elements', [ELLIPTIC_ELEMENTS[:50],
+                                      HYPERBOLIC_ELEMENTS[:50]])
+def test_jacobians(elements):
+    '''
+    Test the analytic Jacobians against finite differences, and that the
+    inverse conversions get the inverse Jacobians.
+    '''
+    cometary = conversions.keplerian_to_cometary(elements, EPOCH)
+    parabolic = np.array([[0.5, 1., 0.3, 1., 2., EPOCH - 30.]])
+    cases = [(conversions.keplerian_to_cartesian, elements),
+             (lambda x, **kw: conversions.cometary_to_cartesian(x, EPOCH,
+                                                                **kw),
+              np.concatenate([cometary, parabolic])),
+             (lambda x, **kw: conversions.keplerian_to_cometary(x, EPOCH,
+                                                                **kw),
+              elements),
+             (lambda x, **kw: conversions.cometary_to_keplerian(x, EPOCH,
+                                                                **kw),
+              cometary)]
+    for function, x in cases:
+        _, jacobian = function(x, jacobian=True)
+        scale = np.max(np.abs(jacobian), axis=(1, 2), keepdims=True)
+        assert np.all(np.abs(jacobian - numerical_jacobian(function, x))
+                      < 1e-5 * scale)
+    xyzv, forward = conversions.keplerian_to_cartesian(elements,
+                                                       jacobian=True)
+    _, inverse = conversions.cartesian_to_keplerian(xyzv, jacobian=True)
+    assert np.allclose(inverse @ forward, np.eye(6), atol=1e-8)
+    # Covariances go back & forth
+    C = np.broadcast_to(np.diag([1e-8, 1e-9, 1e-7, 1e-7, 1e-7, 1e-6]),
+                        forward.shape)
+    cartesian_C = conversions.propagate_covariance(C, forward)
+    assert np.allclose(cartesian_C, np.swapaxes(cartesian_C, -1, -2))
+    assert np.allclose(conversions.propagate_covariance(cartesian_C, inverse),
+                       C, rtol=1e-6, atol=1e-15)
+
+
+# Non-test helper functions
+# -----------------------------------------------------------------------------
+
+def states_close(xyzv, expected, rtol=1e-10):
+    '''Compare positions & velocities relative to their lengths.'''
+    return all(np.all(np.linalg.norm(xyzv[:, k] - expected[:, k], axis=1) <=
+                      rtol * np.linalg.norm(expected[:, k], axis=1))
+               for k in (slice(0, 3), slice(3, 6)))
+
+
+def numerical_jacobian(function, elements, step=1e-7):
+    '''Central finite differences, for checking the analytic Jacobians.'''
+    jacobian = np.empty(elements.shape + (6,))
+    for k in range(6):
+        delta = np.zeros(6)
+        delta[k] = step * max(1., np.max(np.abs(elements[..., k])))
+        jacobian[..., k] = (function(elements + delta) -
+                            function(elements - delta)) / (2 * delta[k])
+    return jacobian
+
+
+# End
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# mpc_nbody/tests/test_import_time.py
+
+'''
+----------------------------------------------------------------------------
+tests that importing mpc_nbody stays fast: the heavy dependencies (astropy,
+mpcpp & the JPL kernel, reboundx) must only be loaded when first used.
+
+----------------------------------------------------------------------------
+'''
+
+# import third-party packages
+# -----------------------------------------------------------------------------
+import sys
+import os
+import json
+import subprocess
+import pytest
+
+# Import neighbouring packages
+# -----------------------------------------------------------------------------
+
+# Default for caching stuff using lru_cache
+# -----------------------------------------------------------------------------
+
+# Constants & Test Data
+# -----------------------------------------------------------------------------
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+IMPORT_BUDGET = 1.0  # seconds, on top of importing numpy
+HEAVY_MODULES = ['astropy', 'mpcpp', 'reboundx', 'examples']
+TIMING_SCRIPT = '''
+import sys, json, time
+import numpy
+t0 = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - t0
+print(json.dumps({{'elapsed': elapsed, 'path': sys.path,
+                   'modules': sorted(set(m.split('.')[0]
+                                         for m in sys.modules))}}))
+'''
+
+
+# Tests
+# -----------------------------------------------------------------------------
+
+@pytest.mark.parametrize(('module'), ['mpc_nbody', 'mpc_nbody.mpc_nbody',
+                                      'mpc_nbody.parse_input'])
+def test_import_time(module):
+    '''
+    Test that importing doesn't load the heavy dependencies or change
+    sys.path, and fits in the startup budget (in a fresh interpreter).
+    '''
+    result = time_import(module)
+    assert not set(HEAVY_MODULES) & set(result['modules'])
+    assert result['path'] == time_import('os')['path']
+    assert result['elapsed'] < IMPORT_BUDGET
+
+
+# Non-test helper functions
+# -----------------------------------------------------------------------------
+
+def time_import(module):
+    '''Import module in a fresh interpreter; return its timing details.'''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [REPO_DIR] + [p for p in env.get('PYTHONPATH', '').split(os.pathsep)
+                      if p])
+    output = subprocess.run([sys.executable, '-c',
+                             TIMING_SCRIPT.format(module=module)],
+                            cwd=REPO_DIR, env=env, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output)
+
+
+# End
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# mpc_nbody/tests/test_metrics.py
+
+'''
+----------------------------------------------------------------------------
+tests for mpc_nbody's metrics module.
+
+----------------------------------------------------------------------------
+'''
+
+# import third-party packages
+# -----------------------------------------------------------------------------
+import sys
+import os
+import pytest
+
+# Import neighbouring packages
+# -----------------------------------------------------------------------------
+sys.path.append(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+from mpc_nbody import metrics
+
+# Default for caching stuff using lru_cache
+# -----------------------------------------------------------------------------
+
+# Constants & Test Data
+# -----------------------------------------------------------------------------
+
+
+# Tests
+# -----------------------------------------------------------------------------
+
+def test_metrics():
+    '''Test timing stages, counting and the hook.'''
+    events = []
+    M = metrics.Metrics(hook=lambda *event: events.append(event))
+    with M.stage('parse'):
+        pass
+    with M.stage('parse'):
+        pass
+    M.count('particles', 5)
+    summary = M.summary()
+    assert summary['calls'] == {'parse': 2}
+    assert summary['timings']['parse'] >= 0
+    assert summary['counters'] == {'particles': 5}
+    assert [event[:2] for event in events] == [('stage', 'parse')] * 2 + \
+        [('count', 'particles')]
+    assert events[-1][2] == 5
+    M.reset()
+    assert M.summary() == {'timings': {}, 'calls': {}, 'counters': {}}
+
+
+def test_activated():
+    '''
+    Test that stage() & count() report to the active Metrics only, and
+    that the previous ones are restored, also after an exception.
+    '''
+    M, inner = metrics.Metrics(), metrics.Metrics()
+    with metrics.stage('integration'):
+        metrics.count('substeps', 3)
+    assert metrics.active() is metrics.NULL_METRICS
+    with metrics.activated(M):
+        with metrics.stage('integration'):
+            metrics.count('substeps', 3)
+        with pytest.raises(RuntimeError):
+            with metrics.activated(inner):
+                metrics.count('substeps')
+                raise RuntimeError
+        assert metrics.active() is M
+        with metrics.activated(None):
+            metrics.count('substeps')
+    assert metrics.active() is metrics.NULL_METRICS
+    assert M.counters == {'substeps': 3} and M.calls == {'integration': 1}
+    assert inner.counters == {'substeps': 1}
+
+
+# End
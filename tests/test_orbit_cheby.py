@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# mpc_nbody/tests/test_orbit_cheby.py
+
+'''
+----------------------------------------------------------------------------
+tests for mpc_nbody's orbit_cheby module.
+
+----------------------------------------------------------------------------
+'''
+
+# import third-party packages
+# -----------------------------------------------------------------------------
+import sys
+import os
+import numpy as np
+import pytest
+
+# Import neighbouring packages
+# -----------------------------------------------------------------------------
+sys.path.append(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+from mpc_nbody.orbit_cheby import ChebyshevEphemeris
+
+# Default for caching stuff using lru_cache
+# -----------------------------------------------------------------------------
+
+# Convenience functions
+# -----------------------------------------------------------------------------
+
+# Constants & Test Data
+# -----------------------------------------------------------------------------
+GM = 0.01720209895 ** 2  # Gaussian gravitational constant squared
+TSTART = 2458937.0
+
+
+# Tests
+# -----------------------------------------------------------------------------
+
+@pytest.mark.parametrize(('tolerance'), [1e-8, 1e-11])
+def test_fit_and_evaluate(tolerance):
+    '''
+    Test that fitted polynomials reproduce circular orbits within tolerance,
+    also between the times they were fitted to.
+    '''
+    radii = np.array([0.8, 1.5, 2.7, 4.2])
+    times = TSTART + np.arange(0, 600, 2.5)
+    cheby = ChebyshevEphemeris.fit(times, circular_orbits(radii, times),
+                                   tolerance=tolerance)
+    assert cheby.position_error <= tolerance
+    assert cheby.n_objects == len(radii)
+    fine_times = np.linspace(times[0], times[-1], 2391)
+    expected = circular_orbits(radii, fine_times)
+    positions, velocities = cheby.evaluate(np.arange(len(radii))[None, :],
+                                           fine_times[:, None], velocity=True)
+    assert positions.shape == (len(fine_times), len(radii), 3)
+    assert np.all(np.abs(positions - expected[..., :3]) < 10 * tolerance)
+    assert np.all(np.abs(velocities - expected[..., 3:]) < 10 * tolerance)
+
+
+def test_evaluate_pairs():
+    '''
+    Test evaluating arbitrary (object, time) pairs, including times outside
+    the fitted span.
+    '''
+    radii = np.array([1.0, 2.0, 3.0])
+    times = TSTART + np.arange(0, 200, 2.5)
+    cheby = ChebyshevEphemeris.fit(times, circular_orbits(radii, times),
+                                   tolerance=1e-10)
+    rng = np.random.default_rng(3)
+    object_ids = rng.integers(0, 3, 1000)
+    pair_times = rng.uniform(times[0], times[-1], 1000)
+    positions = cheby.evaluate(object_ids, pair_times)
+    expected = circular_orbits(radii, pair_times)[np.arange(1000), object_ids]
+    assert np.all(np.abs(positions - expected[:, :3]) < 1e-9)
+    assert np.all(np.isnan(cheby.evaluate(0, times[0] - 1.)))
+    assert np.all(np.isnan(cheby.evaluate(2, times[-1] + 1.)))
+    assert cheby.evaluate(1, times[-1]).shape == (3,)
+
+
+def test_save_load(tmp_path):
+    '''Test that saving and loading gives back the same polynomials.'''
+    times = TSTART + np.arange(0, 100, 2.5)
+    cheby = ChebyshevEphemeris.fit(times, circular_orbits([1.], times))
+    cheby.save(str(tmp_path / 'cheby.npz'))
+    loaded = ChebyshevEphemeris.load(str(tmp_path / 'cheby.npz'))
+    assert np.all(loaded.coeffs == cheby.coeffs)
+    assert (loaded.tstart, loaded.window) == (cheby.tstart, cheby.window)
+
+
+def test_gaps():
+    '''
+    Test that output with gaps (windows without output times) is fitted,
+    and gives NaN in the gaps.
+    '''
+    radii = np.array([1.5])
+    gapped = TSTART + np.concatenate([np.arange(0, 100, 0.5),
+                                      np.arange(400, 600, 0.5)])
+    cheby = ChebyshevEphemeris.fit(gapped, circular_orbits(radii, gapped),
+                                   tolerance=1e-13)
+    assert cheby.position_error <= 1e-13
+    positions = cheby.evaluate(0, gapped)
+    assert np.all(np.abs(positions - circular_orbits(radii, gapped)[:, 0, :3])
+                  < 1e-13)
+    assert np.all(np.isnan(cheby.evaluate(0, TSTART + 250.)))
+
+
+def test_sparse_output():
+    '''
+    Test that output too sparse to reach the tolerance between the output
+    times is rejected, rather than fitted through the samples.
+    '''
+    times = TSTART + np.arange(0, 600, 30.)
+    with pytest.raises(ValueError):
+        ChebyshevEphemeris.fit(times, circular_orbits([1.], times),
+                               tolerance=1e-10)
+
+
+def test_backward():
+    '''Test fitting the output of a backward integration.'''
+    radii = np.array([1.0, 2.0])
+    times = TSTART - np.arange(0, 200, 2.5)
+    cheby = ChebyshevEphemeris.fit(times, circular_orbits(radii, times),
+                                   tolerance=1e-10)
+    assert cheby.tstart == times[-1]
+    positions = cheby.evaluate(np.arange(2)[None, :], times[:, None])
+    assert np.all(np.abs(positions - circular_orbits(radii, times)[..., :3])
+                  < 1e-10)
+
+
+def test_unreachable_tolerance():
+    '''Test that an impossible tolerance raises an error.'''
+    times = TSTART + np.arange(0, 100, 2.5)
+    with pytest.raises(ValueError):
+        ChebyshevEphemeris.fit(times, circular_orbits([0.1], times),
+                               tolerance=1e-20, max_halvings=2)
+
+
+# Non-test helper functions
+# -----------------------------------------------------------------------------
+
+def circular_orbits(radii, times):
+    '''
+    Positions & velocities (n_times, n_objects, 6) of circular orbits,
+    inclined by 10 degrees, with the given radii.
+    '''
+    radii = np.asarray(radii, dtype=float)[None, :]
+    n = np.sqrt(GM / radii ** 3)
+    phase = n * (np.asarray(times)[:, None] - TSTART)
+    inc = np.radians(10.)
+    return np.stack([radii * np.cos(phase),
+                     radii * np.sin(phase) * np.cos(inc),
+                     radii * np.sin(phase) * np.sin(inc),
+                     -radii * n * np.sin(phase),
+                     radii * n * np.cos(phase) * np.cos(inc),
+                     radii * n * np.cos(phase) * np.sin(inc)], axis=-1)
+
+
+# End
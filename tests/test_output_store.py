@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# mpc_nbody/tests/test_output_store.py
+
+'''
+----------------------------------------------------------------------------
+tests for mpc_nbody's output_store module.
+
+----------------------------------------------------------------------------
+'''
+
+# import third-party packages
+# -----------------------------------------------------------------------------
+import sys
+import os
+import numpy as np
+import pytest
+
+# Import neighbouring packages
+# -----------------------------------------------------------------------------
+sys.path.append(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+from mpc_nbody.output_store import OutputStore
+
+# Default for caching stuff using lru_cache
+# -----------------------------------------------------------------------------
+
+# Convenience functions
+# -----------------------------------------------------------------------------
+
+# Constants & Test Data
+# -----------------------------------------------------------------------------
+N_PARTICLES = 7
+WINDOW_N_TIMES = [5, 8, 3]
+
+
+# Tests
+# -----------------------------------------------------------------------------
+
+def test_store_round_trip(tmp_path):
+    '''
+    Test that windows written to a store are read back exactly, both through
+    the lazy view and after re-opening the store.
+    '''
+    store, times, vectors = make_store(str(tmp_path / 'store'))
+    assert store.n_windows == 3
+    assert store.n_times == sum(WINDOW_N_TIMES)
+    assert np.all(store.times() == times)
+    view = store.vectors()
+    assert view.shape == vectors.shape
+    assert np.all(np.asarray(view) == vectors)
+    reopened = OutputStore(str(tmp_path / 'store'))
+    assert reopened.particle_block == 3
+    assert reopened.meta['time_parameters'] == [100., 1., 15.]
+    assert np.all(np.asarray(reopened.vectors()) == vectors)
+
+
+@pytest.mark.parametrize(
+    ('key'),
+    [
+     (slice(None), 4),
+     (6, slice(None)),
+     (slice(3, 10), slice(2, 6)),
+     (np.array([0, 5, 15]), slice(None)),
+     (slice(None), np.array([6, 0])),
+     (-1, -1, 2),
+     (slice(None, None, -2), 3, slice(0, 3)),
+      ])
+def test_store_slicing(tmp_path, key):
+    '''
+    Test that slicing the lazy view gives the same as slicing the array.
+    '''
+    store, _, vectors = make_store(str(tmp_path / 'store'))
+    sliced = store.vectors()[key]
+    assert np.shape(sliced) == np.shape(vectors[key])
+    assert np.all(sliced == vectors[key])
+
+
+def test_store_outer_indexing(tmp_path):
+    '''
+    Test that two index arrays select the outer product of times and
+    particles (not numpy's point-wise selection).
+    '''
+    store, _, vectors = make_store(str(tmp_path / 'store'))
+    time_indices, particle_indices = np.array([0, 5, 15]), np.array([6, 0])
+    assert np.all(store.vectors()[time_indices, particle_indices] ==
+                  vectors[np.ix_(time_indices, particle_indices)])
+
+
+def test_store_object_output(tmp_path):
+    '''
+    Test selecting a single object in a time range.
+    '''
+    store, times, vectors = make_store(str(tmp_path / 'store'))
+    object_times, object_vectors = store.object_output(5, 104., 110.)
+    keep = (times >= 104.) & (times <= 110.)
+    assert np.all(object_times == times[keep])
+    assert np.all(object_vectors == vectors[keep, 5])
+
+
+def test_store_restart(tmp_path):
+    '''
+    Test that starting a new run empties the store.
+    '''
+    store, _, _ = make_store(str(tmp_path / 'store'))
+    store.start(np.zeros(12), 2, [0., 1., 2.])
+    assert store.n_windows == 0
+    assert store.n_times == 0
+    assert sorted(os.listdir(str(tmp_path / 'store'))) == ['store.json']
+
+
+# Non-test helper functions
+# -----------------------------------------------------------------------------
+
+def make_store(store_dir):
+    '''
+    Make a store of random vectors over three windows, with particle blocks
+    of three (so the last block is not full).
+    '''
+    rng = np.random.default_rng(1)
+    times = 100. + np.arange(sum(WINDOW_N_TIMES), dtype=float)
+    vectors = rng.normal(size=(len(times), N_PARTICLES, 6))
+    store = OutputStore(store_dir, time_window=5., particle_block=3)
+    store.start(vectors[0].reshape(-1), N_PARTICLES, [100., 1., 15.])
+    for start, stop in zip(np.cumsum([0] + WINDOW_N_TIMES[:-1]),
+                           np.cumsum(WINDOW_N_TIMES)):
+        store.append_window(times[start:stop], vectors[start:stop])
+    return store, times, vectors
+
+
+# End
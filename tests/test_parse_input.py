@@ -15,6 +15,7 @@ Mike Alexandersen & Matthew Payne
 # -----------------------------------------------------------------------------
 import sys
 import os
+from collections.abc import Mapping
 from filecmp import cmp
 import numpy as np
 import pytest
@@ -25,6 +26,7 @@ from astroquery.jplhorizons import Horizons
 sys.path.append(os.path.dirname(os.path.dirname(
     os.path.realpath(__file__))))
 from mpc_nbody import parse_input
+from mpc_nbody.cache import DiskCache
 
 # Default for caching stuff using lru_cache
 # -----------------------------------------------------------------------------
@@ -58,7 +60,7 @@ def test_parse_orbfit(data_file):
     elements_dictionary = P.heliocentric_ecliptic_cartesian_elements
 
     # check that the returned results are as expected
-    assert isinstance(elements_dictionary, dict)
+    assert isinstance(elements_dictionary, Mapping)
     for key in ['x_HelioEcl', 'dx_HelioEcl', 'y_HelioEcl', 'dy_HelioEcl',
                 'z_HelioEcl', 'dz_HelioEcl']:
         assert key in elements_dictionary
@@ -71,7 +73,42 @@ def test_parse_orbfit(data_file):
                 'z_dx_HelioEcl', 'z_dy_HelioEcl', 'z_dz_HelioEcl',
                 'dx_dy_HelioEcl', 'dx_dz_HelioEcl', 'dy_dz_HelioEcl']:
         assert key in elements_dictionary
-        assert isinstance(elements_dictionary[key], str)
+        assert isinstance(elements_dictionary[key], float)
+    assert len(elements_dictionary) == 27
+    assert elements_dictionary['x_HelioEcl'] == \
+        P.heliocentric_ecliptic_state[0]
+    assert elements_dictionary['x_dy_HelioEcl'] == \
+        P.heliocentric_ecliptic_covariance[0, 4]
+    with pytest.raises(TypeError):  # Read-only
+        elements_dictionary['x_HelioEcl'] = 0.
+    assert not hasattr(P, '__dict__')  # Compact: __slots__ & arrays only
+
+
+def test_parse_orbfit_batch():
+    '''Test that a batch of OrbFit files gets parsed into one array.'''
+    data_files = [os.path.join(DATA_DIR, data_file)
+                  for data_file in ['30101.eq0_postfit', '30102.eq0_postfit',
+                                    'holman_ic_junk', '30101.eq0_horizons']]
+    elements, failures = parse_input.parse_orbfit_batch(data_files)
+
+    # The junk file should be reported, not abort the batch
+    assert len(elements) == 3
+    assert [f[0] for f in failures] == [data_files[2]]
+    assert list(elements['designation']) == ['30101', '30102', '30101']
+
+    # Check against the single-object parser
+    for i, data_file in enumerate([data_files[0], data_files[1],
+                                   data_files[3]]):
+        P = parse_input.ParseElements()
+        P.parse_orbfit(data_file)
+        els = P.heliocentric_ecliptic_cartesian_elements
+        assert np.all(elements['state'][i] ==
+                      [els[key] for key in ['x_HelioEcl', 'y_HelioEcl',
+                                            'z_HelioEcl', 'dx_HelioEcl',
+                                            'dy_HelioEcl', 'dz_HelioEcl']])
+        assert elements['mjd_tt'][i] == P.time.tt.mjd
+        assert elements['covariance'][i][0] == float(els['sigma_x_HelioEcl'])
+        assert elements['covariance'][i][20] == float(els['sigma_dz_HelioEcl'])
 
 
 def test_save_elements():
@@ -83,6 +120,85 @@ def test_save_elements():
     assert cmp('./holman_ic', os.path.join(DATA_DIR, 'holman_ic_junk'))
 
 
+def test_save_elements_parameters(tmp_path):
+    '''Test that save_elements writes the given tstep and trange.'''
+    P = parse_input.ParseElements()
+    (P.barycentric_equatorial_cartesian_elements, P.time
+     ) = parse_input._get_junk_data('BaryEqu')
+    output_file = str(tmp_path / 'holman_ic')
+    P.save_elements(output_file, tstep=-0.5, trange=3000.)
+    with open(output_file) as infile:
+        lines = infile.readlines()
+    assert lines[1:3] == ['tstep -0.5\n', 'trange 3000.\n']
+
+
+@pytest.mark.parametrize('covariance', [False, True])
+def test_initial_conditions(tmp_path, covariance):
+    '''
+    Test that many initial conditions, written in several chunks, are read
+    back exactly.
+    '''
+    rng = np.random.default_rng(16)
+    n_objects = 1000
+    designations = np.array([f'K20A{i:04d}X' for i in range(n_objects)])
+    jd_tdb = 2459000.5 + rng.integers(0, 3, n_objects) * 10.
+    states = rng.normal(size=(n_objects, 6))
+    matrices = rng.normal(size=(n_objects, 6, 6))
+    covariances = matrices @ matrices.transpose(0, 2, 1)
+    ic_file = str(tmp_path / 'ics')
+    with parse_input.ICWriter(ic_file, tstep=-5., trange=100.,
+                              covariance=covariance) as writer:
+        for chunk in np.array_split(np.arange(n_objects), 3):
+            writer.write(designations[chunk], jd_tdb[chunk], states[chunk],
+                         covariances[chunk] if covariance else None)
+    assert writer.n_objects == n_objects
+    elements, parameters = parse_input.read_initial_conditions(ic_file)
+    assert parameters == {'tstep': -5., 'trange': 100., 'geocentric': False,
+                          'covariance': covariance}
+    assert np.all(elements['designation'] == designations)
+    assert np.all(elements['jd_tdb'] == jd_tdb)
+    assert np.all(elements['state'] == states)
+    if covariance:
+        assert np.all(elements['covariance'] == covariances)
+    else:
+        assert np.all(np.isnan(elements['covariance']))
+
+
+def test_initial_conditions_extremes(tmp_path):
+    '''
+    Test that values with 3-digit exponents, infinities and NaNs are read
+    back exactly.
+    '''
+    states = np.array([[1e-120, -1e-300, 1e300, -1.7976931348623157e308,
+                        np.inf, np.nan],
+                       [-5e-324, 1e-100, 0., 0., 0., 0.],
+                       [-2.5e-5, 1., -5e-24, 0., -0., 123.456]])
+    ic_file = str(tmp_path / 'ics')
+    with parse_input.ICWriter(ic_file) as writer:
+        writer.write(['a', 'b', 'c'], 2459000.5, states)
+    elements, _ = parse_input.read_initial_conditions(ic_file)
+    assert np.array_equal(elements['state'], states, equal_nan=True)
+
+
+def test_initial_conditions_errors(tmp_path):
+    '''Test that bad designations and files are refused.'''
+    ic_file = str(tmp_path / 'ics')
+    with parse_input.ICWriter(ic_file, covariance=True) as writer:
+        with pytest.raises(ValueError):
+            writer.write(['a very long designation'], 2459000.5,
+                         np.zeros((1, 6)), np.eye(6))
+        with pytest.raises(ValueError):
+            writer.write(['\u03a9mega'], 2459000.5, np.zeros((1, 6)),
+                         np.eye(6))
+        with pytest.raises(TypeError):
+            writer.write(['30101'], 2459000.5, np.zeros((1, 6)))
+    elements, _ = parse_input.read_initial_conditions(ic_file)
+    assert len(elements) == 0
+    with pytest.raises(TypeError):
+        parse_input.read_initial_conditions(
+            os.path.join(DATA_DIR, 'holman_ic_junk'))
+
+
 @pytest.mark.parametrize(
     ('target', 'jd_tdb', 'id_type'),
     [
@@ -168,6 +284,219 @@ def test_ecliptic_to_equatorial(target, jd_tdb, id_type, centre):
     assert np.all(error[3:6] < 1e-14)  # V accurate to 1.5 milli-metres/day
 
 
+@pytest.mark.parametrize(('backwards'), [False, True])
+def test_vectorized_transforms(backwards):
+    '''
+    Test that (N, 6) arrays give the same result as one vector at a time.
+    '''
+    rng = np.random.default_rng(42)
+    xyzv = rng.uniform(-5, 5, (10, 6)) * np.array([1] * 3 + [0.01] * 3)
+    jd_tdb = 2458937.0 + rng.uniform(-1000, 1000, 10)
+    # Rotation
+    output_xyzv = parse_input.ecliptic_to_equatorial(xyzv, backwards)
+    for i in range(10):
+        assert np.all(output_xyzv[i] ==
+                      parse_input.ecliptic_to_equatorial(list(xyzv[i]),
+                                                         backwards))
+    # Helio <-> bary, with per-object and shared epochs
+    output_xyzv = parse_input.equatorial_helio2bary(xyzv, jd_tdb, backwards)
+    shared_xyzv = parse_input.equatorial_helio2bary(xyzv, jd_tdb[0],
+                                                    backwards)
+    for i in range(10):
+        error = np.abs(output_xyzv[i] - parse_input.equatorial_helio2bary(
+                       list(xyzv[i]), jd_tdb[i], backwards))
+        assert np.all(error < 1e-15)
+        error = np.abs(shared_xyzv[i] - parse_input.equatorial_helio2bary(
+                       list(xyzv[i]), jd_tdb[0], backwards))
+        assert np.all(error < 1e-15)
+
+
+def test_sun_offset_cache():
+    '''
+    Test that the Sun offset cache agrees with the kernel, counts hits and
+    misses, and evicts the least recently used epochs.
+    '''
+    cache = parse_input.SunOffsetCache(maxsize=3)
+    jd_tdb = np.array([2458937.0, 2458937.0, 2458998.0, 2458937.0])
+    delta, delta_vel = cache(jd_tdb)
+    kernel_delta, kernel_vel = parse_input._kernel_sun_offset(jd_tdb)
+    assert np.all(delta == kernel_delta) & np.all(delta_vel == kernel_vel)
+    assert cache.stats['misses'] == 2
+    assert cache.stats['hits'] == 2  # Per requested epoch: repeats are hits
+    assert cache.stats['kernel_calls'] == 1
+    cache(2458937.0)
+    assert cache.stats['hits'] == 3
+    # 2458998.0 is now the least recently used and should be evicted
+    cache([2459000.0, 2459001.0])
+    assert len(cache._cache) == 3
+    assert 2458998.0 not in cache._cache
+    assert 2458937.0 in cache._cache
+
+
+def test_sun_offset_table():
+    '''
+    Test that the Chebyshev table meets its tolerances without the kernel.
+    '''
+    cache = parse_input.SunOffsetCache()
+    table = cache.build_table(2458800.5, 2459200.5, tolerance=1e-14)
+    assert table.position_error <= 1e-14
+    assert table.velocity_error <= 1e-14
+    jd_tdb = np.linspace(2458800.5, 2459200.5, 1001)
+    delta, delta_vel = cache(jd_tdb)
+    kernel_delta, kernel_vel = parse_input._kernel_sun_offset(jd_tdb)
+    assert cache.stats['kernel_calls'] == 0
+    assert cache.stats['table_evaluations'] == 1001
+    assert np.all(np.abs(delta - kernel_delta) < 1e-14)
+    assert np.all(np.abs(delta_vel - kernel_vel) < 1e-14)
+    with pytest.raises(ValueError):  # The velocity is checked too
+        parse_input.SunOffsetTable(2458800.5, 2459200.5, tolerance=1e-10,
+                                   velocity_tolerance=1e-30, max_halvings=1)
+
+
+def test_parse_mpcorb_batch():
+    '''
+    Test that an MPCORB-format file is parsed into columns, skipping the
+    header and reporting malformed lines.
+    '''
+    mpcorb_file = os.path.join(DATA_DIR, 'MPCORB_sample.DAT')
+    elements, failures = parse_input.parse_mpcorb_batch(mpcorb_file)
+    assert list(elements['designation']) == ['00001', '00002', '30101',
+                                             'K19A00A']
+    assert [f[0] for f in failures] == [mpcorb_file + ':13',
+                                        mpcorb_file + ':14']
+    assert np.all(elements['mjd_tt'] == [59000., 59000., 59000., 58858.])
+    assert elements['H'][2] == 13.7
+    assert np.isnan(elements['G'][2])  # Blank in the file
+    assert np.all(elements['keplerian'][0] ==
+                  [2.7691652, 0.0760091, np.radians(10.59407),
+                   np.radians(80.30553), np.radians(73.59764),
+                   np.radians(77.37209)])
+    # The single-object parser takes the first orbit
+    P = parse_input.ParseElements(mpcorb_file, 'mpcorb', save_parsed=False)
+    assert np.all(P.heliocentric_ecliptic_keplerian ==
+                  elements['keplerian'][0])
+    jd_tdb, xyzv_bar_equ, cov_bar_equ = parse_input.bary_equatorial_batch(
+        elements)
+    assert jd_tdb[0] == P.epoch_jd_tdb
+    assert np.all(xyzv_bar_equ[0] == P.barycentric_equatorial_state)
+    assert np.all(np.isnan(cov_bar_equ))
+
+
+def test_parse_cache(tmp_path, monkeypatch):
+    '''
+    Test that re-parsing an unchanged file comes from the cache, without
+    converting again, and gives the same elements.
+    '''
+    cache = DiskCache(str(tmp_path / 'parse'))
+    data_file = os.path.join(DATA_DIR, '30101.eq0_postfit')
+    P = parse_input.ParseElements(data_file, 'eq', save_parsed=False,
+                                  cache=cache)
+    assert cache.stats['misses'] == 1 and cache.stats['writes'] == 1
+
+    def not_again(*args, **kwargs):
+        raise AssertionError("Converted again")
+    monkeypatch.setattr(parse_input, 'equatorial_helio2bary', not_again)
+    cached = parse_input.ParseElements(data_file, 'eq', save_parsed=False,
+                                       cache=cache)
+    assert cache.stats['hits'] == 1
+    assert dict(cached.barycentric_equatorial_cartesian_elements) == \
+        dict(P.barycentric_equatorial_cartesian_elements)
+    assert dict(cached.heliocentric_ecliptic_cartesian_elements) == \
+        dict(P.heliocentric_ecliptic_cartesian_elements)
+    assert cached.epoch_jd_tdb == P.epoch_jd_tdb
+    assert cached.epoch_mjd_tt == P.epoch_mjd_tt
+    # A changed file is a different key
+    changed_file = str(tmp_path / 'changed.eq0')
+    with open(data_file) as infile, open(changed_file, 'w') as outfile:
+        outfile.write(infile.read().replace('30101', '30103'))
+    with pytest.raises(AssertionError):
+        parse_input.ParseElements(changed_file, 'eq', save_parsed=False,
+                                  cache=cache)
+    # Approximate Sun offsets (from a table) are a different key
+    table_cache = parse_input.SunOffsetCache()
+    table_cache.build_table(P.epoch_jd_tdb - 10, P.epoch_jd_tdb + 10)
+    monkeypatch.setattr(parse_input, 'sun_offset_cache', table_cache)
+    with pytest.raises(AssertionError):
+        parse_input.ParseElements(data_file, 'eq', save_parsed=False,
+                                  cache=cache)
+    # No cache at all
+    monkeypatch.delenv('MPC_NBODY_CACHE_DIR', raising=False)
+    with pytest.raises(AssertionError):
+        parse_input.ParseElements(data_file, 'eq', save_parsed=False)
+
+
+def test_bary_equatorial_batch():
+    '''
+    Test that batch conversion agrees with ParseElements.make_bary_equatorial.
+    '''
+    data_files = [os.path.join(DATA_DIR, data_file)
+                  for data_file in ['30101.eq0_postfit', '30102.eq0_postfit']]
+    elements, _ = parse_input.parse_orbfit_batch(data_files)
+    jd_tdb, xyzv_bar_equ, cov_bar_equ = parse_input.bary_equatorial_batch(
+        elements)
+    for i, data_file in enumerate(data_files):
+        P = parse_input.ParseElements(data_file, 'eq', save_parsed=False)
+        els = P.barycentric_equatorial_cartesian_elements
+        assert jd_tdb[i] == P.epoch_jd_tdb
+        error, good_tf = compare_xyzv(
+            xyzv_bar_equ[i], [els[key] for key in ['x_BaryEqu', 'y_BaryEqu',
+                                                  'z_BaryEqu', 'dx_BaryEqu',
+                                                  'dy_BaryEqu', 'dz_BaryEqu']],
+            1e-15, 1e-17)
+        assert np.all(good_tf)
+        assert np.all(cov_bar_equ[i] == P.barycentric_equatorial_covariance)
+
+
+@pytest.mark.filterwarnings('ignore::erfa.ErfaWarning')  # future UTC
+def test_mjd_tt_to_jd_tdb():
+    '''
+    Test the TT -> TDB conversion against astropy, for scalars & arrays,
+    and that ParseElements still offers its epoch as an astropy Time.
+    '''
+    from astropy.time import Time
+    mjd_tt = np.linspace(15020., 88069., 100001)  # 1900 - 2100
+    astropy_time = Time(mjd_tt, format='mjd', scale='tt')
+    tdb, tt = astropy_time.tdb, astropy_time.tt
+    astropy_tdb_tt = ((tdb.jd1 - tt.jd1) + (tdb.jd2 - tt.jd2)) * 86400.
+    tdb_tt = parse_input.tdb_minus_tt(mjd_tt + 2400000.5)
+    assert np.all(np.abs(tdb_tt - astropy_tdb_tt) < 1e-6)
+    jd_tdb = parse_input.mjd_tt_to_jd_tdb(mjd_tt)
+    # Beyond the series, only float64 rounding of the Julian Date remains.
+    assert np.all(np.abs(jd_tdb - tdb.jd) <= 2 * np.spacing(jd_tdb))
+    assert parse_input.mjd_tt_to_jd_tdb(mjd_tt[7]) == jd_tdb[7]
+    P = parse_input.ParseElements(os.path.join(DATA_DIR, '30101.eq0_postfit'),
+                                  'eq', save_parsed=False)
+    assert isinstance(P.epoch_jd_tdb, float)
+    assert P.time.tt.mjd == P.epoch_mjd_tt
+    assert abs(P.time.tdb.jd - P.epoch_jd_tdb) <= 2 * np.spacing(P.epoch_jd_tdb)
+
+
+def test_rotate_covariance():
+    '''
+    Test that covariances are rotated along with the state they describe.
+    '''
+    P = parse_input.ParseElements()
+    P.parse_orbfit(os.path.join(DATA_DIR, '30101.eq0_postfit'))
+    cov_hel_ecl = P.heliocentric_ecliptic_covariance
+    els = P.heliocentric_ecliptic_cartesian_elements
+    assert cov_hel_ecl.shape == (6, 6)
+    assert np.all(cov_hel_ecl == cov_hel_ecl.T)
+    assert cov_hel_ecl[0, 0] == float(els['sigma_x_HelioEcl'])
+    assert cov_hel_ecl[5, 3] == float(els['dx_dz_HelioEcl'])
+    # Rotating a batch is the same as rotating one at a time
+    covs = np.array([cov_hel_ecl, 2 * cov_hel_ecl, cov_hel_ecl.T])
+    rotated = parse_input.rotate_covariance(covs)
+    assert rotated.shape == (3, 6, 6)
+    for i in range(3):
+        assert np.allclose(rotated[i], parse_input.rotate_covariance(covs[i]),
+                           rtol=1e-14, atol=0)
+    # Compare with the rotation of the state vectors
+    R = parse_input.ecliptic_to_equatorial(np.eye(6)).T
+    assert np.allclose(rotated[0], R @ cov_hel_ecl @ R.T, rtol=1e-12, atol=0)
+    assert np.allclose(parse_input.rotate_covariance(rotated, True), covs,
+                       rtol=1e-12, atol=0)
+
+
 @pytest.mark.parametrize(
     ('data_file', 'file_type', 'test_result_file'),
     [
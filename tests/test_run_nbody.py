@@ -31,7 +31,10 @@ sys.path.append(os.path.dirname(os.path.dirname(
     os.path.realpath(__file__))))
 from tests.test_parse_input import is_parsed_good_enough, compare_xyzv
 from mpc_nbody import mpc_nbody
+from mpc_nbody import parse_input
+from mpc_nbody import metrics
 from mpc_nbody.parse_input import ParseElements
+from mpc_nbody.cache import DiskCache, ResultCache
 
 # Default for caching stuff using lru_cache
 # -----------------------------------------------------------------------------
@@ -39,9 +42,18 @@ from mpc_nbody.parse_input import ParseElements
 # Convenience functions
 # -----------------------------------------------------------------------------
 
+def structured_states(dtype):
+    '''STATES as a structured array of the given dtype.'''
+    states = np.zeros(len(STATES), dtype=dtype)
+    for i, name in enumerate(parse_input.BARY_EQU_DTYPE.names):
+        states[name] = STATES[:, i]
+    return states
+
+
 # Constants & Test Data
 # -----------------------------------------------------------------------------
 DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'dev_data')
+STATES = np.arange(30.).reshape(5, 6)
 
 
 # Tests
@@ -189,6 +201,567 @@ def test_NbodySim(data_file, file_type, holman_ic_test_file, nbody_test_file):
                                 target=data_file[:5])
 
 
+def test_fix_input_copies():
+    '''
+    Test that a parsed object's state is copied, but arrays in the right
+    layout are handed over without copying.
+    '''
+    P = ParseElements(os.path.join(DATA_DIR, '30101.eq0_horizons'), 'eq',
+                      save_parsed=False)
+    reparsed, n_particles = mpc_nbody._fix_input(P)
+    assert np.all(reparsed == P.barycentric_equatorial_state)
+    assert not np.shares_memory(reparsed, P.barycentric_equatorial_state)
+    assert n_particles == 1
+    assert np.shares_memory(mpc_nbody._fix_input(reparsed)[0], reparsed)
+
+
+@pytest.mark.parametrize(('pinput', 'zero_copy'), [
+    (STATES, True),
+    (STATES.reshape(-1), True),
+    (np.asfortranarray(STATES), False),
+    (STATES[::-1][::-1], True),
+    (STATES.astype(np.float32), False),
+    (STATES.tolist(), False),
+    (structured_states(parse_input.BARY_EQU_DTYPE), True),
+    (structured_states([('designation', 'U7')] +
+                       parse_input.BARY_EQU_DTYPE.descr), False),
+    ])
+def test_fix_input(pinput, zero_copy):
+    '''
+    Test that (N, 6), (6N,) and structured inputs all become one flat
+    C-contiguous array, without copying if they already have that layout.
+    '''
+    reparsed, n_particles = mpc_nbody._fix_input(pinput)
+    assert n_particles == 5
+    assert reparsed.dtype == np.float64
+    assert reparsed.flags.c_contiguous
+    assert np.all(reparsed == STATES.reshape(-1))
+    if isinstance(pinput, np.ndarray):
+        assert np.shares_memory(reparsed, pinput) == zero_copy
+
+
+@pytest.mark.parametrize(('pinput'), [
+    np.zeros((5, 5)), np.zeros(7), np.array(['1.'] * 6),
+    np.zeros(3, dtype=parse_input.ORBFIT_DTYPE), 'holman_ic',
+    [[1.] * 6, [1.] * 5]])
+def test_fix_input_bad(pinput):
+    '''Test that malformed inputs are rejected.'''
+    with pytest.raises(TypeError):
+        mpc_nbody._fix_input(pinput)
+
+
+def test_group_by_epoch():
+    '''
+    Test that objects get grouped by epoch, preserving their order.
+    '''
+    groups = mpc_nbody.group_by_epoch(np.array([3., 1., 3., 2., 1.]))
+    assert [epoch for epoch, _ in groups] == [1., 2., 3.]
+    assert [list(indices) for _, indices in groups] == [[1, 4], [3], [0, 2]]
+
+
+@pytest.mark.parametrize(
+    ('input_files', 'compare_to_horizons'),
+    [
+     (os.path.join(DATA_DIR, '*.eq0_horizons'), True),
+     ([os.path.join(DATA_DIR, '30101.eq0_horizons'),
+       os.path.join(DATA_DIR, '30102.eq0_horizons')], True),
+     (DATA_DIR, False),  # The postfit orbits too, but not the README
+      ])
+def test_NbodySim_many_files(input_files, compare_to_horizons):
+    '''
+    Test the mpc_nbody.NbodySim class with many input files.
+    Objects with different epochs are integrated in separate groups.
+    '''
+    Sim = mpc_nbody.NbodySim(input_files, 'eq')
+    assert 30101 in [int(d) for d in Sim.designations]
+    assert 30102 in [int(d) for d in Sim.designations]
+    Sim(tstep=20, trange=600)
+    assert len(Sim.epoch_groups) == len(np.unique(Sim.input_epochs))
+    n_objects = 0
+    for designation, times, data in Sim.iter_object_outputs():
+        n_objects += 1
+        assert data.shape == (len(times), 6)
+        if compare_to_horizons:
+            is_nbody_output_good_enough(times, data[:, np.newaxis, :],
+                                        target=designation)
+    assert n_objects == len(Sim.designations)
+    times, data = Sim.object_output('30102')
+    assert times[0] == Sim.input_epochs[list(Sim.designations).index('30102')]
+
+
+def test_expand_input_files(tmp_path):
+    '''
+    Test that only the files of the filetype are used from a directory.
+    '''
+    for name in ['30101.eq0', '30102.eq1', 'README.md', 'MPCORB.DAT']:
+        (tmp_path / name).write_text('')
+    (tmp_path / 'subdir.eq0').mkdir()
+    assert mpc_nbody._expand_input_files(str(tmp_path), 'eq') == [
+        str(tmp_path / '30101.eq0'), str(tmp_path / '30102.eq1')]
+    assert mpc_nbody._expand_input_files(str(tmp_path), 'mpcorb') == [
+        str(tmp_path / 'MPCORB.DAT')]
+    with pytest.raises(TypeError):
+        mpc_nbody._expand_input_files(str(tmp_path), 'ic')
+    assert mpc_nbody._expand_input_files(str(tmp_path / '*.md'), 'ic') == [
+        str(tmp_path / 'README.md')]
+
+
+def test_NbodySim_initial_conditions(tmp_path):
+    '''
+    Test integrating all the objects of an initial conditions file.
+    '''
+    ic_file = str(tmp_path / 'ics')
+    Sim = mpc_nbody.NbodySim(os.path.join(DATA_DIR, 'MPCORB_sample.DAT'),
+                             'mpcorb')
+    with parse_input.ICWriter(ic_file, tstep=20, trange=60) as writer:
+        writer.write(Sim.designations, Sim.input_epochs, Sim.input_states)
+    ICSim = mpc_nbody.NbodySim(ic_file, 'ic')
+    assert np.all(ICSim.designations == Sim.designations)
+    assert np.all(ICSim.input_states == Sim.input_states)
+    assert (ICSim.tstep, ICSim.trange, ICSim.geocentric) == (20, 60, False)
+    ICSim()  # With the parameters of the file
+    Sim(tstep=20, trange=60)
+    assert np.all(ICSim.object_output('30101')[1] ==
+                  Sim.object_output('30101')[1])
+
+
+def test_NbodySim_mpcorb(tmp_path):
+    '''
+    Test integrating all the orbits of an MPCORB-format file.
+    '''
+    Sim = mpc_nbody.NbodySim(os.path.join(DATA_DIR, 'MPCORB_sample.DAT'),
+                             'mpcorb')
+    assert list(Sim.designations) == ['00001', '00002', '30101', 'K19A00A']
+    assert len(Sim.parse_failures) == 2
+    with pytest.raises(TypeError):
+        Sim(tstart=Sim.input_epochs[0], tstep=20, trange=60)
+    Sim(tstep=20, trange=60)
+    assert [len(group['indices']) for group in Sim.epoch_groups] == [1, 3]
+    with pytest.raises(TypeError):
+        Sim.fit_chebyshev()
+    with pytest.raises(TypeError):
+        Sim.save_output(str(tmp_path / 'simulation_states.dat'))
+    times, data = Sim.object_output('30101')
+    assert times[0] == Sim.input_epochs[2]
+    assert np.all(data[0] == Sim.input_states[2])
+
+
+@pytest.mark.parametrize(('chunk_size'), [1, 2])
+def test_run_nbody_parallel(chunk_size):
+    '''
+    Test that the parallel driver reproduces serial run_nbody results,
+    in input order, for orbits with different start times.
+    '''
+    particles = [ParseElements(os.path.join(DATA_DIR, data_file), 'eq',
+                               save_parsed=False)
+                 for data_file in ['30102.eq0_horizons', '30101.eq0_horizons',
+                                   '30102.eq0_postfit']]
+    states = np.array([mpc_nbody._fix_input(P)[0] for P in particles])
+    tstarts = np.array([P.epoch_jd_tdb for P in particles])
+    (final_times, final_states, chunks, failures
+     ) = mpc_nbody.run_nbody_parallel(states, tstarts, 20, 600,
+                                      chunk_size=chunk_size, max_workers=2)
+    assert failures == []
+    # Serial runs with the same grouping must give identical results.
+    groups = [[0], [1], [2]] if chunk_size == 1 else [[0, 2], [1]]
+    for group in groups:
+        (_, _, output_times, output_vectors, _, _
+         ) = mpc_nbody.run_nbody([particles[i] for i in group],
+                                 tstarts[group[0]], 20, 600)
+        for j, i in enumerate(group):
+            assert final_times[i] == output_times[-1]
+            assert np.all(final_states[i] == output_vectors[-1, j, :])
+        chunk = [chunk for chunk in chunks if chunk['indices'][0] == group[0]]
+        assert list(chunk[0]['indices']) == group
+        assert np.all(chunk[0]['output_times'] == output_times)
+        assert np.all(chunk[0]['output_vectors'] == output_vectors)
+    assert [chunk['indices'][0] for chunk in chunks] == \
+        sorted(group[0] for group in groups)
+    # Only the final states
+    (final_times_only, final_states_only, chunks, _
+     ) = mpc_nbody.run_nbody_parallel(states, tstarts, 20, 600,
+                                      chunk_size=chunk_size, max_workers=2,
+                                      full_output=False)
+    assert np.all(final_states_only == final_states)
+    assert all(len(chunk['output_times']) == 1 for chunk in chunks)
+
+
+def test_run_nbody_parallel_failure():
+    '''
+    Test that a failing chunk is reported without aborting the others.
+    '''
+    states = np.array([[-3.1, 2.7, 3.6, -0.006, -0.004, -0.002],
+                       [np.nan] * 6,
+                       [-3.0, 2.7, 3.6, -0.006, -0.004, -0.002]])
+    (final_times, final_states, chunks, failures
+     ) = mpc_nbody.run_nbody_parallel(states, 2456184.7, 20.0, 600,
+                                      chunk_size=1)
+    assert np.all(np.isfinite(final_states[[0, 2]]))
+    assert np.all(np.isfinite(final_times[[0, 2]]))
+    assert len(failures) == 1
+    assert list(failures[0][0]) == [1]
+    assert failures[0][1].startswith('ValueError')
+    assert np.isnan(final_times[1]) and np.all(np.isnan(final_states[1]))
+    assert [list(chunk['indices']) for chunk in chunks] == [[0], [2]]
+
+
+@pytest.mark.parametrize(('mmap_mode'), ['r', None])
+def test_save_binary_output(tmp_path, mmap_mode):
+    '''
+    Test that binary output can be saved and loaded back (memory-mapped).
+    '''
+    Sim = mpc_nbody.NbodySim(os.path.join(DATA_DIR, '30101.eq0_horizons'),
+                             'eq')
+    output_file = str(tmp_path / 'simulation_states.bin')
+    Sim(tstep=20, trange=600, save_output=output_file, binary_output=True)
+    Loaded = mpc_nbody.NbodySim()
+    Loaded.load_output(output_file, mmap_mode=mmap_mode)
+    assert isinstance(Loaded.output_vectors,
+                      np.memmap if mmap_mode else np.ndarray)
+    assert np.all(Loaded.output_vectors == Sim.output_vectors)
+    assert np.all(Loaded.output_times == Sim.output_times)
+    assert np.all(Loaded.input_vectors == Sim.input_vectors)
+    assert Loaded.time_parameters == Sim.time_parameters
+    assert Loaded.output_n_times == Sim.output_n_times
+    assert Loaded.output_n_particles == Sim.output_n_particles
+    with pytest.raises(TypeError):
+        mpc_nbody.load_output(os.path.join(DATA_DIR, 'holman_ic_junk'))
+
+
+def test_NbodySim_output_store(tmp_path):
+    '''
+    Test integrating into a disk-backed output store, in several windows.
+    '''
+    Sim = mpc_nbody.NbodySim(os.path.join(DATA_DIR, '30101.eq0_horizons'),
+                             'eq')
+    store = mpc_nbody.OutputStore(str(tmp_path / 'store'), time_window=200.,
+                                  particle_block=1)
+    Sim(tstep=20, trange=600, output_store=store)
+    assert store.n_windows == 3
+    assert Sim.output_vectors.shape == (len(Sim.output_times), 1, 6)
+    assert np.all(np.diff(Sim.output_times) > 0)
+    assert Sim.output_times[-1] >= Sim.time_parameters[0] + 600
+    is_nbody_output_good_enough(Sim.output_times, Sim.output_vectors,
+                                target='30101')
+    Loaded = mpc_nbody.NbodySim()
+    Loaded.load_output(str(tmp_path / 'store'))
+    assert np.all(Loaded.output_vectors[:, 0] == Sim.output_vectors[:, 0])
+
+
+def test_extend(tmp_path):
+    '''
+    Test that extending an integration, in memory or in an output store,
+    or resuming an interrupted one, matches integrating in one go.
+    '''
+    vectors = np.array([-2.093834952466475E+00, 1.000913720009255E+00,
+                        4.197984954533551E-01, -4.226738336365523E-03,
+                        -9.129140909705199E-03, -3.627121453928710E-03])
+    tstart = 2456117.641933589
+    (_, _, times, expected, _, _
+     ) = mpc_nbody.run_nbody(vectors, tstart, 20, 600, use_cache=False)
+    Sim = mpc_nbody.NbodySim()
+    Sim(vectors=vectors, tstart=tstart, tstep=20, trange=300)
+    Sim.extend(300)
+    assert np.allclose(Sim.output_times, times, rtol=0, atol=1e-6)
+    assert np.allclose(Sim.output_vectors, expected, rtol=1e-10, atol=0)
+    assert Sim.output_n_times == len(times)
+    assert np.isclose(Sim.time_parameters[2], times[-1] - tstart)
+    with pytest.raises(ValueError):
+        Sim.extend(-100)
+    # In an output store, also after re-opening it
+    Stored = mpc_nbody.NbodySim()
+    Stored(vectors=vectors, tstart=tstart, tstep=20, trange=300,
+           output_store=mpc_nbody.OutputStore(str(tmp_path / 'store'),
+                                              time_window=200.))
+    Reopened = mpc_nbody.NbodySim()
+    Reopened.load_output(str(tmp_path / 'store'))
+    Reopened.extend(300)
+    assert Reopened.output_store.n_windows == 4
+    assert np.allclose(Reopened.output_times, times, rtol=0, atol=1e-6)
+    assert np.allclose(np.asarray(Reopened.output_vectors), expected,
+                       rtol=1e-10, atol=0)
+    # Resuming an integration that was interrupted after one window
+    store = mpc_nbody.OutputStore(str(tmp_path / 'resumed'), time_window=200.)
+    mpc_nbody.run_nbody_chunked(vectors, tstart, 20, 600, store)
+    del store.meta['window_n_times'][1:]
+    store._save_meta()
+    resumed = mpc_nbody.extend_output_store(str(tmp_path / 'resumed'))
+    assert resumed.n_windows == 3
+    assert resumed.meta['time_parameters'] == [tstart, 20., 600.]
+    assert np.allclose(np.asarray(resumed.vectors()), expected, rtol=1e-10,
+                       atol=0)
+
+
+@pytest.mark.parametrize(('parallel'), [True, False])
+def test_run_nbody_bidirectional(parallel):
+    '''
+    Test integrating backward & forward from a mid-arc epoch in one call
+    against two separate integrations.
+    '''
+    vectors = np.array([-2.093834952466475E+00, 1.000913720009255E+00,
+                        4.197984954533551E-01, -4.226738336365523E-03,
+                        -9.129140909705199E-03, -3.627121453928710E-03])
+    tstart = 2456117.641933589
+    (_, n_particles, times, output_vectors, n_times, _
+     ) = mpc_nbody.run_nbody_bidirectional(vectors, tstart, 20, tstart - 200,
+                                           tstart + 300, parallel=parallel,
+                                           use_cache=False)
+    (_, _, back_times, back_vectors, _, _
+     ) = mpc_nbody.run_nbody(vectors, tstart, 20, -200, use_cache=False)
+    (_, _, fwd_times, fwd_vectors, _, _
+     ) = mpc_nbody.run_nbody(vectors, tstart, 20, 300, use_cache=False)
+    assert n_times == len(back_times) + len(fwd_times) - 1
+    assert np.all(np.diff(times) > 0)
+    assert times[0] <= tstart - 200 and times[-1] >= tstart + 300
+    assert np.all(times == np.concatenate([back_times[::-1], fwd_times[1:]]))
+    assert np.all(output_vectors == np.concatenate([back_vectors[::-1],
+                                                    fwd_vectors[1:]]))
+    # Only one leg
+    (_, _, times, output_vectors, _, _
+     ) = mpc_nbody.run_nbody_bidirectional(vectors, tstart, 20, tstart,
+                                           tstart + 300, parallel=parallel)
+    assert np.all(times == fwd_times)
+    with pytest.raises(ValueError):
+        mpc_nbody.run_nbody_bidirectional(vectors, tstart, 20, tstart + 1,
+                                          tstart + 300)
+    # Through NbodySim
+    Sim = mpc_nbody.NbodySim()
+    Sim(vectors=vectors, tstart=tstart, tstep=20,
+        tbounds=(tstart - 200, tstart + 300))
+    assert np.all(Sim.output_times == np.concatenate([back_times[::-1],
+                                                      fwd_times[1:]]))
+    with pytest.raises(TypeError):
+        Sim(vectors=vectors, tstart=tstart, tbounds=(tstart - 200, tstart),
+            output_epochs=1.)
+
+
+def test_run_nbody_stm(tmp_path):
+    '''
+    Test the state transition matrices against integrating a slightly
+    displaced particle, and the covariances propagated with them.
+    '''
+    vectors = np.array([-2.093834952466475E+00, 1.000913720009255E+00,
+                        4.197984954533551E-01, -4.226738336365523E-03,
+                        -9.129140909705199E-03, -3.627121453928710E-03])
+    tstart = 2456117.641933589
+    (_, n_particles, times, output_vectors, n_times, _, stm
+     ) = mpc_nbody.run_nbody_stm(vectors, tstart, 20, 300, use_cache=False)
+    assert stm.shape == (n_times, 1, 6, 6)
+    assert np.allclose(stm[0, 0], np.eye(6), rtol=0, atol=1e-12)
+    # Hamiltonian flow: phase space volume is conserved
+    assert np.allclose(np.linalg.det(stm), 1, rtol=0, atol=1e-6)
+    (_, _, _, nominal, _, _
+     ) = mpc_nbody.run_nbody(vectors, tstart, 20, 300, use_cache=False)
+    # Integrated along with the clones, so the sub-steps may differ slightly
+    assert np.allclose(output_vectors, nominal, rtol=0, atol=1e-12)
+    displacement = np.array([1e-5, -2e-5, 1e-5, 1e-7, 2e-7, -1e-7])
+    (_, _, _, displaced, _, _
+     ) = mpc_nbody.run_nbody(vectors + displacement, tstart, 20, 300,
+                             use_cache=False)
+    assert np.allclose(displaced - nominal, stm @ displacement,
+                       rtol=0, atol=1e-8)
+    # Through NbodySim, with the covariances of two objects
+    covariances = np.array([np.diag([1e-12] * 3 + [1e-16] * 3),
+                            np.diag([4e-12] * 3 + [1e-16] * 3)])
+    ic_file = str(tmp_path / 'ics')
+    with parse_input.ICWriter(ic_file, covariance=True) as writer:
+        writer.write(['30101', '30102'], tstart, [vectors, vectors + 1e-3],
+                     covariances)
+    Sim = mpc_nbody.NbodySim(ic_file, 'ic')
+    Sim(tstep=20, trange=300, stm=True)
+    assert Sim.output_stm.shape == (len(Sim.output_times), 2, 6, 6)
+    assert np.allclose(Sim.output_stm[:, 0], stm[:, 0], rtol=0, atol=1e-8)
+    phi = Sim.output_stm[-1, 1]
+    assert np.allclose(Sim.output_covariances[-1, 1],
+                       phi @ covariances[1] @ phi.T, rtol=1e-12, atol=0)
+    with pytest.raises(TypeError):
+        Sim(tstep=20, trange=300, stm=True, output_epochs=1.)
+    Sim.extend(100)
+    assert Sim.output_stm is None
+
+
+def test_run_nbody_clones(tmp_path):
+    '''
+    Test integrating covariance clones of several objects together against
+    integrating single clones, and through NbodySim.
+    '''
+    states = np.array([[-2.093834952466475E+00, 1.000913720009255E+00,
+                        4.197984954533551E-01, -4.226738336365523E-03,
+                        -9.129140909705199E-03, -3.627121453928710E-03],
+                       [3.040097230145563E+00, -1.132938188924467E+00,
+                        -4.208727373454452E-01, 3.441281582008468E-03,
+                        8.403862178102574E-03, 3.283939023926049E-03]])
+    covariances = np.diag([1e-12] * 3 + [1e-16] * 3) * np.ones((2, 1, 1))
+    tstart = 2456117.641933589
+    clones, times, clone_vectors = mpc_nbody.run_nbody_clones(
+        states, covariances, tstart, 20, 100, 4, rng=3,
+        include_nominal=True, use_cache=False)
+    assert clones.shape == (2, 4, 6)
+    assert clone_vectors.shape == (len(times), 2, 4, 6)
+    for obj, clone in [(0, 0), (1, 3)]:
+        (_, _, single_times, single_vectors, _, _
+         ) = mpc_nbody.run_nbody(clones[obj, clone], tstart, 20, 100,
+                                 use_cache=False)
+        assert np.all(single_times == times)
+        assert np.allclose(single_vectors[:, 0], clone_vectors[:, obj, clone],
+                           rtol=1e-13, atol=0)
+    # Through NbodySim, with two epochs
+    ic_file = str(tmp_path / 'ics')
+    with parse_input.ICWriter(ic_file, covariance=True) as writer:
+        writer.write(['30101', '30102'], [tstart, tstart + 10], states,
+                     covariances)
+    Sim = mpc_nbody.NbodySim(ic_file, 'ic')
+    Sim.run_clones(4, tstep=20, trange=100, rng=3)
+    assert [group['tstart'] for group in Sim.clone_groups] == \
+        [tstart, tstart + 10]
+    assert Sim.clone_groups[1]['clone_vectors'].shape[1:] == (1, 4, 6)
+
+
+def test_hermite_interpolate():
+    '''
+    Test interpolating a circular orbit between output times.
+    '''
+    n = 0.01720209895
+    times = 2456117.5 + np.arange(0, 100, 1.)
+    fine_times = np.linspace(times[0], times[-1], 397)
+    def circle(t):
+        phase = n * (t - times[0])
+        return np.stack([np.cos(phase), np.sin(phase), 0 * phase,
+                         -n * np.sin(phase), n * np.cos(phase), 0 * phase],
+                        axis=-1)[:, None, :]
+    interpolated = mpc_nbody.hermite_interpolate(times, circle(times),
+                                                 fine_times)
+    assert interpolated.shape == (len(fine_times), 1, 6)
+    assert np.all(np.abs(interpolated - circle(fine_times))[..., :3] < 1e-9)
+    assert np.all(np.abs(interpolated - circle(fine_times))[..., 3:] < 1e-9)
+    # Exact at the output times themselves, also if times decrease.
+    assert np.all(mpc_nbody.hermite_interpolate(times[::-1],
+                                                circle(times)[::-1], times)
+                  == circle(times))
+
+
+@pytest.mark.parametrize(('window'), [1000., 100.])
+def test_run_nbody_output_epochs(window):
+    '''
+    Test that output resampled to a fixed cadence, in one or several
+    integration windows, matches interpolating the full output.
+    '''
+    vectors = np.array([-2.093834952466475E+00, 1.000913720009255E+00,
+                        4.197984954533551E-01, -4.226738336365523E-03,
+                        -9.129140909705199E-03, -3.627121453928710E-03])
+    tstart = 2456117.641933589
+    (_, _, output_times, output_vectors, _, _
+     ) = mpc_nbody.run_nbody(vectors, tstart, 2, 600)
+    times, resampled = mpc_nbody.run_nbody_resampled(vectors, tstart, 20, 600,
+                                                     0.5, window=window)
+    assert np.all(times == tstart + 0.5 * np.arange(1201))
+    assert resampled.shape == (1201, 1, 6)
+    expected = mpc_nbody.hermite_interpolate(output_times, output_vectors,
+                                             times)
+    assert np.all(np.abs(resampled - expected) < 1e-7)
+    # Also through NbodySim, with explicit epochs
+    Sim = mpc_nbody.NbodySim()
+    Sim(vectors=vectors, tstart=tstart, tstep=20, trange=600,
+        output_epochs=times[[3, 100, 1200]])
+    assert np.all(Sim.output_times == times[[3, 100, 1200]])
+    assert Sim.output_n_times == 3
+    with pytest.raises(ValueError):
+        mpc_nbody.run_nbody(vectors, tstart, 20, 600,
+                            output_epochs=[tstart - 1.])
+
+
+def test_run_nbody_output_epochs_stalled(monkeypatch):
+    '''
+    Test that output epochs the integration never reaches raise an error,
+    rather than leaving uninitialised output.
+    '''
+    def stalled(tstart, tstep, trange, geocentric, n_particles, state):
+        return (np.array([tstart]), state.reshape(1, n_particles, 6), 1,
+                n_particles)
+    monkeypatch.setattr(mpc_nbody, 'integration_function', stalled)
+    with pytest.raises(ValueError):
+        mpc_nbody.run_nbody_resampled(np.ones(6), 2456117.5, 20, 600, 10.)
+
+
+def test_NbodySim_metrics(tmp_path, capsys):
+    '''
+    Test that NbodySim reports its stages & counters to its Metrics, and
+    prints nothing unless verbose.
+    '''
+    vectors = np.array([-2.093834952466475E+00, 1.000913720009255E+00,
+                        4.197984954533551E-01, -4.226738336365523E-03,
+                        -9.129140909705199E-03, -3.627121453928710E-03] * 2)
+    tstart = 2456117.641933589
+    M = metrics.Metrics()
+    Sim = mpc_nbody.NbodySim(metrics=M)
+    capsys.readouterr()
+    output_file = str(tmp_path / 'simulation_states.dat')
+    Sim(vectors=vectors, tstart=tstart, tstep=20, trange=60,
+        save_output=output_file, use_cache=False)
+    assert capsys.readouterr().out == ''
+    assert set(M.calls) == {'input_reshaping', 'integration', 'output_write'}
+    assert M.counters == {'particles': 2, 'substeps': Sim.output_n_times,
+                          'bytes_written': os.path.getsize(output_file)}
+    Sim.output_store = None
+    Sim(vectors=vectors, tstart=tstart, tstep=20, trange=60,
+        output_store=str(tmp_path / 'store'))
+    assert M.counters['bytes_written'] > os.path.getsize(output_file)
+    # Work outside of the NbodySim is not counted
+    mpc_nbody.run_nbody(vectors, tstart, 20, 60, use_cache=False)
+    assert M.counters['particles'] == 4
+    # Parsing
+    M = metrics.Metrics()
+    mpc_nbody.NbodySim(os.path.join(DATA_DIR, 'MPCORB_sample.DAT'), 'mpcorb',
+                       metrics=M)
+    assert M.calls['parse'] == 1 and M.calls['time_conversion'] >= 1
+
+
+def test_run_cache(tmp_path, monkeypatch):
+    '''
+    Test that repeating a run_nbody call with use_cache comes from the
+    cache (in memory, then on disk), unless bypassed (the default) or any
+    input differs.
+    '''
+    monkeypatch.setattr(mpc_nbody, 'run_cache', ResultCache(
+        disk=DiskCache(str(tmp_path / 'run'))))
+    vectors = np.array([-2.093834952466475E+00, 1.000913720009255E+00,
+                        4.197984954533551E-01, -4.226738336365523E-03,
+                        -9.129140909705199E-03, -3.627121453928710E-03])
+    tstart = 2456117.641933589
+    first = mpc_nbody.run_nbody(vectors, tstart, 20, 600, use_cache=True)
+    assert mpc_nbody.run_cache.stats['misses'] == 1
+
+    def not_again(*args, **kwargs):
+        raise AssertionError("Integrated again")
+    monkeypatch.setattr(mpc_nbody, 'integration_function', not_again)
+    again = mpc_nbody.run_nbody(vectors.copy(), tstart, 20., 600,
+                                 use_cache=True)
+    assert mpc_nbody.run_cache.stats['hits'] == 1
+    assert np.all(again[2] == first[2]) and np.all(again[3] == first[3])
+    assert again[4:] == first[4:]
+    with pytest.raises(ValueError):  # Shared, so read-only
+        again[3][0, 0, 0] = 0.
+    first[3][0, 0, 0] = 0.  # But the caller's own result stays writable
+    Sim = mpc_nbody.NbodySim()
+    Sim(vectors=vectors, tstart=tstart, tstep=20, trange=600, use_cache=True)
+    assert Sim.output_vectors is again[3]
+    # Bypassed, or different inputs
+    for args, kwargs in [((vectors, tstart, 20, 600), {}),
+                         ((vectors, tstart, 10, 600), {'use_cache': True}),
+                         ((vectors, tstart, 20, 600), {'use_cache': True,
+                                                       'geocentric': True}),
+                         ((vectors, tstart, 20, 600), {'use_cache': True,
+                                                       'output_epochs': 1.})]:
+        with pytest.raises(AssertionError):
+            mpc_nbody.run_nbody(*args, **kwargs)
+    # A new process (cache) still finds it on disk
+    monkeypatch.setattr(mpc_nbody, 'run_cache', ResultCache(
+        disk=DiskCache(str(tmp_path / 'run'))))
+    from_disk = mpc_nbody.run_nbody(vectors, tstart, 20, 600, use_cache=True)
+    assert mpc_nbody.run_cache.stats['disk_hits'] == 1
+    assert np.all(from_disk[3] == again[3])
+
+
 # Non-test helper functions
 # -----------------------------------------------------------------------------
 
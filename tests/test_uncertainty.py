@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# mpc_nbody/tests/test_uncertainty.py
+
+'''
+----------------------------------------------------------------------------
+tests for mpc_nbody's uncertainty module.
+
+----------------------------------------------------------------------------
+'''
+
+# import third-party packages
+# -----------------------------------------------------------------------------
+import sys
+import os
+import numpy as np
+import pytest
+
+# Import neighbouring packages
+# -----------------------------------------------------------------------------
+sys.path.append(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+from mpc_nbody import uncertainty
+
+# Default for caching stuff using lru_cache
+# -----------------------------------------------------------------------------
+
+# Constants & Test Data
+# -----------------------------------------------------------------------------
+RNG = np.random.default_rng(2022)
+N_OBJECTS = 5
+STATES = RNG.normal(size=(N_OBJECTS, 6))
+# Elongated, correlated covariances, scaled like those of real orbits
+MATRICES = RNG.normal(size=(N_OBJECTS, 6, 6)) * \
+    np.array([1e-6, 1e-6, 1e-6, 1e-8, 1e-8, 1e-8])
+COVARIANCES = MATRICES @ MATRICES.transpose(0, 2, 1)
+
+
+# Tests
+# -----------------------------------------------------------------------------
+
+def test_covariance_factor():
+    '''Test that the factors are square roots, also of singular matrices.'''
+    factor = uncertainty.covariance_factor(COVARIANCES)
+    assert np.allclose(factor @ factor.transpose(0, 2, 1), COVARIANCES,
+                       rtol=0, atol=1e-25)
+    singular = COVARIANCES.copy()
+    singular[2] = np.outer(MATRICES[2, :, 0], MATRICES[2, :, 0])
+    factor = uncertainty.covariance_factor(singular)
+    assert np.allclose(factor @ factor.transpose(0, 2, 1), singular,
+                       rtol=0, atol=1e-25)
+    assert np.all(factor[[0, 1, 3, 4]] ==
+                  np.linalg.cholesky(COVARIANCES[[0, 1, 3, 4]]))
+    with pytest.raises(ValueError):
+        uncertainty.covariance_factor(np.full((6, 6), np.nan))
+
+
+def test_sample_clones():
+    '''
+    Test that the clones reproduce the covariances, reproducibly.
+    '''
+    n_clones = 20000
+    clones = uncertainty.sample_clones(STATES, COVARIANCES, n_clones, rng=1)
+    assert clones.shape == (N_OBJECTS, n_clones, 6)
+    assert np.all(clones == uncertainty.sample_clones(STATES, COVARIANCES,
+                                                      n_clones, rng=1))
+    mean, covariance = uncertainty.clone_statistics(clones)
+    sigma = np.sqrt(np.diagonal(COVARIANCES, axis1=1, axis2=2))
+    assert np.all(np.abs(mean - STATES) < 5 * sigma / np.sqrt(n_clones))
+    correlation = covariance / sigma[:, :, None] / sigma[:, None, :]
+    true_correlation = COVARIANCES / sigma[:, :, None] / sigma[:, None, :]
+    assert np.allclose(correlation, true_correlation, rtol=0, atol=0.05)
+    clones = uncertainty.sample_clones(STATES, COVARIANCES, 3, rng=1,
+                                       include_nominal=True)
+    assert np.all(clones[:, 0] == STATES)
+    assert np.all(clones[:, 1:] != STATES[:, None, :])
+
+
+# End